@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Benchmarks the memory used by elements, and the time it takes to GET a
+page of them, or one of them, with elements stored as objects and stored
+compactly.
+
+The memory is what the stored elements themselves take: the element
+object and its instance dictionary, or the compactly stored element and
+its tuple of values. The values are the same either way.
+"""
+import sys
+
+from twisted.web.resource import IResource
+
+from txyoga import base, compact
+
+from util import makeRequest, measure, render, report
+
+
+class Shed(base.Element):
+    exposedAttributes = "name", "color", "height", "width", "owner"
+    updatableAttributes = "color", "owner"
+
+    def __init__(self, name, color, height, width):
+        self.name = name
+        self.color = color
+        self.height = height
+        self.width = width
+        self.owner = None
+
+
+
+class Sheds(base.Collection):
+    exposedElementAttributes = Shed.exposedAttributes
+    pageSize = maxPageSize = 100
+
+
+
+class CompactSheds(compact.CompactCollection):
+    exposedElementAttributes = Shed.exposedAttributes
+    pageSize = maxPageSize = 100
+
+
+
+def populate(collection, count=10000):
+    for i in xrange(count):
+        collection.add(Shed("shed%d" % (i,), "red", 2.5, 3.0))
+    return collection
+
+
+def storedSize(element):
+    if isinstance(element, compact.CompactElement):
+        return sys.getsizeof(element) + sys.getsizeof(element._values)
+    return sys.getsizeof(element) + sys.getsizeof(element.__dict__)
+
+
+def main():
+    collections = [("objects", populate(Sheds())),
+                   ("compact", populate(CompactSheds()))]
+
+    for name, collection in collections:
+        elements = collection._elements
+        size = sum(storedSize(e) for e in elements) / float(len(elements))
+        print "%-40s %10.1f bytes/element" % ("stored " + name, size)
+
+    for what, f in [("page states", exportPage), ("page GET", getPage),
+                    ("element GET", getElement)]:
+        baseline = None
+        for name, collection in collections:
+            microseconds = measure(f(collection), iterations=1000)
+            report("%s, %s" % (what, name), microseconds, baseline)
+            baseline = baseline or microseconds
+
+
+def exportPage(collection):
+    attrs = collection.exposedElementAttributes
+    elements = collection._elements[:collection.pageSize]
+    return lambda: [e.toState(attrs) for e in elements]
+
+
+def getPage(collection):
+    root = IResource(collection)
+    return lambda: render(root, makeRequest())
+
+
+def getElement(collection):
+    root = IResource(collection)
+    root.maximumCachedRoutes = 0
+    return lambda: render(root, makeRequest(["shed5"]))
+
+
+if __name__ == "__main__":
+    main()
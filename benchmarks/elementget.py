@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Benchmarks element GETs through a collection resource.
+
+Compares collections that produce their elements immediately, which take
+the synchronous fast path, with collections that produce them later, which
+go through ``DeferredResource``.
+"""
+from twisted.internet import defer
+from twisted.web.resource import IResource
+
+from txyoga import base
+
+from util import makeRequest, measure, render, report
+
+
+class Cookie(base.Element):
+    exposedAttributes = "name", "flavor"
+
+    def __init__(self, name, flavor):
+        self.name = name
+        self.flavor = flavor
+
+
+
+class Jar(base.Collection):
+    pass
+
+
+
+class DeferringJar(Jar):
+    """
+    A jar that produces its elements after the lookup has returned, like an
+    asynchronous backend would.
+    """
+    def __init__(self):
+        Jar.__init__(self)
+        self.pending = []
+
+
+    def get(self, identifier):
+        d = defer.Deferred()
+        self.pending.append((d, Jar.get(self, identifier)))
+        return d
+
+
+    def fire(self):
+        pending, self.pending = self.pending, []
+        for d, result in pending:
+            result.chainDeferred(d)
+
+
+
+def populate(collection):
+    for i in xrange(100):
+        collection.add(Cookie("cookie%d" % i, "chocolate"))
+    return collection
+
+
+def main():
+    jar = populate(Jar())
+    root = IResource(jar)
+    def synchronous():
+        render(root, makeRequest(["cookie42"]))
+
+    deferringJar = populate(DeferringJar())
+    deferringRoot = IResource(deferringJar)
+    def deferred():
+        render(deferringRoot, makeRequest(["cookie42"]))
+        deferringJar.fire()
+
+    baseline = measure(deferred)
+    report("element GET, deferred lookup", baseline)
+    report("element GET, synchronous fast path", measure(synchronous),
+           baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Benchmarks GETs of elements deep in a tree of collections, like
+``/oceania/ministries/minitrue``.
+
+Compares resolving the path with the resources of recently requested
+elements kept, and with the routes of recently read paths kept, with
+making new resources for every request.
+"""
+from twisted.web.resource import IResource
+
+from txyoga import base
+
+from util import makeRequest, measure, render, report
+
+
+class Ministry(base.Element):
+    exposedAttributes = "name",
+
+    def __init__(self, name):
+        self.name = name
+
+
+
+class Ministries(base.Collection):
+    exposedElementAttributes = "name",
+
+
+
+class State(base.Element):
+    exposedAttributes = "name",
+    children = "ministries",
+
+    def __init__(self, name):
+        self.name = name
+        self.ministries = Ministries()
+        for ministryName in ["miniluv", "minipax", "miniplenty", "minitrue"]:
+            self.ministries.add(Ministry(ministryName))
+
+
+
+class World(base.Collection):
+    exposedElementAttributes = "name",
+
+
+
+def main():
+    world = World()
+    for name in ["oceania", "eurasia", "eastasia"]:
+        world.add(State(name))
+
+    root = IResource(world)
+    path = ["oceania", "ministries", "minitrue"]
+    def nested():
+        render(root, makeRequest(path))
+
+    root.maximumCachedRoutes = 0
+    root.maximumCachedResources = 0
+    baseline = measure(nested)
+    report("nested GET, new resources", baseline)
+
+    root.maximumCachedResources = 1000
+    report("nested GET, kept resources", measure(nested), baseline)
+
+    root.maximumCachedRoutes = 1000
+    report("nested GET, kept routes", measure(nested), baseline)
+
+
+if __name__ == "__main__":
+    main()
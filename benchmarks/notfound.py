@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Benchmarks GETs for missing elements (404s).
+
+Compares collections reporting misses with ``defer.fail`` through the
+deferred error reporting path to the default collection, which reports
+misses with quick failures that are turned into error pages directly.
+"""
+from twisted.internet import defer
+from twisted.web.resource import IResource
+
+from txyoga import base, errors
+
+from util import makeRequest, measure, render, report
+
+
+class Jar(base.Collection):
+    pass
+
+
+
+class DeferringJar(Jar):
+    """
+    A jar that reports misses with ``defer.fail``, after the lookup has
+    returned.
+    """
+    def __init__(self):
+        Jar.__init__(self)
+        self.pending = []
+
+
+    def get(self, identifier):
+        d = defer.Deferred()
+        self.pending.append((d, identifier))
+        return d
+
+
+    def fire(self):
+        pending, self.pending = self.pending, []
+        for d, identifier in pending:
+            d.errback(errors.MissingElementError(identifier))
+
+
+
+def main():
+    root = IResource(Jar())
+    def quick():
+        render(root, makeRequest(["bogus"]))
+
+    deferringJar = DeferringJar()
+    deferringRoot = IResource(deferringJar)
+    def deferred():
+        render(deferringRoot, makeRequest(["bogus"]))
+        deferringJar.fire()
+
+    baseline = measure(deferred)
+    report("404, deferred failure", baseline)
+    report("404, quick failure and error page", measure(quick), baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Benchmarks the latency of small requests while large pages are being
+encoded, with and without a process pool.
+
+Small element GETs and very large page GETs are scheduled at steady
+rates. Every small request is timed from when
+it was scheduled until it was finished, so time spent waiting for the
+reactor thread counts too.
+"""
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.web.resource import IResource
+
+from txyoga import base, offload
+
+from util import makeRequest, render
+
+
+class Shed(base.Element):
+    exposedAttributes = "name", "color", "coordinates", "tags", "history"
+
+    def __init__(self, name):
+        self.name = name
+        self.color = "red"
+        self.coordinates = [51.05, 3.72]
+        self.tags = ["wooden", "painted", "contentious"]
+        self.history = [{"color": c, "votes": i}
+                        for i, c in enumerate(["red", "green", "blue"] * 5)]
+
+
+
+class Sheds(base.Collection):
+    exposedElementAttributes = Shed.exposedAttributes
+    pageSize = maxPageSize = 5000
+
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@defer.inlineCallbacks
+def run(root, duration=3.0, smallInterval=0.005, largeInterval=0.25):
+    latencies = []
+
+    def small(due):
+        request = render(root, makeRequest(["shed42"]))
+        d = request.notifyFinish()
+        d.addCallback(lambda _: latencies.append(time.time() - due))
+
+    def large():
+        render(root, makeRequest())
+
+    started = time.time()
+    for i in xrange(int(duration / smallInterval)):
+        delay = i * smallInterval
+        reactor.callLater(delay, small, started + delay)
+    for i in xrange(int(duration / largeInterval)):
+        reactor.callLater(i * largeInterval, large)
+
+    yield task.deferLater(reactor, duration + 1, lambda: None)
+    defer.returnValue(latencies)
+
+
+@defer.inlineCallbacks
+def main(pool):
+    sheds = Sheds()
+    for i in xrange(5000):
+        sheds.add(Shed("shed%d" % (i,)))
+
+    root = IResource(sheds)
+
+    for name, processPool in [("reactor thread", None),
+                              ("process pool", pool)]:
+        root.processPool = processPool
+        latencies = yield run(root)
+        print "%-20s %6d small requests, p50 %7.2f ms, p99 %7.2f ms" % (
+            name, len(latencies), percentile(latencies, 0.5) * 1e3,
+            percentile(latencies, 0.99) * 1e3)
+
+    pool.close()
+    reactor.stop()
+
+
+if __name__ == "__main__":
+    pool = offload.ProcessPool()
+    pool.start()
+    reactor.callWhenRunning(main, pool)
+    reactor.run()
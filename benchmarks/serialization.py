@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Benchmarks JSON against MessagePack for encoding pages and decoding
+element states.
+"""
+from StringIO import StringIO
+
+from txyoga import serializers
+
+from util import measure, report
+
+
+def makeState(i):
+    return {"name": "bikeshed%d" % (i,),
+            "color": "red",
+            "maximumOccupancy": 100,
+            "coordinates": [51.05 + i, 3.72 - i],
+            "tags": ["wooden", "painted", "contentious"]}
+
+
+def main():
+    if serializers.decoders.get("application/msgpack") is None:
+        raise SystemExit("MessagePack is not available")
+
+    page = {"prev": "http://localhost/sheds?start=0&stop=100",
+            "next": "http://localhost/sheds?start=200&stop=300",
+            "results": [makeState(i) for i in xrange(100)]}
+    state = makeState(0)
+
+    codecs = [("JSON", serializers.jsonEncode, serializers.jsonDecode),
+              ("MessagePack", serializers.msgpackEncode,
+               serializers.msgpackDecode)]
+
+    baselines = {}
+    for name, encode, decode in codecs:
+        encodePage = lambda: encode(page)
+        encodedState = encode(state)
+        decodeState = lambda: decode(StringIO(encodedState))
+
+        for operation, f, iterations in [("page encode", encodePage, 1000),
+                                         ("element decode", decodeState,
+                                          10000)]:
+            result = measure(f, iterations)
+            report("%s, %s" % (operation, name), result,
+                   baselines.get(operation))
+            baselines.setdefault(operation, result)
+
+
+if __name__ == "__main__":
+    main()
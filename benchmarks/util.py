@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Utilities for txyoga benchmarks.
+
+Run a benchmark from the txyoga base directory, for example::
+
+    PYTHONPATH=. python benchmarks/elementget.py
+"""
+import time
+
+from twisted.web import http_headers, server
+
+from txyoga.test.util import _FakeRequest
+
+
+jsonAcceptHeaders = http_headers.Headers()
+jsonAcceptHeaders.setRawHeaders("Accept", ["application/json"])
+
+
+def makeRequest(path=(), **kwargs):
+    """
+    Makes a fake request for the given path.
+    """
+    kwargs.setdefault("requestHeaders", jsonAcceptHeaders)
+    request = _FakeRequest(**kwargs)
+    request.postpath = list(path)
+    return request
+
+
+def render(root, request):
+    """
+    Renders a request against a resource tree, like ``twisted.web`` would.
+    """
+    resource = root
+    while request.postpath and not resource.isLeaf:
+        segment = request.postpath.pop(0)
+        request.prepath.append(segment)
+        resource = resource.getChildWithDefault(segment, request)
+
+    result = resource.render(request)
+    if result is not server.NOT_DONE_YET:
+        request.write(result)
+        request.finish()
+
+    return request
+
+
+def measure(f, iterations=10000, repeat=5):
+    """
+    Calls ``f`` ``iterations`` times, ``repeat`` times over.
+
+    Returns the best time per call, in microseconds.
+    """
+    best = None
+    for _ in xrange(repeat):
+        started = time.time()
+        for _ in xrange(iterations):
+            f()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best / iterations * 1e6
+
+
+def report(name, microseconds, baseline=None):
+    """
+    Prints a single benchmark result.
+    """
+    line = "%-40s %10.2f us/call" % (name, microseconds)
+    if baseline is not None:
+        line += " (%.2fx)" % (baseline / microseconds,)
+    print line
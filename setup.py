@@ -17,5 +17,6 @@ setuptools.setup(name='txyoga',
         "Development Status :: 3 - Alpha",
         "Framework :: Twisted",
         "License :: OSI Approved :: ISC License (ISCL)",
+        "Programming Language :: Python :: 2.7",
         "Topic :: Internet :: WWW/HTTP",
         ])
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Admission control and load shedding.
+"""
+from collections import deque
+
+from twisted.internet import defer
+
+from txyoga import errors
+
+
+class Budget(object):
+    """
+    A limit on the number of concurrent operations.
+
+    Operations over the limit wait in a queue of at most
+    ``maximumWaiting`` operations. Operations that don't fit in the queue
+    either are shed.
+
+    @ivar inFlight: The number of operations currently admitted.
+    @ivar shed: The number of operations that were shed so far.
+    """
+    def __init__(self, limit, maximumWaiting=0):
+        self.limit = limit
+        self.maximumWaiting = maximumWaiting
+        self.inFlight = 0
+        self.shed = 0
+        self._waiting = deque()
+
+
+    @property
+    def waiting(self):
+        """
+        The number of operations currently waiting to be admitted.
+        """
+        return len(self._waiting)
+
+
+    def acquire(self):
+        """
+        Admits an operation.
+
+        Returns a ``Deferred`` that fires when the operation is admitted,
+        or ``None`` if the operation was shed.
+        """
+        if self.inFlight < self.limit:
+            self.inFlight += 1
+            return defer.succeed(None)
+
+        if len(self._waiting) >= self.maximumWaiting:
+            self.shed += 1
+            return None
+
+        d = defer.Deferred(self._waiting.remove)
+        self._waiting.append(d)
+        return d
+
+
+    def release(self):
+        """
+        Signals that an admitted operation is done.
+
+        The next waiting operation, if any, is admitted in its place.
+        """
+        if self._waiting:
+            self._waiting.popleft().callback(None)
+        else:
+            self.inFlight -= 1
+
+
+
+class AdmissionControl(object):
+    """
+    Limits the number of concurrent requests, separately for reads (GET
+    and HEAD requests) and writes (everything else), so that bursts of
+    one can't starve the other.
+
+    A limit of ``None`` means that kind of request isn't limited. Excess
+    requests wait in a queue of at most ``maximumWaiting`` requests, or
+    are refused with a ``ServiceUnavailableError`` advising the client to
+    retry after ``retryAfter`` seconds.
+
+    If there's a parent admission control, requests have to be admitted
+    by that as well. Sharing a parent between the admission controls of
+    several collections imposes a global limit.
+    """
+    readMethods = frozenset(["GET", "HEAD"])
+
+    def __init__(self, maximumReads=None, maximumWrites=None,
+                 maximumWaiting=0, retryAfter=1, parent=None):
+        self.reads = self._makeBudget(maximumReads, maximumWaiting)
+        self.writes = self._makeBudget(maximumWrites, maximumWaiting)
+        self.retryAfter = retryAfter
+        self.parent = parent
+
+
+    def _makeBudget(self, limit, maximumWaiting):
+        if limit is not None:
+            return Budget(limit, maximumWaiting)
+
+
+    def admit(self, request):
+        """
+        Admits a request.
+
+        Returns a ``Deferred`` that fires when the request is admitted,
+        which may be immediately. The request holds on to its place until
+        it is finished. Requests that were already admitted by this
+        admission control are admitted again immediately.
+        """
+        admissions = getattr(request, "admissions", None)
+        if admissions is None:
+            admissions = request.admissions = []
+        elif self in admissions:
+            return defer.succeed(None)
+        admissions.append(self)
+
+        if self.parent is not None:
+            d = self.parent.admit(request)
+            return d.addCallback(lambda _: self._acquire(request))
+
+        return self._acquire(request)
+
+
+    def _acquire(self, request):
+        """
+        Gets a place for a request from the appropriate budget.
+        """
+        if request.method in self.readMethods:
+            budget = self.reads
+        else:
+            budget = self.writes
+
+        if budget is None:
+            return defer.succeed(None)
+
+        d = budget.acquire()
+        if d is None:
+            raise errors.ServiceUnavailableError(self.retryAfter)
+
+        finished = request.notifyFinish()
+        if d.called:
+            finished.addBoth(lambda _: budget.release())
+            return d
+
+        def admitted(result):
+            finished.addBoth(lambda _: budget.release())
+            return result
+
+        # Stop waiting when the client goes away while waiting
+        finished.addBoth(lambda _: d.called or d.cancel())
+        return d.addCallback(admitted)
@@ -4,12 +4,14 @@
 Base classes for objects that will be exposed through a REST API.
 """
 import inspect
+from collections import OrderedDict
 from functools import partial
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
+from twisted.python import log
 from zope.interface import implements
 
-from txyoga import errors, interface
+from txyoga import changes, errors, interface
 
 
 class Element(object):
@@ -19,26 +21,88 @@ class Element(object):
     exposedAttributes = ()
     identifyingAttribute = "name"
     updatableAttributes = ()
+    blockingAttributes = ()
 
     name = "default"
 
+    threadPool = None
+
 
     def toState(self, attrs=interface.ALL):
+        """
+        Exports the state of this element.
+
+        If any of the attributes are blocking, they are evaluated
+        concurrently in the thread pool, and this returns a ``Deferred``
+        that fires with the state. Otherwise, the state is returned
+        directly.
+        """
         if attrs is interface.ALL:
             attrs = self.exposedAttributes
 
+        if self.blockingAttributes:
+            blocking = [a for a in attrs if a in self.blockingAttributes]
+            if blocking:
+                return self._toStateInThreads(attrs, blocking)
+
         return dict((a, self.getSerializableAttribute(a)) for a in attrs)
 
 
+    def _toStateInThreads(self, attrs, blocking):
+        """
+        Exports the state of this element, evaluating the given blocking
+        attributes in the thread pool.
+        """
+        from twisted.internet import reactor
+        from txyoga import offload
+        pool = self.threadPool or offload.getThreadPool()
+
+        state = dict((a, self.getSerializableAttribute(a))
+                     for a in attrs if a not in blocking)
+
+        def evaluate(attr):
+            d = threads.deferToThreadPool(reactor, pool,
+                                          self.getSerializableAttribute, attr)
+
+            @d.addCallback
+            def store(value):
+                state[attr] = value
+
+            return d
+
+        d = defer.gatherResults(map(evaluate, blocking), consumeErrors=True)
+        d.addErrback(errors.firstFailure)
+        return d.addCallback(lambda _: state)
+
+
     def getSerializableAttribute(self, name):
         """
         Returns an attribute in a serializable form.
 
         Override this method if you have attributes that aren't serializable.
+        If computing an attribute blocks, for example because it does I/O,
+        also list it in ``blockingAttributes``, so that it is computed in a
+        thread instead of on the reactor thread.
         """
         return getattr(self, name)
 
 
+    def getCreationState(self):
+        """
+        Gets the state needed to create this element again with
+        ``fromState``: its constructor arguments and updatable attributes.
+
+        Like ``toState``, this returns a ``Deferred`` if any of them are
+        blocking.
+        """
+        try:
+            attrs = inspect.getargspec(self.__init__).args[1:]
+        except TypeError: # No constructor of its own
+            attrs = []
+        attrs.extend(a for a in self.updatableAttributes if a not in attrs)
+        return self.toState(attrs)
+
+
     @classmethod
     def fromState(cls, state):
         """
@@ -97,8 +161,82 @@ class Element(object):
         return defer.succeed(None)
 
 
+    def patch(self, patch):
+        """
+        Applies a JSON merge patch (RFC 7386) to this element.
+
+        Only the attributes the patch actually changes are passed to
+        ``update``, so ``update`` gets the smallest possible delta. Since
+        elements have a fixed set of attributes, ``null`` sets a top-level
+        attribute to ``None`` instead of removing it.
+
+        Returns a ``Deferred`` that fires with that delta. Patches that
+        aren't objects (dictionaries) fail with a ``PatchError``, and
+        patches that change attributes that aren't updatable (including
+        attributes the element doesn't have) fail with an
+        ``AttributeValueUpdateError``.
+        """
+        if not isinstance(patch, dict):
+            return defer.fail(errors.PatchError("patch is not an object"))
+
+        delta = {}
+        for attr, value in patch.iteritems():
+            current = getattr(self, attr, _MISSING)
+            if isinstance(value, dict) and isinstance(current, dict):
+                value = _mergePatch(current, value)
+            if value == current:
+                continue
+
+            if attr not in self.updatableAttributes:
+                UpdateError = partial(errors.AttributeValueUpdateError,
+                                      attribute=attr, newValue=value)
+                if attr in self.exposedAttributes:
+                    return defer.fail(UpdateError(currentValue=current))
+                else: # Don't expose the current value by accident
+                    return defer.fail(UpdateError())
+
+            delta[attr] = value
+
+        return self.update(delta).addCallback(lambda _: delta)
+
+
+
+_MISSING = object()
+
+
+def _mergePatch(target, patch):
+    """
+    Applies a JSON merge patch to a dictionary, producing a new one.
+    """
+    result = dict(target)
+    for key, value in patch.iteritems():
+        if value is None:
+            result.pop(key, None)
+        elif isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _mergePatch(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
 
 class Collection(object):
+    """
+    An in-memory collection.
+
+    Every change to an element gives it a new version, and the collection
+    keeps track of the elements that were removed, so that clients can ask
+    what changed since a version they saw (see ``changedSince``). Only the
+    ``maximumTombstones`` most recently removed elements are remembered.
+
+    Taking a ``snapshot`` is cheap: the element list is shared with the
+    snapshot, and only copied when an element is removed from it while
+    it is shared. Adding elements never copies it.
+
+    Copies of a collection in several processes can leave numbering their
+    changes to a sequencer (see ``setSequencer``), so that the versions
+    are the same in all of them.
+    """
     implements(interface.ICollection)
 
     defaultElementClass = Element
@@ -107,10 +245,276 @@ class Collection(object):
     pageSize = 10
     maxPageSize = 100
 
+    admissionControl = None
+    operationTimeouts = {}
+
+    maximumTombstones = 1000
+
+    sequencer = None
+
+    _changeListeners = ()
+    _statesWanted = False
+    _heldChanges = None
+
 
     def __init__(self):
         self._elements = []
         self._elementsByIdentifier = {}
+        self._shared = False
+
+        self.version = 0
+        self._versions = OrderedDict()
+        self._tombstones = OrderedDict()
+        self._oldestVersion = 0
+
+
+    def addChangeListener(self, listener, withState=True):
+        """
+        Calls ``listener`` with a ``Change`` for every change to the
+        elements of this collection.
+
+        Listeners that only care about which elements changed can pass
+        ``withState=False``; as long as no listener wants them, the
+        states of added and updated elements aren't exported, and the
+        changes they get have no state.
+        """
+        listeners = list(self._changeListeners) + [(listener, withState)]
+        self._setChangeListeners(listeners)
+
+
+    def removeChangeListener(self, listener):
+        listeners = list(self._changeListeners)
+        for entry in listeners:
+            if entry[0] == listener:
+                listeners.remove(entry)
+                break
+        else:
+            raise ValueError("%r isn't a change listener" % (listener,))
+        self._setChangeListeners(listeners)
+
+
+    def _setChangeListeners(self, listeners):
+        self._changeListeners = listeners
+        self._statesWanted = (self.sequencer is not None
+                              or any(withState for _, withState in listeners))
+
+
+    def setSequencer(self, sequencer):
+        """
+        Leaves numbering the changes to this collection to ``sequencer``.
+
+        Changes made to the collection are then passed to the sequencer,
+        with their state, instead of getting a new version and being told
+        to the change listeners. That only happens once the sequencer
+        applies them with a sequence number (see ``applyChange``), which
+        becomes the new version.
+        """
+        self.sequencer = sequencer
+        self._setChangeListeners(self._changeListeners)
+
+
+    def _notify(self, kind, identifier, state=None, sequence=None):
+        """
+        Records a new version of the changed element, and tells the change
+        listeners about the change, which has that version as its sequence
+        number.
+
+        Changes with a sequence number from the sequencer get it as their
+        version. Other changes to a collection with a sequencer are passed
+        on to the sequencer instead.
+
+        If the state is a ``Deferred``, because it has blocking attributes
+        that are evaluated in threads, the listeners are told once it
+        fires. Changes made in the meantime are held back until then, so
+        that listeners always get the changes in order.
+        """
+        if sequence is not None:
+            self._recordVersion(kind, identifier, sequence)
+        elif self.sequencer is None:
+            self._recordVersion(kind, identifier)
+            sequence = self.version
+
+        if not self._changeListeners and self.sequencer is None:
+            return
+
+        change = changes.Change(kind, identifier, state, sequence)
+        exporting = isinstance(state, defer.Deferred)
+        if self._heldChanges is None and not exporting:
+            self._tellListeners(change)
+            return
+
+        if self._heldChanges is None:
+            self._heldChanges = []
+        self._heldChanges.append(change)
+
+        if exporting:
+            state.addCallbacks(self._exported, self._notExported,
+                               callbackArgs=(change,), errbackArgs=(change,))
+
+
+    def _tellListeners(self, change):
+        if self.sequencer is not None and change.sequence is None:
+            self.sequencer(change)
+            return
+
+        for listener, _ in self._changeListeners:
+            listener(change)
+
+
+    def _exported(self, state, change):
+        change.state = state
+        self._releaseChanges()
+
+
+    def _notExported(self, reason, change):
+        log.err(reason, "Couldn't export the state of %r, so change "
+                        "listeners weren't told about it" % (change,))
+        self._heldChanges.remove(change)
+        self._releaseChanges()
+
+
+    def _releaseChanges(self):
+        """
+        Tells the listeners about the held back changes, up to the first
+        one whose state is still being exported.
+        """
+        held = self._heldChanges
+        while held and not isinstance(held[0].state, defer.Deferred):
+            self._tellListeners(held.pop(0))
+        if not held:
+            self._heldChanges = None
+
+
+    def elementUpdated(self, element, attrs):
+        """
+        Tells the change listeners that some attributes of an element of
+        this collection were updated.
+
+        Elements don't know what collections they are in, so whatever
+        updates an element directly has to call this. Element resources
+        do so for the collection they were found in.
+
+        Like everywhere else, blocking attributes are evaluated in threads
+        (see ``Element.toState``).
+        """
+        identifier = getattr(element, element.identifyingAttribute)
+
+        state = None
+        if self._statesWanted:
+            state = element.toState(list(attrs))
+
+        self._notify(changes.UPDATED, identifier, state)
+
+
+    def _recordVersion(self, kind, identifier, version=None):
+        """
+        Gives a changed element a new version, by default the one after
+        the current version.
+
+        Elements are kept in the order they were last changed in, so that
+        the most recent changes can be found without looking at the
+        others. Removed elements leave a tombstone; when there are too
+        many, the oldest ones are forgotten.
+        """
+        self.version = self.version + 1 if version is None else version
+        self._versions.pop(identifier, None)
+        self._tombstones.pop(identifier, None)
+
+        if kind == changes.REMOVED:
+            self._tombstones[identifier] = self.version
+            if len(self._tombstones) > self.maximumTombstones:
+                _, self._oldestVersion = self._tombstones.popitem(last=False)
+        else:
+            self._versions[identifier] = self.version
+
+
+    def getElementVersion(self, identifier):
+        """
+        Gets the version of the last change to an element, or ``None`` if
+        the element isn't in this collection.
+        """
+        return self._versions.get(identifier)
+
+
+    def changedSince(self, version):
+        """
+        Gets what changed after the given version of this collection.
+
+        Returns a ``Deferred`` that fires with a dictionary with the
+        elements that were added or ``changed``, the identifiers of those
+        that were ``removed``, in the order they were changed in, and the
+        current ``version``.
+
+        Fails with ``ChangesUnavailableError`` when the version is so old
+        that some of the elements that were removed since then were
+        forgotten, or is newer than the current version (for example,
+        because it came from another process that doesn't share this
+        collection's sequencer). Clients then have to get the whole
+        collection again.
+        """
+        if not self._oldestVersion <= version <= self.version:
+            oldest = self._oldestVersion
+            return errors.quickFail(errors.ChangesUnavailableError(version,
+                                                                   oldest))
+
+        elements = self._elementsByIdentifier
+        changed = [elements[identifier] for identifier
+                   in _changedSince(self._versions, version)
+                   if identifier in elements]
+        removed = _changedSince(self._tombstones, version)
+        return defer.succeed({"changed": changed, "removed": removed,
+                              "version": self.version})
+
+
+    def applyChange(self, change):
+        """
+        Applies a change, for example one made to a copy of this
+        collection elsewhere.
+
+        Changes are applied unconditionally, and are idempotent: adding an
+        element that is already there updates it, and updating or removing
+        an element that isn't there does nothing. The change listeners are
+        told about the change, unless it didn't change anything.
+
+        Changes with a sequence number from this collection's sequencer
+        are always told to the change listeners as they are, and give the
+        collection that sequence number as its version, even if they were
+        already made here. Added elements are moved to the end, so the
+        elements are in the order the sequencer added them in.
+        """
+        identifier = change.identifier
+        element = self._elementsByIdentifier.get(identifier)
+        sequenced = self.sequencer is not None and change.sequence is not None
+
+        if change.kind == changes.REMOVED:
+            if element is not None:
+                del self._elementsByIdentifier[identifier]
+                self._unshare()
+                self._elements.remove(element)
+                if not sequenced:
+                    self._notify(changes.REMOVED, identifier)
+        elif element is not None:
+            updated = dict((a, v) for a, v in change.state.iteritems()
+                           if getattr(element, a, _MISSING) != v)
+            for attr, value in updated.iteritems():
+                setattr(element, attr, value)
+            if sequenced and change.kind == changes.ADDED:
+                self._unshare()
+                self._elements.remove(element)
+                self._elements.append(element)
+            elif updated and not sequenced:
+                self._notify(changes.UPDATED, identifier, updated)
+        elif change.kind == changes.ADDED:
+            element = self.createElementFromState(dict(change.state))
+            if not sequenced:
+                self.add(element)
+                return
+            self._elementsByIdentifier[identifier] = element
+            self._elements.append(element)
+
+        if sequenced:
+            self._notify(change.kind, identifier, change.state,
+                         change.sequence)
 
 
     def createElementFromState(self, state):
@@ -121,13 +525,39 @@ class Collection(object):
         try:
             return defer.succeed(self._elementsByIdentifier[identifier])
         except KeyError:
-            return defer.fail(errors.MissingElementError(identifier))
+            return errors.quickFail(errors.MissingElementError(identifier))
 
 
     def query(self, start, stop):
         return defer.succeed(self._elements[start:stop])
 
 
+    def snapshot(self):
+        """
+        Takes a snapshot of the elements in this collection.
+
+        The snapshot keeps the elements that are in the collection now, in
+        the same order, no matter which elements are added or removed
+        later. Those are the same element objects, so updates to them do
+        show up in the snapshot.
+        """
+        self._shared = True
+        return Snapshot(self._elements, len(self._elements), self.version)
+
+
+    def _unshare(self):
+        """
+        Copies the element list before changing it in place, if a snapshot
+        shares it.
+
+        Elements are only ever appended to a shared list, which doesn't
+        change the part of it that the snapshots see.
+        """
+        if self._shared:
+            self._elements = list(self._elements)
+            self._shared = False
+
+
     def add(self, element):
         identifier = getattr(element, element.identifyingAttribute)
 
@@ -137,13 +567,178 @@ class Collection(object):
         self._elementsByIdentifier[identifier] = element
         self._elements.append(element)
 
+        state = None
+        if self._statesWanted:
+            state = element.getCreationState()
+
+        self._notify(changes.ADDED, identifier, state)
+
         return defer.succeed(element)
 
 
+    def count(self, filter=None):
+        """
+        Counts the elements in this collection, or, with a filter, the
+        elements whose attributes are equal to all of the filter's values.
+
+        Without a filter, this doesn't look at the elements. There are no
+        indexes on attribute values, so counting with a filter looks at
+        all of them.
+        """
+        if not filter:
+            return defer.succeed(len(self._elements))
+
+        selected, _ = self._select(filter=filter)
+        return defer.succeed(len(selected))
+
+
     def remove(self, identifier):
         try:
             element = self._elementsByIdentifier.pop(identifier)
+            self._unshare()
             self._elements.remove(element)
-            return defer.succeed(element)
         except KeyError:
-            return defer.fail(errors.MissingElementError(identifier))
+            return errors.quickFail(errors.MissingElementError(identifier))
+
+        self._notify(changes.REMOVED, identifier)
+        return defer.succeed(element)
+
+
+    def updateMany(self, state, identifiers=None, filter=None):
+        """
+        Updates all of the selected elements with the same state.
+
+        The elements are selected in a single pass; see ``_select``. Each
+        element is updated with ``Element.update``; elements that refuse
+        the update with a serializable error don't stop the others from
+        being updated.
+        """
+        selected, missing = self._select(identifiers, filter)
+
+        ds = [defer.maybeDeferred(element.update, state)
+              for _, element in selected]
+        d = defer.DeferredList(ds, consumeErrors=True)
+
+        @d.addCallback
+        def summarize(results):
+            updated, failed = [], {}
+            for (identifier, element), outcome in zip(selected, results):
+                succeeded, result = outcome
+                if succeeded:
+                    updated.append(identifier)
+                    self.elementUpdated(element, state)
+                elif interface.ISerializableError.providedBy(result.value):
+                    failed[identifier] = result.value
+                else:
+                    return result
+
+            return {"updated": updated, "missing": missing, "failed": failed}
+
+        return d
+
+
+    def removeMany(self, identifiers=None, filter=None):
+        """
+        Removes all of the selected elements.
+
+        The elements are selected and removed from the index in one pass,
+        and removed from the element list in a second one, regardless of
+        how many elements are removed.
+        """
+        selected, missing = self._select(identifiers, filter)
+
+        removed = set()
+        for identifier, element in selected:
+            del self._elementsByIdentifier[identifier]
+            removed.add(id(element))
+
+        if removed:
+            self._elements = [e for e in self._elements
+                              if id(e) not in removed]
+            self._shared = False
+
+        removedIdentifiers = [identifier for identifier, _ in selected]
+        for identifier in removedIdentifiers:
+            self._notify(changes.REMOVED, identifier)
+
+        return defer.succeed({"removed": removedIdentifiers,
+                              "missing": missing})
+
+
+    def _select(self, identifiers=None, filter=None):
+        """
+        Selects elements by identifier, by attribute values, or both.
+
+        If identifiers are given, they are looked up in the identifier
+        index, once each, no matter how often they are given. Otherwise,
+        all elements are considered. If a filter is given, only the
+        elements whose attributes are equal to all of the filter's values
+        are selected.
+
+        Returns a list of (identifier, element) pairs and a list of the
+        identifiers that were not found.
+        """
+        missing = []
+        if identifiers is None:
+            candidates = [(getattr(e, e.identifyingAttribute), e)
+                          for e in self._elements]
+        else:
+            candidates, seen = [], set()
+            for identifier in identifiers:
+                if identifier in seen:
+                    continue
+                seen.add(identifier)
+
+                element = self._elementsByIdentifier.get(identifier)
+                if element is None:
+                    missing.append(identifier)
+                else:
+                    candidates.append((identifier, element))
+
+        if not filter:
+            return candidates, missing
+
+        filterItems = filter.items()
+        selected = [(identifier, element)
+                    for identifier, element in candidates
+                    if all(getattr(element, attr, _MISSING) == value
+                           for attr, value in filterItems)]
+        return selected, missing
+
+
+
+def _changedSince(versions, version):
+    """
+    Gets the identifiers in an ordered mapping of identifiers to versions
+    whose version is newer than the given one, oldest first.
+    """
+    identifiers = []
+    for identifier in reversed(versions):
+        if versions[identifier] <= version:
+            break
+        identifiers.append(identifier)
+
+    identifiers.reverse()
+    return identifiers
+
+
+
+class Snapshot(object):
+    """
+    The elements of a collection at some point in time.
+
+    A snapshot can be queried and counted like the collection itself.
+    """
+    def __init__(self, elements, length, version):
+        self._elements = elements
+        self._length = length
+        self.version = version
+
+
+    def query(self, start, stop):
+        stop = min(stop, self._length)
+        return defer.succeed(self._elements[start:stop])
+
+
+    def count(self):
+        return defer.succeed(self._length)
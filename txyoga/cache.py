@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Caching of element lookups.
+"""
+from collections import OrderedDict
+
+from zope.interface import implements
+
+from twisted.internet import defer
+
+from txyoga import errors, interface
+
+
+class CachingCollection(object):
+    """
+    A collection that caches the element lookups of another collection.
+
+    Both elements and misses are cached: elements for ``timeToLive``
+    seconds, misses for ``missingTimeToLive`` seconds. When more than
+    ``maximumSize`` lookups are cached, the least recently used ones are
+    evicted.
+
+    Adding, removing and updating elements through this collection
+    invalidates the affected lookups, and so do the changes the wrapped
+    collection tells its change listeners about (like changes made by
+    other worker processes). Elements that are updated directly are not
+    invalidated otherwise; since the cached element is the element that
+    was updated, that only matters for collections that don't always
+    produce the same object for an element.
+
+    All other attributes are those of the wrapped collection, so this can
+    be used anywhere that collection can.
+
+    @ivar hits: The number of lookups answered from the cache.
+    @ivar misses: The number of lookups passed to the wrapped collection.
+    @ivar evictions: The number of lookups evicted to make room.
+    """
+    implements(interface.ICollection)
+
+    def __init__(self, collection, maximumSize=1000, timeToLive=60,
+                 missingTimeToLive=5, clock=None):
+        self._collection = collection
+        self.maximumSize = maximumSize
+        self.timeToLive = timeToLive
+        self.missingTimeToLive = missingTimeToLive
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self._entries = OrderedDict()
+        self._generation = 0
+
+        self.hits = self.misses = self.evictions = 0
+
+        addChangeListener = getattr(collection, "addChangeListener", None)
+        if addChangeListener is not None:
+            addChangeListener(self._changed, withState=False)
+
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+
+    @property
+    def hitRate(self):
+        """
+        The fraction of lookups answered from the cache.
+        """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+
+    def get(self, identifier):
+        now = self._clock.seconds()
+
+        entry = self._entries.pop(identifier, None)
+        if entry is not None:
+            expires, element = entry
+            if expires > now:
+                self.hits += 1
+                self._entries[identifier] = entry
+                if element is _MISSING:
+                    e = errors.MissingElementError(identifier)
+                    return errors.quickFail(e)
+                return defer.succeed(element)
+
+        self.misses += 1
+        generation = self._generation
+
+        def store(element):
+            if generation == self._generation:
+                self._store(identifier, element, self.timeToLive)
+            return element
+
+        def storeMissing(reason):
+            reason.trap(errors.MissingElementError)
+            if generation == self._generation:
+                self._store(identifier, _MISSING, self.missingTimeToLive)
+            return reason
+
+        d = self._collection.get(identifier)
+        return d.addCallbacks(store, storeMissing)
+
+
+    def _store(self, identifier, element, timeToLive):
+        """
+        Caches a lookup, evicting the least recently used ones if needed.
+        """
+        expires = self._clock.seconds() + timeToLive
+        self._entries[identifier] = expires, element
+
+        while len(self._entries) > self.maximumSize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def invalidate(self, identifiers):
+        """
+        Forgets the cached lookups of some elements.
+
+        Lookups that are in progress while this happens aren't cached.
+        """
+        self._generation += 1
+        for identifier in identifiers:
+            self._entries.pop(identifier, None)
+
+
+    def _changed(self, change):
+        """
+        Forgets the cached lookup of an element that has changed.
+        """
+        self.invalidate([change.identifier])
+
+
+    def createElementFromState(self, state):
+        return self._collection.createElementFromState(state)
+
+
+    def query(self, start, stop):
+        return self._collection.query(start=start, stop=stop)
+
+
+    def add(self, element):
+        identifier = getattr(element, element.identifyingAttribute)
+        self.invalidate([identifier])
+        return self._invalidating(self._collection.add(element), [identifier])
+
+
+    def remove(self, identifier):
+        self.invalidate([identifier])
+        return self._invalidating(self._collection.remove(identifier),
+                                  [identifier])
+
+
+    def updateMany(self, state, identifiers=None, filter=None):
+        if identifiers is not None:
+            self.invalidate(identifiers)
+
+        d = self._collection.updateMany(state, identifiers, filter)
+
+        @d.addCallback
+        def invalidate(result):
+            self.invalidate(result["updated"] + result["failed"].keys())
+            return result
+
+        return self._invalidating(d, identifiers or [])
+
+
+    def removeMany(self, identifiers=None, filter=None):
+        if identifiers is not None:
+            self.invalidate(identifiers)
+
+        d = self._collection.removeMany(identifiers, filter)
+
+        @d.addCallback
+        def invalidate(result):
+            self.invalidate(result["removed"])
+            return result
+
+        return self._invalidating(d, identifiers or [])
+
+
+    def _invalidating(self, d, identifiers):
+        """
+        Forgets the cached lookups of some elements again when an operation
+        on them is done, whether it succeeds or not.
+
+        Lookups made while the operation was in progress may have cached
+        the elements as they were before.
+        """
+        def invalidate(result):
+            self.invalidate(identifiers)
+            return result
+
+        return d.addBoth(invalidate)
+
+
+
+_MISSING = object()
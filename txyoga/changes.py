@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Changes to collections.
+"""
+import collections
+import weakref
+
+from twisted.internet import defer
+
+from txyoga import errors
+
+
+ADDED, UPDATED, REMOVED = "add", "update", "remove"
+
+
+class Change(object):
+    """
+    A change to an element of a collection.
+
+    Added elements come with the state needed to create them again, and
+    updated elements with the new values of their updated attributes.
+    Removed elements have no state.
+
+    Changes told to change listeners by ``base.Collection``, and those
+    recorded in a change log, have a sequence number.
+    """
+    def __init__(self, kind, identifier, state=None, sequence=None):
+        self.kind = kind
+        self.identifier = identifier
+        self.state = state
+        self.sequence = sequence
+
+
+    def __repr__(self):
+        return "<Change %s %r>" % (self.kind, self.identifier)
+
+
+    def toState(self):
+        state = {"type": self.kind,
+                 "identifier": self.identifier,
+                 "state": self.state}
+        if self.sequence is not None:
+            state["sequence"] = self.sequence
+        return state
+
+
+    @classmethod
+    def fromState(cls, state):
+        return cls(state["type"], state["identifier"], state.get("state"),
+                   state.get("sequence"))
+
+
+
+class ChangeLog(object):
+    """
+    The most recent changes to a collection, numbered in sequence.
+
+    At most ``maximumSize`` changes are kept. Changes keep the sequence
+    number they come with, like the versions ``base.Collection`` gives
+    them; others get the one after ``last``, the sequence number of the
+    most recent change. That starts out as the given ``last``.
+    """
+    def __init__(self, maximumSize=1000, last=0):
+        self.maximumSize = maximumSize
+        self.last = last
+        self._oldest = last
+        self._changes = collections.deque(maxlen=maximumSize)
+        self._waiters = []
+
+
+    def record(self, change):
+        """
+        Records a change, and passes it on to everything waiting for one.
+        """
+        sequence = change.sequence
+        if sequence is None:
+            sequence = self.last + 1
+        self.last = sequence
+
+        if len(self._changes) == self.maximumSize:
+            self._oldest = self._changes[0].sequence
+        change = Change(change.kind, change.identifier, change.state,
+                        sequence)
+        self._changes.append(change)
+
+        waiters, self._waiters = self._waiters, []
+        for since, d in waiters:
+            if change.sequence > since:
+                d.callback(self.since(since))
+            else:
+                self._waiters.append((since, d))
+
+
+    def since(self, sequence):
+        """
+        Gets the changes after the one with the given sequence number.
+
+        Raises ``ChangesUnavailableError`` when some of those changes are
+        no longer in the log, and for sequence numbers this log never
+        handed out (like those from before a restart, or from another
+        process that doesn't share the collection's sequencer).
+        """
+        if not self._oldest <= sequence <= self.last:
+            raise errors.ChangesUnavailableError(sequence,
+                                                 self._oldest + 1)
+
+        found = []
+        for change in reversed(self._changes):
+            if change.sequence <= sequence:
+                break
+            found.append(change)
+
+        found.reverse()
+        return found
+
+
+    def wait(self, since):
+        """
+        Waits for changes after the one with the given sequence number.
+
+        Returns a ``Deferred`` that fires with a list of those changes as
+        soon as there are some. Cancelling it stops waiting.
+        """
+        try:
+            available = self.since(since)
+        except errors.ChangesUnavailableError:
+            return defer.fail()
+
+        if available:
+            return defer.succeed(available)
+
+        def cancel(d):
+            self._waiters.remove((since, d))
+
+        d = defer.Deferred(cancel)
+        self._waiters.append((since, d))
+        return d
+
+
+
+_changeLogs = weakref.WeakKeyDictionary()
+
+
+def changeLogFor(collection):
+    """
+    Gets the change log of a collection.
+
+    The change log is created the first time it is asked for, and only
+    has the changes since then, which start after the current version of
+    the collection, if it has one. It lives as long as the collection
+    does.
+    """
+    try:
+        return _changeLogs[collection]
+    except KeyError:
+        last = getattr(collection, "version", 0)
+        log = _changeLogs[collection] = ChangeLog(last=last)
+        collection.addChangeListener(log.record)
+        return log
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Coalescing of concurrent identical operations.
+"""
+import weakref
+
+from twisted.internet import defer
+
+
+class Coalescer(object):
+    """
+    Coalesces concurrent identical operations into a single one.
+
+    While an operation is in flight, identical operations (those with the
+    same key) don't start a new one, but wait for the one in flight. Its
+    result is then passed to every waiter.
+
+    Operations whose result is available immediately are never coalesced,
+    since there is nothing to wait for.
+
+    @ivar calls: The number of operations actually performed.
+    @ivar coalesced: The number of operations that waited for an
+        identical operation instead.
+    """
+    def __init__(self):
+        self._inFlight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+
+    def call(self, key, f, *args, **kwargs):
+        """
+        Performs an operation, unless an identical one is in flight.
+
+        Returns a ``Deferred`` that fires with the operation's result.
+        Cancelling it stops waiting for the operation; once nothing is
+        waiting for the operation anymore, the operation is cancelled.
+        """
+        entry = self._inFlight.get(key)
+        if entry is not None:
+            self.coalesced += 1
+            return self._wait(key, entry)
+
+        self.calls += 1
+        source = defer.maybeDeferred(f, *args, **kwargs)
+        if source.called and not source.paused:
+            return source
+
+        entry = self._inFlight[key] = source, []
+        source.addBoth(self._fanOut, key, source)
+        return self._wait(key, entry)
+
+
+    def _wait(self, key, entry):
+        """
+        Waits for the result of an operation in flight.
+        """
+        source, waiters = entry
+
+        def cancel(d):
+            waiters.remove(d)
+            if not waiters:
+                del self._inFlight[key]
+                source.cancel()
+
+        d = defer.Deferred(cancel)
+        waiters.append(d)
+        return d
+
+
+    def _fanOut(self, result, key, source):
+        """
+        Passes the result of an operation to everything waiting for it.
+        """
+        entry = self._inFlight.get(key)
+        if entry is None or entry[0] is not source:
+            # Everything stopped waiting, and the operation was cancelled
+            return
+
+        del self._inFlight[key]
+        for d in entry[1]:
+            d.callback(result)
+
+
+
+_coalescers = weakref.WeakKeyDictionary()
+
+
+def coalescerFor(obj):
+    """
+    Gets the coalescer for an object, such as a collection.
+
+    The coalescer lives as long as the object does, so operations are
+    coalesced even when different resources wrap the same object.
+    """
+    try:
+        return _coalescers[obj]
+    except KeyError:
+        coalescer = _coalescers[obj] = Coalescer()
+        return coalescer
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Collections that store the state of their elements compactly.
+
+An element object carries an instance dictionary, which is usually much
+larger than the values in it. A ``CompactCollection`` stores every element
+as a ``CompactElement`` instead: a tuple of the element's attribute values
+and its class. Reading the state of an element (which is what most
+requests do) comes straight from that tuple, and the encoded state is
+kept as a pre-encoded record, so that reading the element again doesn't
+even encode it. Only operations that need the element's behavior, like
+updating it or computing attributes with a custom
+``getSerializableAttribute``, construct the element object, and store
+its new state afterwards.
+"""
+import functools
+import inspect
+import operator
+
+from twisted.internet import defer
+from zope.interface import implements
+
+from txyoga import base, interface
+
+
+class CompactElement(object):
+    """
+    The compactly stored state of an element.
+
+    Stands in for an element of a subclass of ``base.Element``: its
+    attributes, ``toState``, ``update`` and ``patch`` all work, but the
+    element object is only constructed when they need it.
+
+    The stored attributes are the element's constructor arguments, its
+    identifying, updatable and exposed attributes and its children (see
+    ``getFields``). Other instance attributes that the constructor
+    doesn't give the element are kept as well, but in a dictionary. Other
+    attributes come from the element's class, or else from the
+    constructed element. Methods of the element that are called through
+    this, store the state of the element they were called on afterwards.
+    """
+    implements(interface.IElement)
+
+    __slots__ = "_cls", "_values", "_extra", "_encoded"
+
+    def __init__(self, cls, values, extra=None):
+        object.__setattr__(self, "_cls", cls)
+        object.__setattr__(self, "_values", values)
+        object.__setattr__(self, "_extra", extra)
+        object.__setattr__(self, "_encoded", None)
+
+
+    @classmethod
+    def fromElement(cls, element):
+        """
+        Stores the state of an element compactly.
+        """
+        elementClass = element.__class__
+        fields, _ = getFields(elementClass)
+        values = tuple(getattr(element, f) for f in fields)
+        extra = _getExtraState(elementClass, values, element)
+        return cls(elementClass, values, extra)
+
+
+    @property
+    def identifyingAttribute(self):
+        return self._cls.identifyingAttribute
+
+
+    def __repr__(self):
+        identifier = getattr(self, self._cls.identifyingAttribute)
+        return "<CompactElement %s %r>" % (self._cls.__name__, identifier)
+
+
+    def __getattr__(self, name):
+        _, indices = getFields(self._cls)
+        index = indices.get(name)
+        if index is not None:
+            return self._values[index]
+
+        if self._extra is not None and name in self._extra:
+            return self._extra[name]
+
+        if name.startswith("__"):
+            # Special lookups, like those of adaptation, aren't the element's
+            raise AttributeError(name)
+
+        attribute = getattr(self._cls, name, _MISSING)
+        if attribute is _MISSING or _isBehavior(attribute):
+            element = self.toElement()
+            value = getattr(element, name)
+            if inspect.ismethod(value) and value.im_self is element:
+                return self._storing(element, value)
+            return value
+        return attribute
+
+
+    def __setattr__(self, name, value):
+        _, indices = getFields(self._cls)
+        if name in indices:
+            values = list(self._values)
+            values[indices[name]] = value
+            object.__setattr__(self, "_values", tuple(values))
+        elif self._extra is not None and name in self._extra:
+            extra = dict(self._extra)
+            extra[name] = value
+            object.__setattr__(self, "_extra", extra)
+        else:
+            raise AttributeError("%s isn't stored" % (name,))
+
+        object.__setattr__(self, "_encoded", None)
+
+
+    def _storing(self, element, method):
+        """
+        Wraps a method of the constructed element, so that the state of
+        the element is stored after it is called, and if it returns a
+        ``Deferred``, again when that fires.
+        """
+        @functools.wraps(method)
+        def storing(*args, **kwargs):
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                self._store(element)
+
+            if isinstance(result, defer.Deferred):
+                result.addBoth(self._stored, element)
+            return result
+
+        return storing
+
+
+    def toElement(self):
+        """
+        Constructs the element.
+
+        The element is constructed with its constructor arguments, and
+        then gets the other stored attributes that are different from
+        those the constructor gave it, and the other kept instance
+        attributes.
+        """
+        element = _construct(self._cls, self._values)
+        if self._extra is not None:
+            element.__dict__.update(self._extra)
+        return element
+
+
+    def _store(self, element):
+        """
+        Stores the state of the constructed element again.
+        """
+        fields, _ = getFields(self._cls)
+        values = tuple(getattr(element, f) for f in fields)
+        extra = _getExtraState(self._cls, values, element)
+        object.__setattr__(self, "_values", values)
+        object.__setattr__(self, "_extra", extra)
+        object.__setattr__(self, "_encoded", None)
+
+
+    def toState(self, attrs=interface.ALL):
+        """
+        Exports the state of the element.
+
+        The state comes straight from the stored attributes, unless the
+        element's class computes attributes itself (with a custom
+        ``getSerializableAttribute`` or ``blockingAttributes``), or some
+        of the requested attributes aren't stored.
+        """
+        if attrs is interface.ALL:
+            attrs = self._cls.exposedAttributes
+
+        getValues = _getValueGetter(self._cls, attrs)
+        if getValues is None:
+            return self.toElement().toState(attrs)
+
+        return dict(zip(attrs, getValues(self._values)))
+
+
+    def getEncodedState(self, encoder):
+        """
+        Gets the state of the element, encoded by ``encoder``.
+
+        The encoded state is kept as a pre-encoded record until the stored
+        state changes, so that reading the element again with the same
+        encoder doesn't encode it again. Returns ``None`` if the state
+        isn't the stored attributes (see ``toState``).
+        """
+        encoded = self._encoded
+        if encoded is not None and encoded[0] is encoder:
+            return encoded[1]
+
+        getValues = _getValueGetter(self._cls, self._cls.exposedAttributes)
+        if getValues is None:
+            return None
+
+        state = dict(zip(self._cls.exposedAttributes, getValues(self._values)))
+        body = encoder(state)
+        object.__setattr__(self, "_encoded", (encoder, body))
+        return body
+
+
+    def getSerializableAttribute(self, name):
+        if _storesState(self._cls):
+            return getattr(self, name)
+        return self.toElement().getSerializableAttribute(name)
+
+
+    def getCreationState(self):
+        return self.toElement().getCreationState()
+
+
+    def update(self, state):
+        """
+        Updates the element, and stores its new state.
+        """
+        element = self.toElement()
+        d = element.update(state)
+        return d.addCallback(self._stored, element)
+
+
+    def patch(self, patch):
+        """
+        Patches the element, and stores its new state.
+        """
+        element = self.toElement()
+        d = element.patch(patch)
+        return d.addCallback(self._stored, element)
+
+
+    def _stored(self, result, element):
+        self._store(element)
+        return result
+
+
+
+_MISSING = object()
+
+
+_fields = {}
+
+
+def getFields(cls):
+    """
+    Gets the names of the attributes stored for elements of a class, and a
+    dictionary of those names to their positions.
+    """
+    try:
+        return _fields[cls]
+    except KeyError:
+        pass
+
+    fields = []
+    for names in [_getConstructorArguments(cls), [cls.identifyingAttribute],
+                  cls.updatableAttributes, cls.exposedAttributes,
+                  cls.children]:
+        fields.extend(n for n in names if n not in fields)
+
+    indices = dict((name, index) for index, name in enumerate(fields))
+    _fields[cls] = fields, indices
+    return fields, indices
+
+
+_valueGetters = {}
+
+
+def _getValueGetter(cls, attrs):
+    """
+    Gets a function that picks the values of some attributes out of the
+    stored values of an element of a class, or ``None`` if their state
+    isn't their stored values.
+    """
+    key = cls, tuple(attrs)
+    try:
+        return _valueGetters[key]
+    except KeyError:
+        pass
+
+    _, indices = getFields(cls)
+    if not _storesState(cls) or not all(a in indices for a in attrs):
+        getter = None
+    else:
+        positions = [indices[a] for a in attrs]
+        if len(positions) == 1:
+            position, = positions
+            getter = lambda values: (values[position],)
+        else:
+            getter = operator.itemgetter(*positions)
+
+    _valueGetters[key] = getter
+    return getter
+
+
+def _construct(cls, values):
+    """
+    Constructs an element of a class with its constructor arguments, and
+    gives it the other stored attributes that are different from those
+    the constructor gave it.
+    """
+    fields, _ = getFields(cls)
+    arguments = _getConstructorArguments(cls)
+
+    values = dict(zip(fields, values))
+    element = cls(**dict((a, values.pop(a)) for a in arguments))
+    for attr, value in values.iteritems():
+        if getattr(element, attr, _MISSING) != value:
+            setattr(element, attr, value)
+
+    return element
+
+
+def _getExtraState(cls, values, element):
+    """
+    Gets the instance attributes of an element that aren't stored, and
+    that its constructor doesn't give it either, or ``None``.
+
+    The element's constructor is only called if the element has instance
+    attributes that aren't stored.
+    """
+    _, indices = getFields(cls)
+    own = dict((a, v) for a, v in vars(element).iteritems()
+               if a not in indices)
+    if not own:
+        return None
+
+    constructed = vars(_construct(cls, values))
+    extra = dict((a, v) for a, v in own.iteritems()
+                 if constructed.get(a, _MISSING) != v)
+    return extra or None
+
+
+def _getConstructorArguments(cls):
+    try:
+        return inspect.getargspec(cls.__init__).args[1:]
+    except TypeError: # No constructor of its own
+        return []
+
+
+def _storesState(cls):
+    """
+    Checks if the state of elements of a class is their stored attributes.
+    """
+    own = cls.getSerializableAttribute.im_func
+    return (own is base.Element.getSerializableAttribute.im_func
+            and not cls.blockingAttributes)
+
+
+def _isBehavior(attribute):
+    """
+    Checks if a class attribute has to be looked up on an element, like a
+    method or a property.
+    """
+    return callable(attribute) or hasattr(attribute, "__get__")
+
+
+
+class CompactCollection(base.Collection):
+    """
+    A collection that stores the state of its elements compactly.
+
+    Elements added to it are stored as ``CompactElement`` objects, which
+    is also what lookups and queries produce.
+    """
+    def add(self, element):
+        if not isinstance(element, CompactElement):
+            element = CompactElement.fromElement(element)
+        return base.Collection.add(self, element)
+
+
+    def createElementFromState(self, state):
+        element = base.Collection.createElementFromState(self, state)
+        return CompactElement.fromElement(element)
@@ -3,8 +3,12 @@
 """
 Serializable REST errors.
 """
+from collections import OrderedDict
+
 from zope.interface import implements
 
+from twisted.internet import defer
+from twisted.python import failure
 from twisted.web import http, resource
 
 from txyoga import interface
@@ -15,17 +19,81 @@ class RESTErrorPage(resource.Resource):
     An alternative to C{ErrorPage} for REST APIs.
 
     Wraps a L{SerializableError}, and produces a pretty serializable form.
+
+    The request's encoder is used if it has one, otherwise the default
+    encoder is. If the error has a ``headers`` dictionary, those headers
+    are set on the response. Encoded errors only depend on their type,
+    message and details, so the ``maxCachedBodies`` most recently used
+    bodies are cached per encoder. Details are small, so encoding them to
+    look up the body still saves encoding the rest of it.
+
+    Error pages are leaves: paths below them get the same error.
     """
-    def __init__(self, exception):
+    isLeaf = True
+
+    maxCachedBodies = 100
+    _cachedBodies = OrderedDict()
+
+    def __init__(self, exception, defaultEncoder=None):
         resource.Resource.__init__(self)
         self.exception = exception
+        self.defaultEncoder = defaultEncoder
+
+
+    def getChild(self, path, request):
+        return self
 
 
     def render(self, request):
-        encoder = request.encoder
+        encoder = getattr(request, "encoder", None) or self.defaultEncoder
+        request.encoder = encoder
         request.setHeader("Content-Type", encoder.contentType)
         request.setResponseCode(self.exception.responseCode)
-        return encoder(self.exception)
+        for name, value in getattr(self.exception, "headers", {}).iteritems():
+            request.setHeader(name, value)
+
+        exception = self.exception
+        details = encoder(exception.details) if exception.details else None
+        key = encoder, exception.__class__, exception.message, details
+        body = self._cachedBodies.pop(key, None)
+        if body is None:
+            body = encoder(exception)
+
+        self._cachedBodies[key] = body
+        if len(self._cachedBodies) > self.maxCachedBodies:
+            self._cachedBodies.popitem(last=False)
+        return body
+
+
+
+class _QuickFailure(failure.Failure):
+    """
+    A failure for an exception that was never raised.
+
+    It has no traceback, so no frames are looked at, and there is no
+    current exception to look for.
+    """
+    def __init__(self, exception):
+        failure.Failure.__init__(self, exception, type(exception), None)
+
+
+
+def firstFailure(reason):
+    """
+    Unwraps the first failure out of a failed ``gatherResults``.
+    """
+    reason.trap(defer.FirstError)
+    return reason.value.subFailure
+
+
+def quickFail(exception):
+    """
+    Like ``defer.fail``, for exceptions that were never raised.
+
+    This is intended for expected errors on hot paths, like missing
+    elements.
+    """
+    return defer.fail(_QuickFailure(exception))
 
 
 
@@ -86,6 +154,105 @@ class UnacceptableRequest(SerializableError):
 
 
 
+class RequestEntityTooLarge(SerializableError):
+    """
+    Raised when the request body is larger than the resource accepts.
+    """
+    responseCode = http.REQUEST_ENTITY_TOO_LARGE
+
+    def __init__(self, maximumBodySize, bodySize):
+        message = "request body too large"
+        details = {"maximumBodySize": maximumBodySize, "bodySize": bodySize}
+        SerializableError.__init__(self, message, details)
+
+
+
+class InternalServerError(SerializableError):
+    """
+    Stands in for an unexpected error, which isn't serializable itself.
+    """
+    responseCode = http.INTERNAL_SERVER_ERROR
+
+    def __init__(self):
+        SerializableError.__init__(self, "internal server error")
+
+
+
+class ServiceUnavailableError(SerializableError):
+    """
+    Raised when a request can't be served right now because the server is
+    too busy.
+    """
+    responseCode = http.SERVICE_UNAVAILABLE
+
+    def __init__(self, retryAfter):
+        message = "service unavailable, retry later"
+        details = {"retryAfter": retryAfter}
+        SerializableError.__init__(self, message, details)
+        self.headers = {"Retry-After": str(retryAfter)}
+
+
+
+class GatewayTimeoutError(SerializableError):
+    """
+    Raised when an operation on a collection took too long.
+    """
+    responseCode = http.GATEWAY_TIMEOUT
+
+    def __init__(self, operation, timeout):
+        message = "operation timed out"
+        details = {"operation": operation, "timeout": timeout}
+        SerializableError.__init__(self, message, details)
+
+
+
+class ChangesUnavailableError(SerializableError):
+    """
+    Raised when changes are requested that are no longer known, for
+    example because they are no longer in the change log.
+
+    The client missed some changes, and has to get the collection again.
+    """
+    responseCode = http.GONE
+
+    def __init__(self, since, oldest):
+        message = "changes are no longer available"
+        details = {"since": since, "oldest": oldest}
+        SerializableError.__init__(self, message, details)
+
+
+
+class SnapshotExpiredError(SerializableError):
+    """
+    Raised when a snapshot is requested that is no longer kept.
+
+    The client has to start over from the first page.
+    """
+    responseCode = http.GONE
+
+    def __init__(self, token):
+        message = "snapshot expired"
+        SerializableError.__init__(self, message, {"snapshot": token})
+
+
+
+class ChangeFeedError(SerializableError):
+    """
+    Raised when a request for changes is malformed.
+    """
+
+
+
+class IncludeError(SerializableError):
+    """
+    Raised when a child that can't be included is requested.
+    """
+    def __init__(self, child):
+        message = "child can't be included"
+        SerializableError.__init__(self, message, {"child": child})
+
+
+
 class PaginationError(SerializableError):
     """
     Raised when there was a problem computing pagination.
@@ -93,6 +260,20 @@ class PaginationError(SerializableError):
 
 
 
+class BulkRequestError(SerializableError):
+    """
+    Raised when a request for a bulk operation is malformed.
+    """
+
+
+
+class PatchError(SerializableError):
+    """
+    Raised when a patch is malformed.
+    """
+
+
+
 class MissingElementError(SerializableError):
     """
     Raised when an element that was expected to exist didn't.
@@ -108,6 +289,18 @@ class MissingElementError(SerializableError):
 
 
 
+class MissingChildError(SerializableError):
+    """
+    Raised when an element doesn't have the requested child.
+    """
+    responseCode = http.NOT_FOUND
+
+    def __init__(self, child):
+        message = "missing child"
+        SerializableError.__init__(self, message, {"child": child})
+
+
+
 UNSPECIFIED = object()
 
 
@@ -171,6 +364,20 @@ class IdentifierError(SerializableError):
 
 
 
+class ReservedIdentifierError(SerializableError):
+    """
+    Raised when an element is added with an identifier that is reserved
+    for something else, like the change feed of its collection.
+    """
+    responseCode = http.FORBIDDEN
+
+    def __init__(self, identifier):
+        message = "reserved identifier"
+        details = {"identifier": identifier}
+        SerializableError.__init__(self, message, details)
+
+
+
 class DuplicateElementError(SerializableError):
     """
     Raised when an element is added to a collection that already has an
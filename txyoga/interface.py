@@ -38,6 +38,30 @@ class ICollection(Interface):
         """
 
 
+    def count(filter=None):
+        """
+        Counts the elements in the collection, or, with a filter, the
+        elements that match it (like for ``updateMany``).
+
+        This is optional, and only meant for collections that can count
+        their elements cheaply.
+
+        Returns a ``Deferred`` that fires with the number of elements.
+        """
+
+
+    def snapshot():
+        """
+        Takes a snapshot of the elements in the collection.
+
+        This is optional. The snapshot has ``query`` and ``count`` methods
+        like those of the collection, and the ``version`` of the
+        collection when it was taken (or ``None``). Queries of the snapshot
+        keep producing the elements that were in the collection when it
+        was taken, in the same order.
+        """
+
+
     def add(element):
         """
         Adds the element to the collection.
@@ -54,6 +78,49 @@ class ICollection(Interface):
         """
 
 
+    def updateMany(state, identifiers=None, filter=None):
+        """
+        Updates many elements in the collection with the same state.
+
+        Elements are selected by their identifiers, by a filter (a mapping
+        of attribute names to the values the selected elements must have),
+        or both. If neither is given, all elements are updated.
+
+        Returns a ``Deferred`` that fires with a dictionary with the
+        identifiers of the elements that were ``updated``, the requested
+        identifiers that were ``missing``, and a dictionary of identifiers
+        to the serializable errors of the elements that ``failed`` to
+        update.
+        """
+
+
+    def removeMany(identifiers=None, filter=None):
+        """
+        Removes many elements from the collection.
+
+        Elements are selected like they are for ``updateMany``.
+
+        Returns a ``Deferred`` that fires with a dictionary with the
+        identifiers of the elements that were ``removed`` and of those
+        that were ``missing``.
+        """
+
+
+    def changedSince(version):
+        """
+        Gets what changed in the collection after a version of it.
+
+        This is optional; collections that have it also have a ``version``
+        attribute, the current version of the collection.
+
+        Returns a ``Deferred`` that fires with a dictionary with the
+        elements that were added or ``changed``, the identifiers of the
+        elements that were ``removed``, and the current ``version``. Fails
+        with ``ChangesUnavailableError`` when those changes are no longer
+        known.
+        """
+
+
 
 ALL = object()
 
@@ -81,7 +148,9 @@ class IElement(Interface):
         """
         Export the state of this object.
 
-        Returns a ``Deferred`` that will fire with the state of this object.
+        Returns the state of this object, or a ``Deferred`` that will fire
+        with it (for example, when some attributes can only be computed by
+        blocking).
         """
     
 
@@ -93,6 +162,24 @@ class IElement(Interface):
         """
 
 
+    def update(state):
+        """
+        Updates this object with the given (partial) state.
+
+        Returns a ``Deferred`` that will fire when the object has been
+        updated.
+        """
+
+
+    def patch(patch):
+        """
+        Applies a JSON merge patch to this object.
+
+        Returns a ``Deferred`` that will fire with the attributes that
+        changed, and their new values, when the object has been updated.
+        """
+
+
 
 class ISerializableError(Interface):
     """
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Monitoring reactor lag.
+
+Everything a reactor does runs one thing at a time, so an operation that
+takes long (like encoding a large page, creating many elements or
+removing one from a large collection) delays every other connection. A
+``LagMonitor`` schedules a call every ``interval`` seconds, and measures
+how late the reactor runs it. When that lag is at least the
+``threshold``, the reactor stalled.
+
+Resources with a ``lagMonitor`` tell it about the operations they run on
+behalf of requests: rendering, the operations of their collection,
+exporting the states of elements and encoding. Stalls are attributed to
+the operation that ran longest (not counting the operations it ran in
+turn) since the previous call. Since there is only one reactor, the
+monitor is usually set on ``serializers.EncodingResource``, so that all
+resources use it.
+"""
+import collections
+
+from twisted.python import log
+
+
+class Operation(object):
+    """
+    Something done on behalf of a request, like ``"render"``,
+    ``"toState"``, ``"encoding"`` or an operation of a collection.
+
+    It has the names of the classes of the resource and collection
+    involved, not the objects themselves, so that stalls don't keep them
+    alive.
+    """
+    def __init__(self, name, resource, method, collection=None,
+                 elements=None):
+        self.name = name
+        self.resource = resource.__class__.__name__
+        self.method = method
+        self.collection = None
+        if collection is not None:
+            self.collection = collection.__class__.__name__
+        self.elements = elements
+
+
+    def __str__(self):
+        description = self.name
+        if self.elements is not None:
+            description += " of %d elements" % (self.elements,)
+        if self.collection is not None:
+            description += " of %s" % (self.collection,)
+        return description + " for %s on %s" % (self.method, self.resource)
+
+
+
+class Stall(object):
+    """
+    A time the reactor stalled.
+
+    @ivar lag: How late the reactor was, in seconds.
+    @ivar operation: The ``Operation`` that ran longest before, or
+        ``None`` if none ran.
+    @ivar duration: How long that operation ran, in seconds.
+    """
+    def __init__(self, lag, operation, duration):
+        self.lag = lag
+        self.operation = operation
+        self.duration = duration
+
+
+    def __str__(self):
+        if self.operation is None:
+            culprit = "no monitored operation"
+        else:
+            culprit = "%s, which took %.3fs" % (self.operation, self.duration)
+        return "Reactor stalled for %.3fs: %s" % (self.lag, culprit)
+
+
+
+class LagMonitor(object):
+    """
+    Measures reactor lag, and attributes stalls to operations.
+
+    Stalls are logged, and the last ``maximumRecentStalls`` are kept.
+
+    @ivar lastLag: The most recently measured lag, in seconds.
+    @ivar maximumLag: The largest lag measured so far, in seconds.
+    @ivar stalls: The number of stalls so far.
+    @ivar recentStalls: The most recent ``Stall``s, oldest first.
+    """
+    maximumRecentStalls = 100
+
+    def __init__(self, interval=0.1, threshold=0.05, clock=None):
+        self.interval = interval
+        self.threshold = threshold
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self.lastLag = 0.0
+        self.maximumLag = 0.0
+        self.stalls = 0
+        self.recentStalls = collections.deque(
+            maxlen=self.maximumRecentStalls)
+
+        self._call = None
+        self._expected = None
+        self._running = []
+        self._longest = None
+
+
+    def start(self):
+        """
+        Starts measuring reactor lag.
+        """
+        self._schedule()
+
+
+    def stop(self):
+        """
+        Stops measuring reactor lag.
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+
+    def _schedule(self):
+        self._expected = self._clock.seconds() + self.interval
+        self._call = self._clock.callLater(self.interval, self._measure)
+
+
+    def _measure(self):
+        lag = max(0.0, self._clock.seconds() - self._expected)
+        self.lastLag = lag
+        self.maximumLag = max(self.maximumLag, lag)
+
+        if lag >= self.threshold:
+            operation, duration = self._longest or (None, 0.0)
+            self._stalled(Stall(lag, operation, duration))
+
+        self._longest = None
+        self._schedule()
+
+
+    def _stalled(self, stall):
+        self.stalls += 1
+        self.recentStalls.append(stall)
+        log.msg(str(stall))
+
+
+    def running(self, operation, f, *args, **kwargs):
+        """
+        Runs an operation, by calling a function.
+
+        The time it takes, minus the time of the operations it runs in
+        turn, is what it is held accountable for.
+        """
+        frame = [self._clock.seconds(), 0.0]
+        self._running.append(frame)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self._running.pop()
+            started, nested = frame
+            duration = self._clock.seconds() - started
+            if self._running:
+                self._running[-1][1] += duration
+
+            own = duration - nested
+            if self._longest is None or own > self._longest[1]:
+                self._longest = operation, own
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Offloading work that would hold up the reactor thread.
+
+Encoding a large page or decoding a large request body holds the reactor
+thread for as long as it takes, and threads don't help because of the
+GIL. A ``ProcessPool`` does that work in local worker processes instead,
+so the reactor can keep serving other requests in the meantime.
+
+Work that blocks on I/O, on the other hand, is done in a thread pool; see
+``getThreadPool``.
+"""
+import cPickle as pickle
+import marshal
+from StringIO import StringIO
+
+from twisted.internet import defer
+from twisted.python import failure, threadpool
+
+from txyoga import errors
+
+
+class ProcessPool(object):
+    """
+    A pool of local worker processes.
+
+    The worker processes are forked from this process when the pool is
+    started, so ``start`` has to be called before the reactor runs: a
+    process forked from a running reactor would inherit its threads'
+    locks and its connections in whatever state they were in. Codecs
+    have to be picklable; module-level functions, like the codecs txyoga
+    comes with, are.
+
+    Calls that take longer than ``timeout`` seconds fail, unless it is
+    ``None``.
+    """
+    def __init__(self, processes=None, reactor=None, timeout=60):
+        self.processes = processes
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.timeout = timeout
+        self._pool = None
+
+
+    def start(self):
+        """
+        Starts the worker processes.
+
+        Raises ``RuntimeError`` when the reactor is already running.
+        """
+        if getattr(self._reactor, "running", False):
+            raise RuntimeError("process pools have to be started before "
+                               "the reactor runs")
+        if self._pool is None:
+            import multiprocessing
+            self._pool = multiprocessing.Pool(self.processes)
+
+
+    def call(self, f, *args):
+        """
+        Calls a function in a worker process.
+
+        Returns a ``Deferred`` that fires with the result of the call, or
+        fails with the exception it raised. Functions and arguments that
+        can't be passed to a worker process fail right away, and so do
+        all calls while the pool isn't started.
+
+        The pools of Python 2 have no error callback, and never deliver
+        the results of calls whose worker process died. Everything that
+        can fail is therefore caught in the worker process, and reported
+        as its result; calls that still don't return fail with
+        ``GatewayTimeoutError`` after the ``timeout``.
+        """
+        if self._pool is None:
+            return defer.fail(RuntimeError("process pool isn't started"))
+
+        try:
+            task = pickle.dumps(f, pickle.HIGHEST_PROTOCOL), _dumps(args)
+        except Exception:
+            return defer.fail()
+
+        d = defer.Deferred()
+        if self.timeout is not None:
+            name = getattr(f, "__name__", repr(f))
+            timer = self._reactor.callLater(self.timeout, _timeOut, d, name,
+                                            self.timeout)
+            d.addBoth(_stopTimer, timer)
+
+        def deliver(data):
+            # Called in the pool's result handler thread
+            self._reactor.callFromThread(_fire, d, data)
+
+        self._pool.apply_async(_capture, task, callback=deliver)
+        return d
+
+
+    def encode(self, encoder, obj):
+        """
+        Encodes an object in a worker process.
+        """
+        return self.call(encoder, obj)
+
+
+    def decode(self, decoder, body):
+        """
+        Decodes a request body, given as a string, in a worker process.
+        """
+        return self.call(_decode, decoder, body)
+
+
+    def close(self):
+        """
+        Stops the worker processes, once they have done the work they
+        were given.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+
+maximumThreads = 10
+_threadPool = None
+
+
+def getThreadPool():
+    """
+    Gets the thread pool for blocking work.
+
+    The pool has at most ``maximumThreads`` threads. It is started when
+    it is first asked for, and stopped when the reactor shuts down.
+    """
+    global _threadPool
+    if _threadPool is None:
+        from twisted.internet import reactor
+        _threadPool = threadpool.ThreadPool(0, maximumThreads, "txyoga")
+        _threadPool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", _threadPool.stop)
+    return _threadPool
+
+
+
+def _decode(decoder, body):
+    return decoder(StringIO(body))
+
+
+def _capture(f, args):
+    """
+    Calls a pickled function in a worker process, and serializes the
+    outcome.
+
+    The outcome is serialized here, so that results and exceptions that
+    can't be serialized are reported instead of getting lost. Exceptions
+    that would stop the worker process, like ``SystemExit``, are reported
+    too.
+    """
+    try:
+        f = pickle.loads(f)
+        outcome = True, f(*_loads(args))
+    except BaseException, e:
+        outcome = False, e
+
+    try:
+        return _dumps(outcome)
+    except Exception, e:
+        error = pickle.PicklingError("unable to pickle %r: %s" % (f, e))
+        return _dumps((False, error))
+
+
+def _dumps(obj):
+    """
+    Serializes an object to pass it to or from a worker process.
+
+    States made of builtin types, like decoded bodies and pages, are much
+    faster to marshal than to pickle; anything else is pickled.
+    """
+    try:
+        return "m" + marshal.dumps(obj)
+    except ValueError:
+        return "p" + pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(data):
+    if data[0] == "m":
+        return marshal.loads(data[1:])
+    return pickle.loads(data[1:])
+
+
+def _fire(d, data):
+    if d.called:
+        # The call timed out already
+        return
+
+    succeeded, result = _loads(data)
+    if succeeded:
+        d.callback(result)
+    else:
+        d.errback(failure.Failure(result))
+
+
+def _timeOut(d, name, timeout):
+    d.errback(errors.GatewayTimeoutError(name, timeout))
+
+
+def _stopTimer(result, timer):
+    if timer.active():
+        timer.cancel()
+    return result
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Profiling a sample of requests.
+
+Give a resource a ``Profiler`` as its ``profiler`` (or give it to all
+resources, by setting it on ``serializers.EncodingResource``), and it
+profiles a sample of the requests it renders, from when rendering starts
+until the request is finished. That includes the callbacks of the
+``Deferred`` chain that produces the response, whenever they run.
+
+Profiles are aggregated per resource class and request method, and written
+to a directory for offline analysis:
+
+    - ``<key>.pstats``, for ``pstats`` (or tools like SnakeViz),
+    - ``<key>.folded``, stack samples in the folded format that
+      ``flamegraph.pl`` and speedscope read.
+
+Only one request is profiled at a time. While it is, the reactor may also
+run code for other requests, which then shows up in its profile too.
+"""
+import cProfile
+import collections
+import hmac
+import marshal
+import os
+import pstats
+import random
+import signal
+
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.web import server
+
+
+class Profiler(object):
+    """
+    Profiles a sample of requests.
+
+    A request is profiled when it has the ``header`` with the ``secret``
+    as its value, or otherwise with a probability of ``sampleRate``, if it
+    is for one of the ``resourceClasses`` and its path starts with one of
+    the ``pathPrefixes`` (when those are given).
+
+    While a request is profiled, its stack is sampled every
+    ``sampleInterval`` seconds of CPU time. Profiling stops after
+    ``maximumDuration`` seconds, even if the request isn't finished yet,
+    so that long polls and event streams (see
+    ``resource.ChangeFeedResource``) don't keep every other request from
+    being profiled, and don't slow the reactor down, for as long as they
+    are open.
+
+    Profiles are written in the ``threadPool``, or the shared thread pool
+    (see ``offload.getThreadPool``) if that's ``None``.
+    """
+    header = "X-Profile"
+    sampleInterval = 0.001
+    maximumDuration = 10
+    threadPool = None
+
+    def __init__(self, directory, sampleRate=0.01, resourceClasses=(),
+                 pathPrefixes=(), secret=None, random=random.random,
+                 clock=None):
+        self.directory = directory
+        self.sampleRate = sampleRate
+        self.resourceClasses = tuple(resourceClasses)
+        self.pathPrefixes = tuple(pathPrefixes)
+        self.secret = secret
+        self._random = random
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+        self._profiling = False
+        self._stats = {}
+        self._stacks = {}
+        self._written = defer.succeed(None)
+
+
+    def shouldProfile(self, resource, request):
+        """
+        Checks if a request for a resource should be profiled.
+        """
+        if self._profiling:
+            return False
+
+        if self.secret is not None:
+            value = request.getHeader(self.header)
+            if value is not None and _compareDigest(value, self.secret):
+                return True
+
+        if self.resourceClasses:
+            if not isinstance(resource, self.resourceClasses):
+                return False
+
+        if self.pathPrefixes:
+            if not request.path.startswith(self.pathPrefixes):
+                return False
+
+        return self._random() < self.sampleRate
+
+
+    def profile(self, resource, request, render):
+        """
+        Profiles rendering a request, until it is finished or for at most
+        ``maximumDuration`` seconds.
+
+        ``render`` is called without arguments to render the request.
+        """
+        key = "%s.%s" % (resource.__class__.__name__, request.method)
+        profile = cProfile.Profile()
+        sampler = _StackSampler(self.sampleInterval)
+
+        self._profiling = True
+        sampler.start()
+        profile.enable()
+        try:
+            result = render()
+        except:
+            self._stop(key, profile, sampler)
+            raise
+
+        if result is not server.NOT_DONE_YET:
+            self._stop(key, profile, sampler)
+            return result
+
+        timer = self._clock.callLater(self.maximumDuration, self._stop,
+                                      key, profile, sampler)
+
+        def finished(_):
+            if timer.active():
+                timer.cancel()
+                self._stop(key, profile, sampler)
+
+        request.notifyFinish().addBoth(finished)
+        return result
+
+
+    def _stop(self, key, profile, sampler):
+        profile.disable()
+        sampler.stop()
+        self._profiling = False
+        self._record(key, profile, sampler.stacks)
+
+
+    def _record(self, key, profile, stacks):
+        """
+        Adds a profile to the aggregated profiles, and writes them in the
+        thread pool.
+
+        Writes happen one after the other, so that the files end up with
+        the latest profiles.
+        """
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+
+        allStacks = self._stacks.setdefault(key, collections.Counter())
+        allStacks.update(stacks)
+
+        path = os.path.join(self.directory, key)
+        pstatsData = marshal.dumps(stats.stats) # What dump_stats writes
+        foldedData = "".join("%s %d\n" % (stack, count)
+                             for stack, count in allStacks.iteritems())
+
+        def write(_):
+            from twisted.internet import reactor
+            from txyoga import offload
+            pool = self.threadPool or offload.getThreadPool()
+            return threads.deferToThreadPool(reactor, pool, _write,
+                                             path, pstatsData, foldedData)
+
+        self._written.addCallback(write)
+        self._written.addErrback(log.err,
+                                 "Couldn't write the profile of %s" % (key,))
+
+
+
+def _write(path, pstatsData, foldedData):
+    with open(path + ".pstats", "wb") as f:
+        f.write(pstatsData)
+    with open(path + ".folded", "w") as f:
+        f.write(foldedData)
+
+
+
+def _compareInConstantTime(a, b):
+    """
+    Compares two strings in a time that doesn't depend on where they
+    differ, like ``hmac.compare_digest``, which Python only has since 2.7.7.
+    """
+    if len(a) != len(b):
+        return False
+
+    difference = 0
+    for x, y in zip(a, b):
+        difference |= ord(x) ^ ord(y)
+    return difference == 0
+
+
+_compareDigest = getattr(hmac, "compare_digest", _compareInConstantTime)
+
+
+
+class _StackSampler(object):
+    """
+    Samples the stack of the main thread at regular intervals of CPU time.
+
+    Sampling needs ``SIGPROF``, so it only works on the main thread of
+    platforms that have it; elsewhere, there are no samples.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._previousHandler = None
+        self._started = False
+
+
+    def start(self):
+        if not hasattr(signal, "setitimer"):
+            return
+
+        try:
+            previous = signal.signal(signal.SIGPROF, self._sample)
+        except ValueError: # Not the main thread
+            return
+
+        self._previousHandler = previous
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self._started = True
+
+
+    def stop(self):
+        if not self._started:
+            return
+
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._previousHandler)
+        self._started = False
+
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("%s (%s:%d)" % (code.co_name, code.co_filename,
+                                         code.co_firstlineno))
+            frame = frame.f_back
+
+        names.reverse()
+        self.stacks[";".join(names)] += 1
@@ -6,12 +6,15 @@ Resources providing the REST API to some objects.
 import functools
 import urllib
 import urlparse
+import weakref
+from collections import Hashable, OrderedDict
 
-from twisted.internet import defer
-from twisted.python import log
+from twisted.internet import defer, task
+from twisted.python import failure, log
 from twisted.web import http, resource, server
 
-from txyoga import errors, interface, serializers
+from txyoga import changes, coalescing, errors, interface, serializers
+from txyoga import lag, slowlog, snapshots, tracing
 
 
 class Created(resource.Resource):
@@ -34,39 +37,201 @@ class Deleted(resource.Resource):
 
 
 def deferredRenderWithErrorReporting(method):
-    def decorated(self, request):
+    """
+    Renders with a method that may return a deferred body, and reports its
+    errors.
+
+    If the resource has a ``profiler`` (see ``txyoga.profiling``), it
+    gets to profile the request. If it has a ``slowRequestLog`` (see
+    ``txyoga.slowlog``) or a ``tracer`` (see ``txyoga.tracing``), the
+    request is timed or traced, if it isn't already. If it has a
+    ``lagMonitor`` (see ``txyoga.lag``), rendering is monitored. Requests
+    for resources without any of those, that aren't timed or traced
+    already, are just rendered.
+    """
+    def render(self, request):
         d = defer.maybeDeferred(method, self, request)
         d.addErrback(_reportError, request, self.defaultEncoder)
         d.addCallback(_finish, request)
         return server.NOT_DONE_YET
 
+    def profiled(self, request):
+        profiler = self.profiler
+        if profiler is not None and profiler.shouldProfile(self, request):
+            return profiler.profile(self, request,
+                                    lambda: render(self, request))
+        return render(self, request)
+
+    def instrumented(self, request):
+        _instrument(self, request)
+        slowlog.timingsFor(request).renderedBy(self)
+        tracing.spanFor(request).setAttribute("txyoga.resource",
+                                              self.__class__.__name__)
+
+        monitor = self.lagMonitor
+        if monitor is not None:
+            operation = lag.Operation("render", self, request.method,
+                                      _collectionOf(self))
+            return monitor.running(operation, profiled, self, request)
+        return profiled(self, request)
+
+    def decorated(self, request):
+        if _instrumented(self) or _isObserved(request):
+            return instrumented(self, request)
+        return render(self, request)
+
+    return decorated
+
+
+def admitted(method):
+    """
+    Waits for the collection's admission control, if any, to admit the
+    request before calling the decorated method.
+
+    The request is the last positional argument of the decorated method.
+    """
+    @functools.wraps(method)
+    def decorated(self, *args):
+        control = getattr(self._collection, "admissionControl", None)
+        if control is None:
+            return method(self, *args)
+
+        d = control.admit(args[-1])
+        return d.addCallback(lambda _: method(self, *args))
+
     return decorated
 
 
 def _reportError(reason, request, defaultEncoder):
-    if not interface.ISerializableError.providedBy(reason.value):
+    """
+    Reports an error to the client.
+
+    Unexpected errors are logged, and reported as an
+    ``InternalServerError``, without their details.
+    """
+    if reason.check(defer.CancelledError) and _isGone(request):
+        # The request was finished while its operation was in progress.
+        return server.NOT_DONE_YET
+
+    error = reason.value
+    if not interface.ISerializableError.providedBy(error):
         log.err(reason)
-        return
+        error = errors.InternalServerError()
 
-    request.encoder = getattr(request, "encoder", defaultEncoder)
-    resource = errors.RESTErrorPage(reason.value)
+    resource = errors.RESTErrorPage(error, defaultEncoder)
     return resource.render(request)
 
 
+def _isGone(request):
+    """
+    Checks if a request was finished already, or its client went away.
+    """
+    return bool(request.finished or request._disconnected)
+
+
 def _finish(body, request):
     if body is server.NOT_DONE_YET:
         return
 
-    request.write(body)
+    if body is not None:
+        slowlog.timingsFor(request).annotate(bytes=len(body))
+        tracing.wrap(request, "write", request.write)(body)
     request.finish()
 
 
+_instruments = "profiler", "slowRequestLog", "lagMonitor", "tracer"
+
+
+def _instrument(resource, request):
+    """
+    Starts timing and tracing a request, if the resource has a
+    ``slowRequestLog`` or a ``tracer``, and they haven't started yet.
+    """
+    if resource.slowRequestLog is not None:
+        resource.slowRequestLog.start(resource, request)
+    if resource.tracer is not None:
+        resource.tracer.start(resource, request)
+
+
+def _measure(resource, request, phase, elements, f, *args):
+    """
+    Runs a phase of a request that runs synchronously, like exporting the
+    states of some elements or encoding.
+
+    The phase is timed and traced if the request is (see
+    ``txyoga.slowlog`` and ``txyoga.tracing``), and the resource's
+    ``lagMonitor``, if any, is told about it.
+    """
+    monitor = resource.lagMonitor
+    if monitor is None and not _isObserved(request):
+        return f(*args)
+
+    if monitor is not None:
+        operation = lag.Operation(phase, resource, request.method,
+                                  _collectionOf(resource), elements)
+        args = (operation, f) + args
+        f = monitor.running
+
+    attributes = None
+    if elements is not None:
+        attributes = {"txyoga.elements": elements}
+    f = tracing.wrap(request, phase, f, attributes)
+
+    return slowlog.timingsFor(request).measure(phase, f, *args)
+
+
+def _instrumented(resource):
+    """
+    Checks if a resource has any instrumentation, like a ``tracer``.
+    """
+    for name in _instruments:
+        if getattr(resource, name) is not None:
+            return True
+    return False
+
+
+def _isObserved(request):
+    """
+    Checks if a request is timed or traced.
+    """
+    return (slowlog.getAttached(request, "timings") is not None
+            or slowlog.getAttached(request, "span") is not None)
+
+
+def _collectionOf(resource):
+    """
+    Gets the collection a resource is for, or ``None``.
+    """
+    collection = getattr(resource, "_collection", None)
+    if collection is None:
+        collection = getattr(resource, "collection", None)
+    return collection
+
+
 def _renderResource(resource, request):
     return resource.render(request)
 
 
+def _getClock(clock):
+    if clock is None:
+        from twisted.internet import reactor
+        return reactor
+    return clock
+
+
 
 class DeferredResource(object):
+    """
+    A resource that isn't available yet.
+
+    It has the same instrumentation, like a ``profiler``, as the resource
+    it was returned by.
+    """
+    profiler = None
+    slowRequestLog = None
+    lagMonitor = None
+    tracer = None
+
     def __init__(self, deferred, defaultEncoder):
         self.deferred = deferred
         self.defaultEncoder = defaultEncoder
@@ -83,58 +248,398 @@ class DeferredResource(object):
 
     @deferredRenderWithErrorReporting
     def render(self, request):
-        self.deferred.addCallback(_renderResource, request)
-        self.deferred.addCallback(_finish, request)
-        return self.deferred
+        return self.deferred.addCallback(_renderResource, request)
 
 
     @classmethod
     def returning(cls, method):
         """
         A decorator for methods that return a deferred Resource.
+
+        If the method returns a resource, or a deferred that has already
+        fired successfully, that resource is returned directly. Deferreds
+        that have already failed with a serializable error produce the
+        matching error page directly. Only results that aren't available
+        yet (or other failures) are wrapped in a ``DeferredResource``.
+
+        The request is the last positional argument of the method. If the
+        resource has a ``slowRequestLog`` or a ``tracer``, the request is
+        timed or traced from here.
         """
         @functools.wraps(method)
         def decorated(self, *args, **kwargs):
-            deferred = defer.maybeDeferred(method, self, *args, **kwargs)
-            return cls(deferred, self.defaultEncoder)
+            request = args[-1]
+            _instrument(self, request)
+
+            def wrap(d):
+                deferred = cls(d, self.defaultEncoder)
+                for name in _instruments:
+                    setattr(deferred, name, getattr(self, name))
+                return deferred
+
+            try:
+                traced = tracing.wrap(request, method.__name__, method)
+                result = traced(self, *args, **kwargs)
+            except:
+                return wrap(defer.fail())
+
+            if not isinstance(result, defer.Deferred):
+                return result
+            elif _hasSucceeded(result):
+                return result.result
+            elif _hasSerializableFailure(result):
+                page = errors.RESTErrorPage(result.result.value,
+                                            self.defaultEncoder)
+                result.addErrback(_ignore)
+                return page
+
+            return wrap(result)
         return decorated
 
 
 
+def _hasSucceeded(d):
+    """
+    Checks if a deferred has already fired with a result that isn't a
+    failure or another deferred.
+    """
+    if not d.called or d.paused:
+        return False
+
+    return not isinstance(d.result, (failure.Failure, defer.Deferred))
+
+
+def _hasSerializableFailure(d):
+    """
+    Checks if a deferred has already failed with a serializable error.
+    """
+    if not d.called or d.paused or not isinstance(d.result, failure.Failure):
+        return False
+
+    return interface.ISerializableError.providedBy(d.result.value)
+
+
+def _ignore(_):
+    pass
+
+
+
+_readMethods = frozenset(["GET", "HEAD"])
+_coalesced = frozenset(["get", "query", "count", "changedSince"])
+
+
+def _cancelling(d, request, operation, timeout, clock):
+    """
+    Cancels an operation when it times out or its request is finished.
+
+    Operations that time out fail with ``GatewayTimeoutError``.
+    """
+    timedOut = []
+    if timeout is not None:
+        def expire():
+            timedOut.append(True)
+            d.cancel()
+        delayedCall = clock.callLater(timeout, expire)
+
+        def stopTimer(result):
+            if delayedCall.active():
+                delayedCall.cancel()
+            return result
+        d.addBoth(stopTimer)
+
+    request.notifyFinish().addBoth(lambda _: d.cancel())
+
+    def reportTimeout(reason):
+        if timedOut:
+            reason.trap(defer.CancelledError)
+            raise errors.GatewayTimeoutError(operation, timeout)
+        return reason
+
+    return d.addErrback(reportTimeout)
+
+
+
 class CollectionResource(serializers.EncodingResource):
     """
     A resource representing a REST collection.
+
+    If the collection has an ``admissionControl``, requests for the
+    collection and its elements have to be admitted by it first.
+
+    Operations on the collection can have timeouts, as a dictionary of
+    operation names (like ``"get"`` or ``"query"``) to seconds. If the
+    resource has no ``operationTimeouts``, those of the collection are
+    used. Operations that time out fail with ``GatewayTimeoutError``.
+
+    With a ``processPool``, pages of at least ``minimumOffloadedPageSize``
+    elements are encoded by it, like large request bodies are decoded.
+    Passing a page to a worker process costs more than encoding a page of
+    the usual size, so by default only pages far larger than the default
+    ``maxPageSize`` are.
+
+    If the collection has change listeners, the changes to it are
+    available from the ``ChangeFeedResource`` child named
+    ``changeFeedName``, which elements can't be added with as their
+    identifier.
+
+    The resources of recently requested elements are kept, so that deep
+    paths through elements and their children don't make new resources
+    for every request. The routes of the ``maximumCachedRoutes`` most
+    recently read paths below this resource are kept too, so that those
+    paths are resolved in one step (see ``getChildWithDefault``).
     """
+    operationTimeouts = None
+    clock = None
+
+    changeFeedName = "_changes"
+
+    maximumCachedResources = 1000
+    maximumCachedRoutes = 1000
+
+    minimumOffloadedPageSize = 1000
+
     def __init__(self, collection):
         serializers.EncodingResource.__init__(self)
         self._collection = collection
+        self._elementResources = OrderedDict()
+        self._routes = OrderedDict()
+
+        if hasattr(collection, "addChangeListener"):
+            _forgetRemovedElements(collection, self)
+            feed = ChangeFeedResource(collection)
+            self.putChild(self.changeFeedName, feed)
+
+
+    def getChildWithDefault(self, path, request):
+        """
+        Gets the resource for a path below this one.
+
+        Reading requests for a path that was read recently are resolved in
+        one step, instead of one segment at a time, as long as its route is
+        still current: every element along it has to be the same version
+        in its collection, and every child the same object (see
+        ``_Route``). Routes are only kept for paths that resolve without
+        waiting, through collections that keep track of the versions of
+        their elements and have no admission control, and through
+        resources without instrumentation.
+        """
+        if (path in self.children or request.method not in _readMethods
+                or _instrumented(self)):
+            return serializers.EncodingResource.getChildWithDefault(
+                self, path, request)
+
+        key = (path,) + tuple(request.postpath)
+        route = self._routes.pop(key, None)
+        if route is None or not route.isCurrent():
+            return self._resolve(key, path, request)
+
+        self._routes[key] = route
+        request.prepath.extend(request.postpath)
+        del request.postpath[:]
+        return route.resource
+
+
+    def _resolve(self, key, path, request):
+        """
+        Resolves a path one segment at a time, like ``twisted.web`` would,
+        and keeps its route if it can be checked later.
+        """
+        route = _Route()
+        parent = self
+        while True:
+            child = serializers.EncodingResource.getChildWithDefault(
+                parent, path, request)
+            if not route.follow(parent, path, child):
+                return child
+            if not request.postpath:
+                break
+            parent, path = child, request.postpath.pop(0)
+            request.prepath.append(path)
+
+        route.resource = child
+        self._routes[key] = route
+        if len(self._routes) > self.maximumCachedRoutes:
+            self._routes.popitem(last=False)
+        return child
 
 
     @DeferredResource.returning
+    @admitted
     def getChild(self, path, request):
         """
         Gets the resource for an element in the collection for this resource.
 
         If this is a DELETE request addressing an element this collection,
         deletes the child. If this is a PUT request request addressing an
-        element in this collection, creates the element and adds (upserts)
-        it to the collection. Otherwise, attempts to get the child element.
-        If that child could not be found, returns an error.
+        element in this collection that doesn't exist yet, creates the
+        element and adds it to the collection. Otherwise, attempts to get
+        the child element. If that child could not be found, returns an
+        error.
 
         The case for updating an element is not covered in this method: since
         updating is an operation on elements that already exist, that is
         handled by the corresponding ElementResource.
         """
+        slowlog.timingsFor(request).annotate(
+            collection=self._collection.__class__.__name__, identifier=path)
+
         if not request.postpath:
             if request.method == "DELETE":
-                d = self._collection.remove(path)
+                d = self._call(request, "remove", path)
+                d.addCallback(self._forgetElementResource, path)
                 d.addCallback(lambda _: Deleted())
                 return d
 
             elif request.method == "PUT":
-                return self._createElement(request, path)
+                d = self._call(request, "get", path)
+                d.addCallbacks(self._getElementResource, self._createMissing,
+                               errbackArgs=(request, path))
+                return d
+
+        d = self._call(request, "get", path)
+        return d.addCallback(self._getElementResource)
+
+
+    def _getElementResource(self, element):
+        """
+        Gets the resource for an element of this collection.
+
+        The resources of the ``maximumCachedResources`` most recently
+        requested elements are kept, so that requests for the same element
+        (and its children) don't create new resources. A resource is only
+        used again for the very element it was made for.
+        """
+        identifier = getattr(element, element.identifyingAttribute)
+
+        entry = self._elementResources.pop(identifier, None)
+        if entry is None or entry[0] is not element:
+            child = resource.IResource(element)
+            if isinstance(child, ElementResource):
+                child.collection = self._collection
+            entry = element, child
 
-        return self._collection.get(path).addCallback(resource.IResource)
+        self._elementResources[identifier] = entry
+        if len(self._elementResources) > self.maximumCachedResources:
+            self._elementResources.popitem(last=False)
+
+        return entry[1]
+
+
+    def _forgetElementResource(self, result, identifier):
+        """
+        Forgets the resource of an element that was removed.
+
+        Collections with change listeners tell their resources about every
+        removal (see ``_forgetRemovedElements``); for other collections,
+        only removals through this resource are noticed.
+        """
+        self._elementResources.pop(identifier, None)
+        return result
+
+
+    @property
+    def coalescer(self):
+        """
+        The coalescer for read operations on this resource's collection.
+        """
+        return coalescing.coalescerFor(self._collection)
+
+
+    def _call(self, request, operation, *args, **kwargs):
+        """
+        Calls an operation of the collection on behalf of a request.
+
+        Concurrent identical lookups and queries by reading requests are
+        coalesced into one.
+
+        If the operation doesn't finish immediately, it is cancelled when
+        it takes longer than its timeout, or when the request is finished
+        before it is (for example, because the client went away).
+
+        If the resource has a ``lagMonitor``, it is told about the
+        operation. If the request is traced, the operation gets a span.
+        """
+        method = getattr(self._collection, operation)
+
+        monitor = self.lagMonitor
+        if monitor is not None:
+            running = lag.Operation(operation, self, request.method,
+                                    self._collection)
+            method = functools.partial(monitor.running, running, method)
+
+        observed = _isObserved(request)
+        if observed:
+            method = tracing.wrap(request, operation, method)
+
+        if request.method in _readMethods and operation in _coalesced:
+            key = (operation,) + args + tuple(sorted(kwargs.iteritems()))
+            d = self.coalescer.call(key, method, *args, **kwargs)
+        else:
+            d = defer.maybeDeferred(method, *args, **kwargs)
+
+        if d.called and not d.paused:
+            return d
+
+        d = _cancelling(d, request, operation, self._getTimeout(operation),
+                        self._getClock())
+        if observed:
+            slowlog.timingsFor(request).wait(d)
+        return d
+
+
+    @admitted
+    def _getFirstPage(self, url, request):
+        """
+        Gets the first page of the collection, to be embedded in the state
+        of the element it is a child of (see ``_includeChildren``).
+
+        The page is queried like any other, on behalf of the request that
+        includes it.
+        """
+        collection = self._collection
+        pageSize = min(collection.pageSize, collection.maxPageSize)
+        d = self._call(request, "query", start=0, stop=pageSize)
+        page = {"next": None}
+
+        def _buildPage(elements):
+            if len(elements) >= pageSize:
+                query = urllib.urlencode([("start", pageSize),
+                                          ("stop", 2 * pageSize)])
+                page["next"] = url + "?" + query
+
+            attrs = collection.exposedElementAttributes
+            return _exportStates(elements, attrs)
+
+        def _addResults(results):
+            page["results"] = results
+            return page
+
+        return d.addCallback(_buildPage).addCallback(_addResults)
+
+
+    def _getTimeout(self, operation):
+        """
+        Gets the timeout for an operation, in seconds, or ``None``.
+
+        Timeouts configured on the resource take precedence over those
+        configured on the collection.
+        """
+        timeouts = self.operationTimeouts
+        if timeouts is None:
+            timeouts = getattr(self._collection, "operationTimeouts", {})
+        return timeouts.get(operation)
+
+
+    def _getClock(self):
+        return _getClock(self.clock)
+
+
+    def _createMissing(self, reason, request, identifier):
+        """
+        Creates an element that a PUT request addressed, but wasn't found.
+        """
+        reason.trap(errors.MissingElementError)
+        return self._createElement(request, identifier)
 
 
     @serializers.withDecoder
@@ -148,28 +653,77 @@ class CollectionResource(serializers.EncodingResource):
         identifier does not match the identifier of the new element,
         `IdentifierError` is raised.
         """
-        state = request.decoder(request.content)
-        element = self._collection.createElementFromState(state)
+        d = self._decodeBody(request)
+        d.addCallback(self._addElement, request, identifier)
+        return d.addCallback(lambda _: Created())
+
+
+    def _addElement(self, state, request, identifier=None):
+        """
+        Creates an element from its state, and adds it to the collection.
+
+        Elements can't have the name of a child of this resource, like
+        the ``changeFeedName``, as their identifier, since the child would
+        hide them.
+        """
+        element = _measure(self, request, "fromState", 1,
+                           self._collection.createElementFromState, state)
 
-        if identifier is not None:
-            actualIdentifier = getattr(element, element.identifyingAttribute)
-            if actualIdentifier != identifier:
-                e = errors.IdentifierError(identifier, actualIdentifier)
-                return defer.fail(e)
+        actualIdentifier = getattr(element, element.identifyingAttribute)
+        if identifier is not None and actualIdentifier != identifier:
+            raise errors.IdentifierError(identifier, actualIdentifier)
+        if actualIdentifier in self.children:
+            raise errors.ReservedIdentifierError(actualIdentifier)
 
-        return self._collection.add(element).addCallback(lambda _: Created())
+        return self._call(request, "add", element)
+
+
+    @serializers.withDecoder
+    def _createElements(self, request):
+        """
+        Creates one or more elements.
+
+        If the decoder supports incremental decoding and the request body
+        is an array, each item is decoded and added in turn, cooperating
+        with the reactor between elements. Bodies that are decoded by the
+        process pool are decoded at once, and then added in the same way.
+        Otherwise, this behaves like ``_createElement``.
+        """
+        iterDecode = getattr(request.decoder, "iterDecode", None)
+        if self._offloadsDecoding(request):
+            d = self._decodeBody(request).addCallback(_asList)
+            d.addCallback(self._addElements, request)
+        elif iterDecode is not None:
+            d = self._addElements(iterDecode(request.content), request)
+        else:
+            return self._createElement(request)
+
+        return d.addCallback(lambda _: Created())
+
+
+    def _addElements(self, states, request):
+        """
+        Adds an element for each state, cooperating with the reactor.
+        """
+        def add():
+            for state in states:
+                yield self._addElement(state, request)
+
+        return task.coiterate(add())
 
 
     @deferredRenderWithErrorReporting
+    @admitted
     def render_POST(self, request):
         """
-        Creates a new element in the collection.
+        Creates new elements in the collection.
         """
-        d = self._createElement(request)
-        d.addCallback(_renderResource, request)
+        d = self._createElements(request)
+        return d.addCallback(_renderResource, request)
 
 
     @deferredRenderWithErrorReporting
+    @admitted
     def render_GET(self, request):
         """
         Displays the collection.
@@ -178,28 +732,243 @@ class CollectionResource(serializers.EncodingResource):
         will display a part of the collection, one page at a
         time. Each page will have links to the previous and next
         pages.
+
+        If the collection can count its elements, each page has the
+        ``total`` number of elements in the collection.
+
+        Child collections of the elements named in the ``include``
+        argument are embedded in them (see ``_includeChildren``).
+
+        If the collection has versions, each page has the ``version`` of
+        the collection, and clients can ask for only what changed since
+        then with a ``since`` argument (see ``_renderChanges``).
+
+        Pages can come from a snapshot of the collection, so that paging
+        through it shows every element once, even while it changes (see
+        ``_getSnapshot``).
+        """
+        return self._renderPage(request)
+
+
+    @deferredRenderWithErrorReporting
+    @admitted
+    def render_HEAD(self, request):
+        """
+        Displays the headers of the collection: its content type, its
+        ``ETag`` if it has versions, and its ``X-Total-Count`` if it can
+        count its elements.
+
+        No elements are queried or encoded. Since the body isn't encoded,
+        its length isn't known either, so there is no ``Content-Length``.
+        """
+        self._getEncoder(request)
+        self._setHeaders(request)
+
+        collectionName = self._collection.__class__.__name__
+        slowlog.timingsFor(request).annotate(collection=collectionName)
+        d = self._count(request)
+
+        @d.addCallback
+        def _setTotal(total):
+            if total is not None:
+                request.setHeader("X-Total-Count", str(total))
+            return ""
+
+        return d
+
+
+    def _renderPage(self, request):
+        """
+        Renders a page of the collection (see ``render_GET``).
         """
         request.encoder = self._getEncoder(request)
+        timings = slowlog.timingsFor(request)
+        timings.annotate(collection=self._collection.__class__.__name__)
+
+        if "since" in request.args:
+            return self._renderChanges(request)
 
         start, stop = self._getBounds(request)
+        timings.annotate(start=start, stop=stop)
+        snapshot, token = self._getSnapshot(request)
         url = request.prePathURL()
-        prevURL, nextURL = self._getPaginationURLs(url, start, stop)
+        prevURL, nextURL = self._getPaginationURLs(url, start, stop, token)
         response = {"prev": prevURL, "next": nextURL}
+        includes = _getIncludes(request)
 
-        d = self._collection.query(start=start, stop=stop)
+        if snapshot is None:
+            version = self._setHeaders(request)
+            d = self._count(request)
+        else:
+            response["snapshot"] = token
+            version = snapshot.version
+            if version is not None:
+                _setETag(request, version)
+            d = snapshot.count()
+
+        if version is not None:
+            response["version"] = version
+
+        def _query(total):
+            if total is not None:
+                request.setHeader("X-Total-Count", str(total))
+                response["total"] = total
+                if stop >= total:
+                    response["next"] = None
+
+            if snapshot is not None:
+                return snapshot.query(start, stop)
+            return self._call(request, "query", start=start, stop=stop)
 
         def _buildResponse(elements):
-            attrs = self._collection.exposedElementAttributes
-            response["results"] = [e.toState(attrs) for e in elements]
-        
             if (stop - start) > len(elements):
                 # Not enough elements -> end of the collection
                 response["next"] = None
 
-            request.write(request.encoder(response))
-            request.finish()
+            timings.annotate(elements=len(elements))
+            attrs = self._collection.exposedElementAttributes
+            states = _measure(self, request, "toState", len(elements),
+                              _exportStates, elements, attrs)
+            if not includes:
+                return states
+
+            resources = map(self._getElementResource, elements)
+            urls = [_childURL(url, getattr(e, e.identifyingAttribute))
+                    for e in elements]
+            return _includeChildren(zip(resources, urls), states, includes,
+                                    request)
+
+        def _encodeResponse(results):
+            response["results"] = results
+            return _measure(self, request, "encoding", None,
+                            self._encodePage, request, response)
+
+        d.addCallback(_query)
+        return d.addCallback(_buildResponse).addCallback(_encodeResponse)
+
+
+    def _setHeaders(self, request):
+        """
+        Sets the ``ETag`` of the collection, if it has versions.
+
+        Returns the version of the collection, or ``None``.
+        """
+        version = getattr(self._collection, "version", None)
+        if version is not None:
+            _setETag(request, version)
+        return version
 
-        return d.addCallback(_buildResponse)
+
+    def _count(self, request):
+        """
+        Counts the elements in the collection, if it can.
+
+        Returns a ``Deferred`` that fires with the number of elements, or
+        with ``None`` if the collection can't count them.
+        """
+        if not hasattr(self._collection, "count"):
+            return defer.succeed(None)
+        return self._call(request, "count")
+
+
+    def _renderChanges(self, request):
+        """
+        Displays what changed in the collection since a version.
+
+        The response has the ``results`` that were added or changed, the
+        identifiers of the elements that were ``removed``, and the current
+        ``version``. When the changes are no longer known, the response is
+        a ``ChangesUnavailableError``, and the client has to get the whole
+        collection again.
+        """
+        if not hasattr(self._collection, "changedSince"):
+            raise errors.ChangeFeedError("collection has no versions")
+
+        since = _getInteger(request.args, "since", None)
+        timings = slowlog.timingsFor(request)
+        timings.annotate(since=since)
+        d = self._call(request, "changedSince", since)
+        response = {}
+
+        def _buildResponse(delta):
+            response["removed"] = delta["removed"]
+            response["version"] = delta["version"]
+
+            changed = delta["changed"]
+            timings.annotate(elements=len(changed))
+            attrs = self._collection.exposedElementAttributes
+            return _measure(self, request, "toState", len(changed),
+                            _exportStates, changed, attrs)
+
+        def _encodeResponse(results):
+            response["results"] = results
+            return _measure(self, request, "encoding", None,
+                            self._encodePage, request, response)
+
+        return d.addCallback(_buildResponse).addCallback(_encodeResponse)
+
+
+    def _encodePage(self, request, page):
+        """
+        Encodes a page of the collection.
+
+        Pages with at least ``minimumOffloadedPageSize`` elements are
+        encoded by the process pool, if there is one.
+        """
+        pool = self.processPool
+        if pool is not None:
+            if len(page["results"]) >= self.minimumOffloadedPageSize:
+                return pool.encode(request.encoder, page)
+
+        return request.encoder(page)
+
+
+    @deferredRenderWithErrorReporting
+    @admitted
+    @serializers.withEncoder
+    @serializers.withDecoder
+    def render_PATCH(self, request):
+        """
+        Updates many elements in the collection at once.
+
+        The request body selects the elements with a list of
+        ``identifiers``, a ``filter`` of attribute values, or both, and
+        has the ``state`` to update them with. The response lists the
+        elements that were updated, that were missing and that failed to
+        update.
+        """
+        def updateMany(body):
+            identifiers, filter = _getBulkSelection(body)
+
+            state = body.get("state")
+            if not isinstance(state, dict):
+                raise errors.BulkRequestError("bulk update without a state")
+
+            return self._call(request, "updateMany", state, identifiers,
+                              filter)
+
+        d = self._decodeBody(request).addCallback(updateMany)
+        return d.addCallback(request.encoder)
+
+
+    @deferredRenderWithErrorReporting
+    @admitted
+    @serializers.withEncoder
+    @serializers.withDecoder
+    def render_DELETE(self, request):
+        """
+        Removes many elements from the collection at once.
+
+        The request body selects the elements like it does for PATCH. The
+        response lists the elements that were removed and that were
+        missing.
+        """
+        def removeMany(body):
+            identifiers, filter = _getBulkSelection(body)
+            return self._call(request, "removeMany", identifiers, filter)
+
+        d = self._decodeBody(request).addCallback(removeMany)
+        return d.addCallback(request.encoder)
 
 
     def _getBounds(self, request):
@@ -211,13 +980,49 @@ class CollectionResource(serializers.EncodingResource):
         return start, stop
 
 
-    def _getPaginationURLs(self, thisURL, start, stop):
+    def _getSnapshot(self, request):
+        """
+        Gets the snapshot to display pages of, and its token.
+
+        Clients ask for a new snapshot with a ``snapshot`` argument of
+        ``new``. The snapshot is pinned (see ``snapshots.pinsFor``) under
+        a token, which the links to the next and previous pages have as
+        their ``snapshot`` argument. Pinned snapshots expire after a while;
+        pages of expired snapshots fail with ``SnapshotExpiredError``.
+
+        Returns ``None`` for both without a ``snapshot`` argument.
+        """
+        values = request.args.get("snapshot")
+        if not values:
+            return None, None
+
+        pins = snapshots.pinsFor(self._collection)
+        now = self._getClock().seconds()
+
+        token = values[-1]
+        if token != "new":
+            return pins.get(token, now), token
+
+        takeSnapshot = getattr(self._collection, "snapshot", None)
+        if takeSnapshot is None:
+            raise errors.PaginationError("collection has no snapshots")
+
+        snapshot = takeSnapshot()
+        return snapshot, pins.pin(snapshot, now)
+
+
+    def _getPaginationURLs(self, thisURL, start, stop, snapshot=None):
         """
         Produces the URLs for the next page and the previous one.
+
+        If the pages are those of a snapshot, the URLs have its token.
         """
         scheme, netloc, path, _, _ = urlparse.urlsplit(thisURL)
         def buildURL(start, stop):
-            query = urllib.urlencode([("start", start), ("stop", stop)])
+            args = [("start", start), ("stop", stop)]
+            if snapshot is not None:
+                args.append(("snapshot", snapshot))
+            query = urllib.urlencode(args)
             return urlparse.urlunsplit((scheme, netloc, path, query, ""))
 
         pageSize = stop - start
@@ -240,6 +1045,228 @@ class CollectionResource(serializers.EncodingResource):
 
 
 
+_removalWatchers = weakref.WeakKeyDictionary()
+
+
+def _forgetRemovedElements(collection, collectionResource):
+    """
+    Makes a collection resource forget the resources of elements that are
+    removed from its collection, however they are removed.
+
+    Each collection gets a single change listener, which only holds on to
+    the resources weakly, since child collections get new resources
+    whenever the resources of their elements are forgotten.
+    """
+    resources = _removalWatchers.get(collection)
+    if resources is None:
+        resources = _removalWatchers[collection] = weakref.WeakSet()
+
+        def forget(change):
+            if change.kind == changes.REMOVED:
+                for r in list(resources):
+                    r._forgetElementResource(None, change.identifier)
+
+        collection.addChangeListener(forget, withState=False)
+
+    resources.add(collectionResource)
+
+
+
+class _Route(object):
+    """
+    The way a path was resolved, and the resource it resolved to.
+
+    It is current as long as the elements along the path are still the
+    same versions in their collections, and the children along the path
+    are still the same objects.
+    """
+    def __init__(self):
+        self._lookups = []
+        self._children = []
+        self.resource = None
+
+
+    def follow(self, parent, path, child):
+        """
+        Adds a step from a resource to its child to the route.
+
+        Returns ``False``, without adding it, if it can't be checked later.
+        """
+        if _instrumented(parent):
+            return False
+
+        if isinstance(parent, CollectionResource):
+            if not isinstance(child, ElementResource):
+                return False
+            collection = parent._collection
+            if getattr(collection, "admissionControl", None) is not None:
+                return False
+            getVersion = getattr(collection, "getElementVersion", None)
+            version = getVersion(path) if getVersion is not None else None
+            if version is None:
+                return False
+            self._lookups.append((getVersion, path, version))
+        else:
+            if not isinstance(child, CollectionResource):
+                return False
+            element = parent._element
+            self._children.append((element, path, getattr(element, path)))
+
+        return True
+
+
+    def isCurrent(self):
+        for getVersion, identifier, version in self._lookups:
+            if getVersion(identifier) != version:
+                return False
+        for element, name, child in self._children:
+            if getattr(element, name, None) is not child:
+                return False
+        return True
+
+
+
+def _setETag(request, version):
+    """
+    Sets a weak ``ETag`` for a version of a resource.
+
+    The tag is weak, since every encoding of the resource has the same one.
+    """
+    request.setHeader("ETag", 'W/"%d"' % (version,))
+
+
+def _getIncludes(request):
+    """
+    Gets the names of the children to include out of the query.
+
+    Names can be given in several ``include`` arguments, or separated by
+    commas in one.
+    """
+    names = []
+    for value in request.args.get("include", []):
+        for name in value.split(","):
+            if name and name not in names:
+                names.append(name)
+    return names
+
+
+def _childURL(url, name):
+    """
+    Gets the URL of a child of the resource at a URL.
+    """
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    return url.rstrip("/") + "/" + urllib.quote(name, safe="")
+
+
+def _includeChildren(pairs, states, names, request):
+    """
+    Embeds the first pages of the named child collections of some
+    elements in their states.
+
+    Takes pairs of the resources of elements and their URLs, and their
+    states (or a ``Deferred`` that fires with them). The pages of all of
+    the children of all of the elements are queried concurrently, on
+    behalf of the request, by the resources of the children (see
+    ``CollectionResource._getFirstPage``). Each page has as many elements
+    as the child collection's page size, and a link to the ``next`` page,
+    if there is one.
+
+    Raises ``IncludeError`` if a named child of some element isn't one of
+    its children, or isn't a collection.
+    """
+    children = []
+    for index, (elementResource, url) in enumerate(pairs):
+        element = elementResource._element
+        for name in names:
+            if name not in element.children:
+                raise errors.IncludeError(name)
+
+            child = getattr(element, name)
+            if not interface.ICollection.providedBy(child):
+                raise errors.IncludeError(name)
+
+            childResource = elementResource._getChildResource(name)
+            children.append((index, name, childResource,
+                             _childURL(url, name)))
+
+    pages = [childResource._getFirstPage(url, request)
+             for _, _, childResource, url in children]
+    if not isinstance(states, defer.Deferred):
+        states = defer.succeed(states)
+
+    d = defer.gatherResults([states] + pages, consumeErrors=True)
+    d.addErrback(errors.firstFailure)
+
+    @d.addCallback
+    def _embed(results):
+        states = results[0]
+        for (index, name, _, _), page in zip(children, results[1:]):
+            states[index][name] = page
+        return states
+
+    return d
+
+
+def _getBulkSelection(body):
+    """
+    Gets the identifiers and the filter out of a bulk request body.
+
+    At least one of them has to be given, so that a malformed request
+    can't accidentally affect every element in a collection.
+    """
+    if not isinstance(body, dict):
+        raise errors.BulkRequestError("bulk request body is not an object")
+
+    identifiers, filter = body.get("identifiers"), body.get("filter")
+
+    if identifiers is not None:
+        if not isinstance(identifiers, list):
+            raise errors.BulkRequestError("identifiers is not a list")
+        if not all(isinstance(i, Hashable) for i in identifiers):
+            raise errors.BulkRequestError("identifiers can't be lists or "
+                                          "objects")
+
+    if filter is not None and not isinstance(filter, dict):
+        raise errors.BulkRequestError("filter is not an object")
+
+    if identifiers is None and not filter:
+        raise errors.BulkRequestError("bulk request selects no elements")
+
+    return identifiers, filter
+
+
+def _exportStates(elements, attrs):
+    """
+    Exports the given attributes of some elements (see ``_gatherStates``).
+    """
+    return _gatherStates([e.toState(attrs) for e in elements])
+
+
+def _gatherStates(states):
+    """
+    Gathers the states of some elements.
+
+    If some of the states are deferred, the elements' blocking attributes
+    are evaluated concurrently, and this returns a ``Deferred`` that fires
+    with all of the states. Otherwise, the states are returned directly.
+    """
+    if not any(isinstance(state, defer.Deferred) for state in states):
+        return states
+
+    ds = [state if isinstance(state, defer.Deferred) else defer.succeed(state)
+          for state in states]
+    d = defer.gatherResults(ds, consumeErrors=True)
+    return d.addErrback(errors.firstFailure)
+
+
+def _asList(decoded):
+    """
+    Treats a decoded body that isn't an array as an array of one.
+    """
+    return decoded if isinstance(decoded, list) else [decoded]
+
+
 def _getBound(args, key, default=0):
     """
     Gets a particular start or stop bound from the given args.
@@ -257,18 +1284,243 @@ def _getBound(args, key, default=0):
 
 
 
+class ChangeFeedResource(serializers.EncodingResource):
+    """
+    A feed of the changes to a collection.
+
+    Clients long-poll for changes with the sequence number of the last
+    change they saw as ``since``. If there are changes after that one,
+    they are returned right away. Otherwise, the response waits for the
+    next change, for at most ``timeout`` seconds (``pollTimeout`` by
+    default, and no more than ``maximumPollTimeout``). The response has
+    the ``changes`` and the sequence number of the ``last`` change.
+
+    Like in pages of the collection, changes only have the
+    ``exposedElementAttributes`` of the collection in their states.
+
+    Clients that accept ``text/event-stream`` get Server-Sent Events
+    instead: one event per change, with the sequence number as its ID.
+    Reconnecting clients continue after their ``Last-Event-ID``. A comment
+    is sent every ``heartbeatInterval`` seconds to keep the connection
+    open.
+
+    Without a sequence number, clients get the changes from now on. When
+    the changes a client asks for are no longer in the change log, it gets
+    a ``ChangesUnavailableError``, and has to get the collection again.
+    Sequence numbers are the versions of the collection, so they mean
+    the same in all worker processes (see ``workers``).
+    """
+    pollTimeout = 30
+    maximumPollTimeout = 300
+    heartbeatInterval = 15
+    clock = None
+
+    def __init__(self, collection):
+        serializers.EncodingResource.__init__(self)
+        self._collection = collection
+
+
+    @property
+    def changeLog(self):
+        return changes.changeLogFor(self._collection)
+
+
+    def render_GET(self, request):
+        accept = request.getHeader("Accept") or ""
+        if _eventStream in accept:
+            return self._stream(request)
+        return self._poll(request)
+
+
+    @deferredRenderWithErrorReporting
+    @serializers.withEncoder
+    def _poll(self, request):
+        """
+        Answers a long-polling request for changes.
+        """
+        changeLog = self.changeLog
+        since = _getInteger(request.args, "since", changeLog.last)
+        timeout = _getInteger(request.args, "timeout", self.pollTimeout)
+        timeout = min(timeout, self.maximumPollTimeout)
+
+        d = changeLog.wait(since)
+        if not d.called:
+            clock = _getClock(self.clock)
+            d = _cancelling(d, request, "changes", timeout, clock)
+            d.addErrback(_noChanges)
+
+        @d.addCallback
+        def encode(changes):
+            last = changes[-1].sequence if changes else since
+            attrs = self._collection.exposedElementAttributes
+            states = [_exposedState(change, attrs) for change in changes]
+            return request.encoder({"changes": states, "last": last})
+
+        return d
+
+
+    def _stream(self, request):
+        """
+        Streams changes as Server-Sent Events.
+        """
+        changeLog = self.changeLog
+        try:
+            since = request.getHeader("Last-Event-ID")
+            if since is not None:
+                since = _parseInteger("Last-Event-ID", since)
+            else:
+                since = _getInteger(request.args, "since", changeLog.last)
+            changeLog.since(since)
+        except errors.SerializableError, e:
+            return errors.RESTErrorPage(e, self.defaultEncoder).render(request)
+
+        request.setHeader("Content-Type", _eventStream)
+        request.setHeader("Cache-Control", "no-cache")
+        clock = _getClock(self.clock)
+        attrs = self._collection.exposedElementAttributes
+        stream = _EventStream(request, changeLog, since, attrs)
+        stream.start(clock, self.heartbeatInterval)
+        return server.NOT_DONE_YET
+
+
+
+_eventStream = "text/event-stream"
+
+
+def _noChanges(reason):
+    """
+    Answers a long-poll that timed out without changes.
+    """
+    reason.trap(errors.GatewayTimeoutError)
+    return []
+
+
+def _exposedState(change, attrs):
+    """
+    Exports the state of a change, with only the given attributes of the
+    element it is for, like pages of its collection have.
+    """
+    state = change.toState()
+    if state["state"] is not None:
+        state["state"] = dict((attr, value)
+                              for attr, value in state["state"].iteritems()
+                              if attr in attrs)
+    return state
+
+
+def _getInteger(args, key, default):
+    """
+    Gets an integer from the query arguments.
+    """
+    values = args.get(key)
+    if not values:
+        return default
+    return _parseInteger(key, values[-1])
+
+
+def _parseInteger(key, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise errors.ChangeFeedError("%s not an integer" % (key,))
+
+
+
+class _EventStream(object):
+    """
+    Writes the changes in a change log to a request as Server-Sent Events,
+    with only the given attributes of elements in their states.
+    """
+    def __init__(self, request, changeLog, since, attrs):
+        self._request = request
+        self._changeLog = changeLog
+        self._since = since
+        self._attrs = attrs
+        self._waiting = None
+
+
+    def start(self, clock, heartbeatInterval):
+        self._request.write(":\n\n")
+
+        self._heartbeat = task.LoopingCall(self._request.write, ":\n\n")
+        self._heartbeat.clock = clock
+        self._heartbeat.start(heartbeatInterval, now=False)
+
+        self._request.notifyFinish().addBoth(self._stop)
+        self._wait()
+
+
+    def _wait(self):
+        self._waiting = self._changeLog.wait(self._since)
+        self._waiting.addCallbacks(self._send, _ignoreCancellation)
+
+
+    def _send(self, changes):
+        events = []
+        for change in changes:
+            state = _exposedState(change, self._attrs)
+            data = serializers.jsonEncode(state)
+            events.append("id: %d\nevent: %s\ndata: %s\n\n"
+                          % (change.sequence, change.kind, data))
+        self._request.write("".join(events))
+
+        self._since = changes[-1].sequence
+        self._wait()
+
+
+    def _stop(self, _):
+        self._heartbeat.stop()
+        self._waiting.cancel()
+
+
+
+def _ignoreCancellation(reason):
+    reason.trap(defer.CancelledError)
+
+
+
 class ElementResource(serializers.EncodingResource):
     """
     A resource representing an element in a collection.
+
+    If the resource knows the ``collection`` the element was found in,
+    that collection is told about updates to the element.
     """
+    patchDecoders = serializers.patchDecoders
+    collection = None
+
     def __init__(self, element):
         serializers.EncodingResource.__init__(self)
         self._element = element
+        self._childResources = {}
 
 
     def getChild(self, path, request):
-        child = getattr(self._element, path)
-        return resource.IResource(child)
+        """
+        Gets the resource for one of the element's ``children``.
+
+        The resource is kept for as long as the element has the same child,
+        so that requests for it don't create new resources.
+        """
+        if path not in self._element.children:
+            error = errors.MissingChildError(path)
+            return errors.RESTErrorPage(error, self.defaultEncoder)
+
+        return self._getChildResource(path)
+
+
+    def _getChildResource(self, name):
+        """
+        Gets the resource for one of the element's ``children``.
+        """
+        child = getattr(self._element, name)
+        cached = self._childResources.get(name)
+        if cached is not None and cached[0] is child:
+            return cached[1]
+
+        childResource = resource.IResource(child)
+        self._childResources[name] = child, childResource
+        return childResource
 
 
     @deferredRenderWithErrorReporting
@@ -276,11 +1528,77 @@ class ElementResource(serializers.EncodingResource):
     def render_GET(self, request):
         """
         Displays the element.
+
+        Child collections named in the ``include`` argument are embedded
+        in it (see ``_includeChildren``). Elements that keep their encoded
+        state (like those of a ``compact.CompactCollection``) are served
+        from it.
+        """
+        return self._renderElement(request)
+
+
+    @deferredRenderWithErrorReporting
+    @serializers.withEncoder
+    def render_HEAD(self, request):
         """
-        state = self._element.toState()
-        encoded = request.encoder(state)
-        request.write(encoded)
-        request.finish()
+        Displays the headers of the element: its content type, and its
+        ``ETag`` if the collection it was found in has versions.
+
+        The state of the element isn't exported or encoded, so there is no
+        ``Content-Length``.
+        """
+        self._setHeaders(request)
+        return ""
+
+
+    def _renderElement(self, request):
+        """
+        Renders the element (see ``render_GET``).
+        """
+        self._setHeaders(request)
+        timings = slowlog.timingsFor(request)
+        timings.annotate(elements=1)
+        includes = _getIncludes(request)
+
+        getEncodedState = getattr(self._element, "getEncodedState", None)
+        if getEncodedState is not None and not includes:
+            body = _measure(self, request, "encoding", None, getEncodedState,
+                            request.encoder)
+            if body is not None:
+                return body
+
+        state = _measure(self, request, "toState", 1, self._element.toState)
+
+        def encode(state):
+            return _measure(self, request, "encoding", None, request.encoder,
+                            state)
+
+        if includes:
+            pairs = [(self, request.prePathURL())]
+            d = _includeChildren(pairs, _gatherStates([state]), includes,
+                                 request)
+            return d.addCallback(lambda states: encode(states[0]))
+
+        if isinstance(state, defer.Deferred):
+            return state.addCallback(encode)
+        return encode(state)
+
+
+    def _setHeaders(self, request):
+        """
+        Sets the ``ETag`` of the element, if the collection it was found in
+        knows its version.
+        """
+        getElementVersion = getattr(self.collection, "getElementVersion",
+                                    None)
+        if getElementVersion is None:
+            return
+
+        element = self._element
+        version = getElementVersion(getattr(element,
+                                            element.identifyingAttribute))
+        if version is not None:
+            _setETag(request, version)
 
 
     @deferredRenderWithErrorReporting
@@ -289,4 +1607,26 @@ class ElementResource(serializers.EncodingResource):
         """
         Updates the element.
         """
-        return self._element.update(request.decoder(request.content))
+        state = request.decoder(request.content)
+        d = self._element.update(state)
+        return d.addCallback(lambda _: self._updated(state))
+
+
+    @deferredRenderWithErrorReporting
+    @serializers.withPatchDecoder
+    def render_PATCH(self, request):
+        """
+        Partially updates the element, by applying a patch to it.
+        """
+        d = self._element.patch(request.decoder(request.content))
+        return d.addCallback(self._updated)
+
+
+    def _updated(self, attrs):
+        """
+        Tells the collection that some attributes of the element were
+        updated, if it wants to know, and there are any.
+        """
+        elementUpdated = getattr(self.collection, "elementUpdated", None)
+        if elementUpdated is not None and attrs:
+            elementUpdated(self._element, attrs)
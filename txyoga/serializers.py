@@ -4,11 +4,14 @@
 Serialization support.
 """
 import functools
+import re
 try: # pragma: no cover
     import simplejson as json
 except ImportError:# pragma: no cover
     import json
 
+from twisted.internet import defer
+from twisted.python import log, reflect
 from twisted.web.resource import Resource
 
 from txyoga import errors, interface
@@ -21,7 +24,184 @@ def forContentType(contentType):
     return decorator
 
 
+def incremental(iterDecoder):
+    """
+    Marks a decoder as having an incremental variant.
+
+    The incremental variant takes a file-like object just like the
+    decoder. If the encoded object is an array, it yields the items of
+    that array one at a time, otherwise it yields the object itself.
+    """
+    def decorator(decoder):
+        decoder.iterDecode = iterDecoder
+        return decoder
+    return decorator
+
+
+_whitespace = re.compile(r"[ \t\n\r]*")
+
+
+class _ItemScanner(object):
+    """
+    Finds where a JSON array item ends, in the chunks of a body, without
+    decoding it.
+
+    Items that are objects, arrays or strings end where their last
+    bracket or quote is; other items (like numbers) end where a comma,
+    bracket or whitespace is. Since the scanner keeps track of the
+    nesting and strings it is in, every chunk is only scanned once.
+    """
+    _structural = re.compile(r'["\[\]{}]')
+    _stringEnd = re.compile(r'["\\]')
+    _scalarEnd = re.compile(r"[ \t\n\r,\]]")
+
+    def __init__(self):
+        self._scalar = None
+        self._depth = 0
+        self._inString = False
+        self._escaped = False
+
+
+    def scan(self, chunk, position=0):
+        """
+        Scans a chunk, from a position, for the end of the item.
+
+        Returns the index in the chunk just past the end of the item, or
+        ``None`` if the item doesn't end in it.
+        """
+        if self._scalar is None:
+            self._scalar = chunk[position] not in '[{"'
+
+        if self._scalar:
+            match = self._scalarEnd.search(chunk, position)
+            return None if match is None else match.start()
+
+        while True:
+            if self._inString:
+                if self._escaped:
+                    if position == len(chunk):
+                        return None
+                    position += 1
+                    self._escaped = False
+
+                match = self._stringEnd.search(chunk, position)
+                if match is None:
+                    return None
+
+                position = match.end()
+                if match.group() == "\\":
+                    self._escaped = True
+                    continue
+
+                self._inString = False
+                if self._depth == 0:
+                    return position
+            else:
+                match = self._structural.search(chunk, position)
+                if match is None:
+                    return None
+
+                position, char = match.end(), match.group()
+                if char == '"':
+                    self._inString = True
+                elif char in "[{":
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        return position
+
+
+
+def jsonIterDecode(state, chunkSize=65536):
+    """
+    Incrementally decodes a JSON array, yielding one item at a time.
+
+    Only the part of the body that hasn't been decoded yet is kept in
+    memory, in addition to the chunk being read. Items that span many
+    chunks are only decoded once all of them are read (see
+    ``_ItemScanner``), so they take time proportional to their size.
+
+    Like ``json.load``, anything but whitespace after the array is
+    rejected, but only once all items were yielded.
+    """
+    decoder = json.JSONDecoder()
+    buf = state.read(chunkSize)
+    index = _whitespace.match(buf).end()
+    while index == len(buf):
+        more = state.read(chunkSize)
+        if not more:
+            break
+        buf, index = more, _whitespace.match(more).end()
+
+    if buf[index:index + 1] != "[":
+        yield json.loads(buf + state.read())
+        return
+
+    index += 1
+    expectingItem, empty = True, True
+    while True:
+        index = _whitespace.match(buf, index).end()
+
+        if index == len(buf):
+            more = state.read(chunkSize)
+            if not more:
+                raise ValueError("unterminated JSON array")
+            buf, index = buf[index:] + more, 0
+            continue
+
+        char = buf[index]
+        if not expectingItem:
+            if char == "]":
+                _checkEnd(state, buf, index + 1, chunkSize)
+                return
+            elif char != ",":
+                raise ValueError("expected ',' or ']' in JSON array")
+            index += 1
+            expectingItem = True
+            continue
+        elif char == "]" and empty:
+            _checkEnd(state, buf, index + 1, chunkSize)
+            return
+
+        scanner = _ItemScanner()
+        if scanner.scan(buf, index) is None:
+            # The item continues in the next chunks, read up to its end.
+            chunks = [buf[index:]]
+            while True:
+                more = state.read(chunkSize)
+                if not more:
+                    break
+                chunks.append(more)
+                if scanner.scan(more) is not None:
+                    break
+            buf, index = "".join(chunks), 0
+
+        try:
+            item, index = decoder.raw_decode(buf, index)
+        except ValueError:
+            raise ValueError("invalid JSON array item")
+
+        yield item
+        expectingItem, empty = False, False
+
+
+
+def _checkEnd(state, buf, index, chunkSize):
+    """
+    Makes sure there's only whitespace after the end of a JSON array.
+    """
+    while True:
+        index = _whitespace.match(buf, index).end()
+        if index < len(buf):
+            raise ValueError("extra data after JSON array")
+        buf, index = state.read(chunkSize), 0
+        if not buf:
+            return
+
+
 @forContentType("application/json")
+@incremental(jsonIterDecode)
 def jsonDecode(state):
     """
     Decodes an object from JSON.
@@ -29,6 +209,14 @@ def jsonDecode(state):
     return json.load(state)
 
 
+@forContentType("application/merge-patch+json")
+def jsonMergePatchDecode(state):
+    """
+    Decodes a JSON merge patch.
+    """
+    return json.load(state)
+
+
 @forContentType("application/json")
 def jsonEncode(obj):
     """
@@ -47,18 +235,256 @@ class _RESTResourceJSONEncoder(json.JSONEncoder):
     """
     def default(self, obj):
         if interface.ISerializableError.providedBy(obj):
-            return {"errorMessage": obj.message, "errorDetails": obj.details}
+            return _errorState(obj)
         return json.JSONEncoder.default(self, obj)
 
 
 
+def _errorState(error):
+    """
+    Gets the serializable state of a ``SerializableError``.
+    """
+    return {"errorMessage": error.message, "errorDetails": error.details}
+
+
+def _msgpackDefault(obj):
+    """
+    Encodes the objects MessagePack doesn't know about.
+
+    Like the JSON encoder, this encodes ``SerializableError``s.
+    """
+    if interface.ISerializableError.providedBy(obj):
+        return _errorState(obj)
+    raise TypeError("%r is not MessagePack serializable" % (obj,))
+
+
+def _isMsgpackArray(firstByte):
+    """
+    Checks if the first byte of a MessagePack object starts an array.
+    """
+    return firstByte in "\xdc\xdd" or "\x90" <= firstByte <= "\x9f"
+
+
+def msgpackIterDecode(state, chunkSize=65536):
+    """
+    Incrementally decodes a MessagePack array, yielding one item at a time.
+    """
+    import msgpack
+
+    buf = state.read(chunkSize)
+    if not buf or not _isMsgpackArray(buf[0]):
+        yield msgpack.unpackb(buf + state.read(), raw=False)
+        return
+
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(buf)
+
+    def unpack(read):
+        while True:
+            try:
+                return read()
+            except msgpack.OutOfData:
+                more = state.read(chunkSize)
+                if not more:
+                    raise ValueError("truncated MessagePack array")
+                unpacker.feed(more)
+
+    for _ in xrange(unpack(unpacker.read_array_header)):
+        yield unpack(unpacker.unpack)
+
+
+@forContentType("application/msgpack")
+@incremental(msgpackIterDecode)
+def msgpackDecode(state):
+    """
+    Decodes an object from MessagePack.
+    """
+    import msgpack
+    return msgpack.unpackb(state.read(), raw=False)
+
+
+@forContentType("application/msgpack")
+def msgpackEncode(obj):
+    """
+    Encodes an object to MessagePack.
+
+    Like ``jsonEncode``, this also encodes ``SerializableError``s.
+    """
+    import msgpack
+    return msgpack.packb(obj, default=_msgpackDefault, use_bin_type=False)
+
+
+
+class CodecRegistry(object):
+    """
+    Encoders or decoders, by content type.
+
+    Codecs can be registered directly, by their fully qualified name or as
+    objects with a ``load`` method that returns the codec (such as entry
+    points). Codecs that weren't registered directly are only loaded the
+    first time their content type is looked up. Codecs that can't be
+    imported are dropped from the registry.
+
+    If the registry has an entry point group, the entry points in that
+    group are registered the first time the registry is used. Their names
+    are the content types; they don't replace codecs registered
+    explicitly.
+    """
+    def __init__(self, entryPointGroup=None):
+        self.entryPointGroup = entryPointGroup
+        self._codecs = {}
+        self._contentTypes = []
+        self._discovered = entryPointGroup is None
+
+
+    def register(self, contentType, codec):
+        """
+        Registers a codec for a content type.
+        """
+        contentType = contentType.lower()
+
+        if isinstance(codec, basestring):
+            codec = _NamedCodec(codec)
+
+        if contentType not in self._codecs:
+            self._contentTypes.append(contentType)
+        self._codecs[contentType] = codec
+
+
+    def get(self, contentType):
+        """
+        Gets the codec for a content type, or ``None`` if there isn't one.
+        """
+        self._discover()
+        contentType = contentType.lower()
+
+        codec = self._codecs.get(contentType)
+        if codec is None or not isinstance(codec, _lazyCodecTypes):
+            return codec
+
+        try:
+            codec = self._codecs[contentType] = codec.load()
+        except ImportError, e:
+            log.msg("Unable to load codec for %s: %s" % (contentType, e))
+            del self._codecs[contentType]
+            self._contentTypes.remove(contentType)
+            return None
+
+        return codec
+
+
+    def contentTypes(self):
+        """
+        Gets the content types of all registered codecs, without loading
+        them.
+        """
+        self._discover()
+        return list(self._contentTypes)
+
+
+    def _discover(self):
+        """
+        Registers the codecs advertised as entry points.
+        """
+        if self._discovered:
+            return
+        self._discovered = True
+
+        try:
+            import pkg_resources
+        except ImportError: # pragma: no cover
+            return
+
+        group = self.entryPointGroup
+        for entryPoint in pkg_resources.iter_entry_points(group):
+            if entryPoint.name.lower() not in self._codecs:
+                self.register(entryPoint.name, _EntryPointCodec(entryPoint))
+
+
+
+class _NamedCodec(object):
+    """
+    A codec that's imported by its fully qualified name when it's loaded.
+
+    If the codec requires some other module, that module is imported
+    first, so that a missing dependency makes the codec unavailable.
+    """
+    def __init__(self, name, requires=None):
+        self.name = name
+        self.requires = requires
+
+
+    def load(self):
+        if self.requires is not None:
+            __import__(self.requires)
+        return reflect.namedAny(self.name)
+
+
+
+class _EntryPointCodec(object):
+    """
+    A codec advertised as a setuptools entry point.
+    """
+    def __init__(self, entryPoint):
+        self.entryPoint = entryPoint
+
+
+    def load(self):
+        return self.entryPoint.load()
+
+
+
+_lazyCodecTypes = _NamedCodec, _EntryPointCodec
+
+
+encoders = CodecRegistry("txyoga.encoders")
+encoders.register("application/json", jsonEncode)
+encoders.register("application/msgpack",
+                  _NamedCodec(__name__ + ".msgpackEncode", "msgpack"))
+
+decoders = CodecRegistry("txyoga.decoders")
+decoders.register("application/json", jsonDecode)
+decoders.register("application/msgpack",
+                  _NamedCodec(__name__ + ".msgpackDecode", "msgpack"))
+
+
+patchDecoders = CodecRegistry("txyoga.patchDecoders")
+patchDecoders.register("application/merge-patch+json", jsonMergePatchDecode)
+
+
+
 class EncodingResource(Resource):
     """
     A resource that understands content types.
+
+    Request bodies larger than ``maximumBodySize`` bytes are refused
+    before they are decoded. If it is ``None``, bodies of any size are
+    accepted.
+
+    If the resource has a ``processPool`` (see ``txyoga.offload``), request
+    bodies of at least ``minimumOffloadedBodySize`` bytes are decoded by
+    it, instead of on the reactor thread.
+
+    If the resource has a ``profiler`` (see ``txyoga.profiling``), it
+    profiles a sample of the requests the resource renders. If it has a
+    ``slowRequestLog`` (see ``txyoga.slowlog``), requests that take too
+    long are logged. If it has a ``lagMonitor`` (see ``txyoga.lag``),
+    reactor stalls are attributed to what it was doing. If it has a
+    ``tracer`` (see ``txyoga.tracing``), requests are traced.
     """
     defaultEncoder = staticmethod(jsonEncode)
-    encoders = [jsonEncode]
-    decoders = [jsonDecode]
+    encoders = encoders
+    decoders = decoders
+
+    maximumBodySize = None
+
+    processPool = None
+    minimumOffloadedBodySize = 1 << 20
+
+    profiler = None
+    slowRequestLog = None
+    lagMonitor = None
+    tracer = None
 
 
     def _getEncoder(self, request):
@@ -71,33 +497,105 @@ class EncodingResource(Resource):
         accepted = [contentType.lower() for contentType, _ in parsed]
 
         for contentType in accepted:
-            for encoder in self.encoders:
-                if encoder.contentType == contentType:
-                    request.setHeader("Content-Type", encoder.contentType)
-                    return encoder
+            encoder = _getCodec(self.encoders, contentType)
+            if encoder is not None:
+                request.setHeader("Content-Type", encoder.contentType)
+                return encoder
 
         self._unacceptable(accepted)
 
 
     def _unacceptable(self, accepted=None):
-        supported = [encoder.contentType for encoder in self.encoders]
+        supported = _getContentTypes(self.encoders)
         raise errors.UnacceptableRequest(supported, accepted)
 
 
-    def _getDecoder(self, request):
+    def _getDecoder(self, request, decoders=None):
+        if decoders is None:
+            decoders = self.decoders
+
         contentType = request.getHeader("Content-Type")
         if contentType is None:
-            supported = [decoder.contentType for decoder in self.decoders]
+            supported = _getContentTypes(decoders)
             raise errors.MissingContentType(supported)
 
-        for decoder in self.decoders:
-            if decoder.contentType == contentType:
-                return decoder
+        decoder = _getCodec(decoders, contentType)
+        if decoder is not None:
+            return decoder
 
-        supported = [decoder.contentType for decoder in self.decoders]
+        supported = _getContentTypes(decoders)
         raise errors.UnsupportedContentType(supported, contentType)
 
 
+    def _checkBodySize(self, request):
+        """
+        Checks that the request body isn't larger than allowed.
+        """
+        if self.maximumBodySize is None:
+            return
+
+        bodySize = _getBodySize(request.content)
+        if bodySize > self.maximumBodySize:
+            raise errors.RequestEntityTooLarge(self.maximumBodySize, bodySize)
+
+
+    def _offloadsDecoding(self, request):
+        """
+        Checks if the request body is decoded by the process pool.
+        """
+        if self.processPool is None:
+            return False
+
+        bodySize = _getBodySize(request.content)
+        return bodySize >= self.minimumOffloadedBodySize
+
+
+    def _decodeBody(self, request):
+        """
+        Decodes the request body with the request's decoder.
+
+        Returns a ``Deferred`` that fires with the decoded body.
+        """
+        if self._offloadsDecoding(request):
+            body = request.content.read()
+            return self.processPool.decode(request.decoder, body)
+
+        return defer.maybeDeferred(request.decoder, request.content)
+
+
+
+def _getBodySize(content):
+    """
+    Gets the size of a request body, leaving it ready to be read.
+    """
+    content.seek(0, 2)
+    bodySize = content.tell()
+    content.seek(0, 0)
+    return bodySize
+
+
+
+def _getCodec(codecs, contentType):
+    """
+    Gets the codec for a content type from a registry or a list of codecs.
+    """
+    if isinstance(codecs, CodecRegistry):
+        return codecs.get(contentType)
+
+    for codec in codecs:
+        if codec.contentType == contentType:
+            return codec
+
+
+def _getContentTypes(codecs):
+    """
+    Gets the supported content types of a registry or a list of codecs.
+    """
+    if isinstance(codecs, CodecRegistry):
+        return codecs.contentTypes()
+
+    return [codec.contentType for codec in codecs]
+
 
 def withEncoder(m):
     """
@@ -113,10 +611,27 @@ def withEncoder(m):
 def withDecoder(m):
     """
     Tacks the appropriate decoder on to a decorated method's request.
+
+    Also refuses request bodies that are too large to be decoded.
     """
     @functools.wraps(m)
     def decorated(self, request, *args, **kwargs):
         request.decoder = self._getDecoder(request)
+        self._checkBodySize(request)
+        return m(self, request, *args, **kwargs)
+    return decorated
+
+
+def withPatchDecoder(m):
+    """
+    Tacks the appropriate patch decoder on to a decorated method's request.
+
+    Like ``withDecoder``, but uses the resource's ``patchDecoders``.
+    """
+    @functools.wraps(m)
+    def decorated(self, request, *args, **kwargs):
+        request.decoder = self._getDecoder(request, self.patchDecoders)
+        self._checkBodySize(request)
         return m(self, request, *args, **kwargs)
     return decorated
 
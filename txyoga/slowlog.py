@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Logging slow requests.
+
+Give a resource a ``SlowRequestLog`` as its ``slowRequestLog`` (or give it
+to all resources, by setting it on ``serializers.EncodingResource``), and
+every request it renders that takes longer than the log's ``threshold``
+is written to the log as one line of JSON, like::
+
+    {"method": "GET", "path": "/zoo", "resource": "CollectionResource",
+     "collection": "Zoo", "start": 0, "stop": 10, "elements": 10,
+     "contentType": "application/json", "bytes": 1234,
+     "duration": 1.5, "phases": {"waiting": 1.2, "toState": 0.2,
+     "encoding": 0.05, "other": 0.05}, ...}
+
+The phases say where the time went:
+
+    - ``waiting``, for the ``Deferred``s of the collection (and of the
+      process pool, and blocking attributes) to fire,
+    - ``fromState``, creating elements from their state,
+    - ``toState``, exporting the state of elements,
+    - ``encoding``, encoding the response body,
+    - ``other``, everything else.
+
+Waits that overlap (like those for the pages of included children) are
+each counted, so they can add up to more than the request took.
+"""
+from twisted.internet import defer
+from twisted.python import log
+
+from txyoga.serializers import json
+
+
+class RequestTimings(object):
+    """
+    The time a request spent in each phase, and what it was for.
+    """
+    def __init__(self, clock):
+        self._clock = clock
+        self.started = clock.seconds()
+        self.phases = {"waiting": 0.0, "fromState": 0.0, "toState": 0.0,
+                       "encoding": 0.0}
+        self.details = {}
+        self.resource = None
+
+
+    def annotate(self, **details):
+        """
+        Adds details of what the request was for.
+        """
+        self.details.update(details)
+
+
+    def renderedBy(self, resource):
+        """
+        Notes the resource that renders the request.
+
+        Requests pass through several resources; the one that renders it
+        last is the one that is logged.
+        """
+        self.resource = resource
+
+
+    def measure(self, phase, f, *args, **kwargs):
+        """
+        Calls a function, and adds the time it took to a phase.
+
+        If it returns a ``Deferred``, the time until that fires is waiting.
+        """
+        started = self._clock.seconds()
+        try:
+            result = f(*args, **kwargs)
+        finally:
+            self.phases[phase] += self._clock.seconds() - started
+
+        if isinstance(result, defer.Deferred):
+            self.wait(result)
+        return result
+
+
+    def wait(self, d):
+        """
+        Adds the time until a ``Deferred`` fires to the waiting phase.
+        """
+        started = self._clock.seconds()
+
+        def stop(result):
+            self.phases["waiting"] += self._clock.seconds() - started
+            return result
+
+        return d.addBoth(stop)
+
+
+
+class _NoTimings(object):
+    """
+    The timings of requests that aren't timed: they measure nothing.
+    """
+    def annotate(self, **details):
+        pass
+
+
+    def renderedBy(self, resource):
+        pass
+
+
+    def measure(self, phase, f, *args, **kwargs):
+        return f(*args, **kwargs)
+
+
+    def wait(self, d):
+        return d
+
+
+
+_noTimings = _NoTimings()
+
+
+def getAttached(request, name, default=None):
+    """
+    Gets something attached to a request, like its timings or its span
+    (see ``txyoga.tracing``), or ``default`` if it has none.
+    """
+    # Looked up in the instance dictionary, since a missing attribute is
+    # much slower to find out about.
+    return request.__dict__.get(name, default)
+
+
+def timingsFor(request):
+    """
+    Gets the timings of a request, which measure nothing if the request
+    isn't timed.
+    """
+    return getAttached(request, "timings", _noTimings)
+
+
+
+class SlowRequestLog(object):
+    """
+    Logs the requests that take longer than ``threshold`` seconds to the
+    ``output`` file, one JSON object per line.
+    """
+    def __init__(self, output, threshold=1.0, clock=None):
+        self.output = output
+        self.threshold = threshold
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
+
+    def start(self, resource, request):
+        """
+        Starts timing a request for a resource, unless it already is.
+        """
+        timings = getAttached(request, "timings")
+        if timings is None:
+            timings = request.timings = RequestTimings(self._clock)
+            d = request.notifyFinish()
+            d.addBoth(self._finished, request, timings)
+
+            timings.renderedBy(resource)
+        return timings
+
+
+    def _finished(self, result, request, timings):
+        duration = self._clock.seconds() - timings.started
+        if duration < self.threshold:
+            return
+
+        phases = dict(timings.phases)
+        phases["other"] = max(0.0, duration - sum(phases.itervalues()))
+
+        contentTypes = request.responseHeaders.getRawHeaders("Content-Type")
+        record = {"time": timings.started,
+                  "duration": duration,
+                  "method": request.method,
+                  "path": request.path,
+                  "resource": timings.resource.__class__.__name__,
+                  "contentType": contentTypes[-1] if contentTypes else None,
+                  "finished": result is None,
+                  "phases": phases}
+        record.update(timings.details)
+
+        try:
+            self.output.write(json.dumps(record) + "\n")
+            self.output.flush()
+        except EnvironmentError:
+            log.err(None, "Couldn't log the slow request for %s"
+                    % (request.path,))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Keeping snapshots of collections around for a while.
+
+Paging through a collection while it changes can show some elements
+twice, and skip others, since their positions shift. A client that pages
+through a snapshot of the collection instead sees every element exactly
+once. The snapshot is pinned under a token, which the client passes along
+with every page.
+"""
+import binascii
+import os
+import weakref
+from collections import OrderedDict
+
+from txyoga import errors
+
+
+class SnapshotPins(object):
+    """
+    Snapshots pinned under tokens.
+
+    Snapshots are kept for ``timeToLive`` seconds after they were pinned.
+    At most ``maximumSize`` of them are kept; when more are pinned, the
+    oldest ones are unpinned.
+    """
+    def __init__(self, timeToLive=300, maximumSize=100):
+        self.timeToLive = timeToLive
+        self.maximumSize = maximumSize
+        self._pinned = OrderedDict()
+
+
+    def pin(self, snapshot, now):
+        """
+        Pins a snapshot, and returns its token.
+        """
+        self._expire(now)
+
+        token = binascii.hexlify(os.urandom(8))
+        self._pinned[token] = now + self.timeToLive, snapshot
+        if len(self._pinned) > self.maximumSize:
+            self._pinned.popitem(last=False)
+
+        return token
+
+
+    def get(self, token, now):
+        """
+        Gets a pinned snapshot.
+
+        Raises ``SnapshotExpiredError`` if the snapshot is no longer kept.
+        """
+        self._expire(now)
+
+        try:
+            _, snapshot = self._pinned[token]
+        except KeyError:
+            raise errors.SnapshotExpiredError(token)
+
+        return snapshot
+
+
+    def _expire(self, now):
+        """
+        Unpins the snapshots that have expired.
+
+        Snapshots are pinned in the order they expire in, so only the
+        expired ones are looked at.
+        """
+        while self._pinned:
+            token, (expires, _) = next(self._pinned.iteritems())
+            if expires > now:
+                break
+            del self._pinned[token]
+
+
+
+_pins = weakref.WeakKeyDictionary()
+
+
+def pinsFor(collection):
+    """
+    Gets the pinned snapshots of a collection.
+
+    They live as long as the collection does, so snapshots pinned through
+    one resource can be used through another one for the same collection.
+    """
+    try:
+        return _pins[collection]
+    except KeyError:
+        pins = _pins[collection] = SnapshotPins()
+        return pins
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test admission control and load shedding.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.web import http
+
+from txyoga import admission, errors
+from txyoga.test import collections, util
+from txyoga.test.test_coalescing import SlowZoo
+
+
+class BudgetTest(TestCase):
+    """
+    Tests for budgets of concurrent operations.
+    """
+    def setUp(self):
+        self.budget = admission.Budget(1, maximumWaiting=1)
+
+
+    def test_admit(self):
+        """
+        Operations are admitted immediately while under the limit.
+        """
+        self.assertTrue(self.budget.acquire().called)
+        self.assertEqual(self.budget.inFlight, 1)
+
+
+    def test_wait(self):
+        """
+        Operations over the limit wait until an admitted operation is done.
+        """
+        self.budget.acquire()
+        d = self.budget.acquire()
+        self.assertFalse(d.called)
+        self.assertEqual(self.budget.waiting, 1)
+
+        self.budget.release()
+        self.assertTrue(d.called)
+        self.assertEqual((self.budget.inFlight, self.budget.waiting), (1, 0))
+
+
+    def test_shed(self):
+        """
+        Operations that don't fit in the queue are shed.
+        """
+        self.budget.acquire()
+        self.budget.acquire()
+        self.assertIdentical(self.budget.acquire(), None)
+        self.assertEqual(self.budget.shed, 1)
+
+
+    def test_cancelWaiting(self):
+        """
+        Cancelled operations stop waiting.
+        """
+        self.budget.acquire()
+        d = self.budget.acquire()
+        d.cancel()
+        self.failureResultOf(d)
+        self.assertEqual(self.budget.waiting, 0)
+
+
+
+class AdmissionControlTest(TestCase):
+    """
+    Tests for admission control of requests.
+    """
+    def setUp(self):
+        self.control = admission.AdmissionControl(maximumReads=1,
+                                                  maximumWrites=1,
+                                                  retryAfter=5)
+
+
+    def test_releaseOnFinish(self):
+        """
+        Requests hold on to their place until they are finished.
+        """
+        request = util._FakeRequest()
+        self.control.admit(request)
+        self.assertEqual(self.control.reads.inFlight, 1)
+        request.finish()
+        self.assertEqual(self.control.reads.inFlight, 0)
+
+
+    def test_shed(self):
+        """
+        Excess requests are refused, advising when to retry.
+        """
+        self.control.admit(util._FakeRequest())
+        e = self.assertRaises(errors.ServiceUnavailableError,
+                              self.control.admit, util._FakeRequest())
+        self.assertEqual(e.headers, {"Retry-After": "5"})
+
+
+    def test_separateBudgets(self):
+        """
+        Reads and writes have separate budgets.
+        """
+        self.control.admit(util._FakeRequest())
+        self.control.admit(util._FakeRequest(method="PUT"))
+        self.assertEqual(self.control.writes.inFlight, 1)
+
+
+    def test_readmission(self):
+        """
+        Requests that were already admitted are admitted again without
+        taking another place.
+        """
+        request = util._FakeRequest()
+        self.control.admit(request)
+        self.assertTrue(self.control.admit(request).called)
+        self.assertEqual(self.control.reads.inFlight, 1)
+
+
+    def test_parent(self):
+        """
+        Requests have to be admitted by the parent admission control too.
+        """
+        parent = admission.AdmissionControl(maximumReads=1)
+        first = admission.AdmissionControl(maximumReads=1, parent=parent)
+        second = admission.AdmissionControl(maximumReads=1, parent=parent)
+
+        first.admit(util._FakeRequest())
+        self.assertRaises(errors.ServiceUnavailableError,
+                          second.admit, util._FakeRequest())
+
+
+
+class SheddingZoo(SlowZoo):
+    """
+    A slow zoo that only serves one read and one write at a time.
+    """
+    def __init__(self):
+        SlowZoo.__init__(self)
+        self.admissionControl = admission.AdmissionControl(maximumReads=1,
+                                                           maximumWrites=1)
+
+
+
+class SheddingResourceTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests that collection resources shed excess requests.
+    """
+    collectionClass = SheddingZoo
+
+    def test_shed(self):
+        """
+        Requests over the limit are refused with 503 Service Unavailable.
+        """
+        self.addElements()
+        firstRequest = util._FakeRequest(
+            requestHeaders=util.correctAcceptHeaders)
+        first = self._makeRequest(self.resource, firstRequest)
+        second = self.getElement("Simba")
+
+        @second.addCallback
+        def verify(_):
+            self._checkBadRequest(http.SERVICE_UNAVAILABLE)
+            retryAfter = self.request.responseHeaders.getRawHeaders(
+                "Retry-After")
+            self.assertEqual(retryAfter, ["1"])
+
+            self.collection.fire()
+            return first
+
+        @second.addCallback
+        def verifyFirst(_):
+            self.assertEqual(firstRequest.code, http.OK)
+            reads = self.collection.admissionControl.reads
+            self.assertEqual(reads.inFlight, 0)
+
+        return second
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test evaluating blocking attributes in threads.
+"""
+import threading
+import time
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+from twisted.web import http
+
+from txyoga import base
+from txyoga.test import util
+
+
+class Photo(base.Element):
+    """
+    A photo, whose thumbnail is computed by blocking.
+    """
+    exposedAttributes = "name", "thumbnail"
+    blockingAttributes = "thumbnail",
+
+    running = 0
+    mostRunning = 0
+    threads = []
+
+    def __init__(self, name):
+        self.name = name
+
+
+    def getSerializableAttribute(self, name):
+        if name != "thumbnail":
+            return base.Element.getSerializableAttribute(self, name)
+
+        cls = self.__class__
+        cls.threads.append(threading.current_thread())
+        cls.running += 1
+        cls.mostRunning = max(cls.mostRunning, cls.running)
+        time.sleep(0.05)
+        cls.running -= 1
+        return "thumbnail of " + self.name
+
+
+
+class Album(base.Collection):
+    """
+    A photo album.
+    """
+    exposedElementAttributes = Photo.exposedAttributes
+
+
+
+class BlockingAttributesMixin(util._BaseCollectionTest):
+    collectionClass = Album
+    elementClass = Photo
+    elementArgs = [("beach",), ("mountain",), ("city",)]
+
+    def setUp(self):
+        util._BaseCollectionTest.setUp(self)
+        self.addElements()
+        Photo.running = Photo.mostRunning = 0
+        Photo.threads = []
+
+
+
+class ElementStateTest(BlockingAttributesMixin, TestCase):
+    """
+    Tests exporting the state of elements with blocking attributes.
+    """
+    def test_blocking(self):
+        """
+        Blocking attributes are evaluated in a thread, and the state is
+        deferred.
+        """
+        d = Photo("beach").toState()
+        self.assertIsInstance(d, defer.Deferred)
+
+        @d.addCallback
+        def verify(state):
+            self.assertEqual(state, {"name": "beach",
+                                     "thumbnail": "thumbnail of beach"})
+            mainThread = threading.current_thread()
+            self.assertNotIn(mainThread, Photo.threads)
+
+        return d
+
+
+    def test_notBlocking(self):
+        """
+        Without blocking attributes, the state is returned directly.
+        """
+        state = Photo("beach").toState(["name"])
+        self.assertEqual(state, {"name": "beach"})
+
+
+
+class BlockingResourceTest(BlockingAttributesMixin, TestCase):
+    """
+    Tests displaying elements with blocking attributes.
+    """
+    def test_page(self):
+        """
+        The states of the elements on a page are gathered concurrently.
+        """
+        d = self.getElements()
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            thumbnails = [r["thumbnail"]
+                          for r in self.responseContent["results"]]
+            self.assertEqual(thumbnails, ["thumbnail of beach",
+                                          "thumbnail of mountain",
+                                          "thumbnail of city"])
+            self.assertTrue(Photo.mostRunning > 1)
+
+        return d
+
+
+    def test_element(self):
+        """
+        Elements with blocking attributes can be displayed.
+        """
+        d = self.getElement("city")
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.responseContent["thumbnail"],
+                             "thumbnail of city")
+
+        return d
+
+
+
+class ChangeListenerTest(BlockingAttributesMixin, TestCase):
+    """
+    Tests telling change listeners about changes to elements with blocking
+    attributes.
+    """
+    def setUp(self):
+        BlockingAttributesMixin.setUp(self)
+        self.changes = []
+        self.told = defer.Deferred()
+        self.collection.addChangeListener(self._changed)
+
+
+    def _changed(self, change):
+        self.changes.append(change)
+        if len(self.changes) == 2:
+            self.told.callback(None)
+
+
+    def test_inOrder(self):
+        """
+        Updated blocking attributes are exported in a thread, and changes
+        made in the meantime are held back, so that listeners get them in
+        order.
+        """
+        photo = self.collection._elementsByIdentifier["city"]
+        self.collection.elementUpdated(photo, ["thumbnail"])
+        self.collection.remove("beach")
+        self.assertEqual(self.changes, [])
+
+        @self.told.addCallback
+        def verify(_):
+            updated, removed = self.changes
+            self.assertEqual((updated.kind, updated.identifier),
+                             ("update", "city"))
+            self.assertEqual(updated.state,
+                             {"thumbnail": "thumbnail of city"})
+            self.assertEqual(removed.identifier, "beach")
+            self.assertNotIn(threading.current_thread(), Photo.threads)
+
+        return self.told
+
+
+    def test_notBlocking(self):
+        """
+        Listeners are told about changes without blocking attributes
+        right away.
+        """
+        self.collection.add(Photo("forest"))
+        self.assertEqual(self.changes[0].state, {"name": "forest"})
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test updating and removing many elements at once.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.web import http, http_headers
+
+from txyoga.serializers import json
+from txyoga.test import collections, util
+
+
+class BulkOperationsTest(collections.UpdatableCollectionMixin, TestCase):
+    """
+    Test bulk updates and removals on a collection of bikesheds.
+    """
+    def setUp(self):
+        collections.UpdatableCollectionMixin.setUp(self)
+        self.addElements()
+
+
+    def _bulkRequest(self, method, body):
+        headers = http_headers.Headers()
+        headers.setRawHeaders("Accept", ["application/json"])
+        headers.setRawHeaders("Content-Type", ["application/json"])
+        request = util._FakeRequest(method=method, body=json.dumps(body),
+                                    requestHeaders=headers)
+        d = self._makeRequest(self.resource, request)
+        d.addCallback(lambda _: self._decodeResponse())
+        return d
+
+
+    def _colors(self):
+        elements = self.collection._elements
+        return dict((element.name, element.color) for element in elements)
+
+
+    def test_updateByIdentifiers(self):
+        """
+        Elements can be updated by identifier; missing identifiers are
+        reported.
+        """
+        body = {"identifiers": ["north", "east", "bogus"],
+                "state": {"color": "black"}}
+        d = self._bulkRequest("PATCH", body)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            self.assertEqual(self.responseContent,
+                             {"updated": ["north", "east"],
+                              "missing": ["bogus"], "failed": {}})
+            self.assertEqual(self._colors(), {"north": "black",
+                                              "east": "black",
+                                              "south": "green",
+                                              "west": "yellow"})
+
+        return d
+
+
+    def test_updateByFilter(self):
+        """
+        Elements can be updated by the values of their attributes.
+        """
+        body = {"filter": {"color": "green"}, "state": {"color": "black"}}
+        d = self._bulkRequest("PATCH", body)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.responseContent["updated"], ["south"])
+            self.assertEqual(self._colors()["south"], "black")
+
+        return d
+
+
+    def test_updateFailures(self):
+        """
+        Elements that refuse an update are reported with their error.
+        """
+        body = {"identifiers": ["north"], "state": {"maximumOccupancy": 1}}
+        d = self._bulkRequest("PATCH", body)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.responseContent["updated"], [])
+            error = self.responseContent["failed"]["north"]
+            self.assertEqual(error["errorDetails"]["attribute"],
+                             "maximumOccupancy")
+
+        return d
+
+
+    def test_remove(self):
+        """
+        Elements can be removed by identifier and filter.
+        """
+        body = {"identifiers": ["north", "east", "bogus"],
+                "filter": {"color": "red"}}
+        d = self._bulkRequest("DELETE", body)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            self.assertEqual(self.responseContent,
+                             {"removed": ["north"], "missing": ["bogus"]})
+            self.assertEqual(self._colors(), {"east": "blue",
+                                              "south": "green",
+                                              "west": "yellow"})
+            self.assertNotIn("north", self.collection._elementsByIdentifier)
+
+        return d
+
+
+    def test_noSelection(self):
+        """
+        Bulk requests have to select some elements.
+        """
+        d = self._bulkRequest("DELETE", {})
+
+        @d.addCallback
+        def verify(_):
+            self._checkBadRequest(http.BAD_REQUEST)
+            self.assertEqual(len(self.collection._elements), 4)
+
+        return d
+
+
+    def test_noState(self):
+        """
+        Bulk updates have to specify a state.
+        """
+        d = self._bulkRequest("PATCH", {"identifiers": ["north"]})
+        d.addCallback(lambda _: self._checkBadRequest(http.BAD_REQUEST))
+        return d
+
+
+    def test_duplicateIdentifiers(self):
+        """
+        Elements whose identifiers are given more than once are removed
+        once.
+        """
+        body = {"identifiers": ["north", "north", "bogus", "bogus"]}
+        d = self._bulkRequest("DELETE", body)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            self.assertEqual(self.responseContent,
+                             {"removed": ["north"], "missing": ["bogus"]})
+            self.assertEqual(len(self.collection._elements), 3)
+
+        return d
+
+
+    def test_duplicateUpdates(self):
+        """
+        Elements whose identifiers are given more than once are updated
+        once.
+        """
+        updates = []
+        self.collection.addChangeListener(updates.append)
+        body = {"identifiers": ["north", "north"],
+                "state": {"color": "black"}}
+        d = self._bulkRequest("PATCH", body)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.responseContent["updated"], ["north"])
+            self.assertEqual(len(updates), 1)
+
+        return d
+
+
+    def test_unhashableIdentifiers(self):
+        """
+        Identifiers can't be lists or objects.
+        """
+        d = self._bulkRequest("DELETE", {"identifiers": [["north"]]})
+
+        @d.addCallback
+        def verify(_):
+            self._checkBadRequest(http.BAD_REQUEST)
+            self.assertEqual(len(self.collection._elements), 4)
+
+        return d
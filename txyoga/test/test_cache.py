@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test caching element lookups.
+"""
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from twisted.web import http
+
+from txyoga import cache, changes, errors
+from txyoga.test import collections
+
+
+class CountingJar(collections.Jar):
+    """
+    A cookie jar that counts how often it's asked for a cookie.
+    """
+    def __init__(self):
+        collections.Jar.__init__(self)
+        self.lookups = 0
+
+
+    def get(self, identifier):
+        self.lookups += 1
+        return collections.Jar.get(self, identifier)
+
+
+
+class SlowJar(collections.Jar):
+    """
+    A cookie jar that takes a while to add cookies, and doesn't report
+    the changes.
+    """
+    def __init__(self):
+        collections.Jar.__init__(self)
+        self.adding = []
+
+
+    def add(self, element):
+        d = defer.Deferred()
+        self.adding.append((element, d))
+        return d
+
+
+    def finishAdding(self):
+        for element, d in self.adding:
+            collections.Jar.add(self, element)
+            d.callback(None)
+
+
+
+class CachingCollectionTest(TestCase):
+    """
+    Tests for caching collections.
+    """
+    def setUp(self):
+        self.jar = CountingJar()
+        self.jar.add(collections.Cookie("butter"))
+        self.clock = task.Clock()
+        self.cache = cache.CachingCollection(self.jar, maximumSize=2,
+                                             timeToLive=10,
+                                             missingTimeToLive=1,
+                                             clock=self.clock)
+
+
+    def _get(self, identifier):
+        results = []
+        self.cache.get(identifier).addBoth(results.append)
+        return results[0]
+
+
+    def test_hit(self):
+        """
+        Elements are only looked up once while they're cached.
+        """
+        first, second = self._get("butter"), self._get("butter")
+        self.assertIdentical(first, second)
+        self.assertEqual(self.jar.lookups, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.hitRate, 0.5)
+
+
+    def test_expiry(self):
+        """
+        Cached elements are looked up again once they expire.
+        """
+        self._get("butter")
+        self.clock.advance(10)
+        self._get("butter")
+        self.assertEqual(self.jar.lookups, 2)
+
+
+    def test_missing(self):
+        """
+        Misses are cached too, but for a shorter time.
+        """
+        for _ in xrange(2):
+            failure = self._get("bogus")
+            failure.trap(errors.MissingElementError)
+        self.assertEqual(self.jar.lookups, 1)
+
+        self.clock.advance(1)
+        self._get("bogus").trap(errors.MissingElementError)
+        self.assertEqual(self.jar.lookups, 2)
+
+
+    def test_eviction(self):
+        """
+        The least recently used lookups are evicted to make room.
+        """
+        self.jar.add(collections.Cookie("gingerbread"))
+        self._get("butter")
+        self._get("gingerbread")
+        self._get("butter")
+        self._get("bogus").trap(errors.MissingElementError)
+        self.assertEqual(self.cache.evictions, 1)
+
+        self._get("butter")
+        self._get("gingerbread")
+        self.assertEqual(self.jar.lookups, 4)
+
+
+    def test_removeInvalidates(self):
+        """
+        Removing an element through the cache invalidates its lookup.
+        """
+        self._get("butter")
+        self.cache.remove("butter")
+        self._get("butter").trap(errors.MissingElementError)
+
+
+    def test_addInvalidates(self):
+        """
+        Adding an element through the cache invalidates a cached miss.
+        """
+        self._get("gingerbread").trap(errors.MissingElementError)
+        self.cache.add(collections.Cookie("gingerbread"))
+        self.assertEqual(self._get("gingerbread").name, "gingerbread")
+
+
+    def test_slowAddInvalidates(self):
+        """
+        Lookups made while an element is being added aren't cached past
+        the add.
+        """
+        jar = SlowJar()
+        self.cache = cache.CachingCollection(jar, clock=self.clock)
+        jar.removeChangeListener(self.cache._changed)
+
+        d = self.cache.add(collections.Cookie("gingerbread"))
+        self._get("gingerbread").trap(errors.MissingElementError)
+        jar.finishAdding()
+        self.successResultOf(d)
+        self.assertEqual(self._get("gingerbread").name, "gingerbread")
+
+
+    def test_removeManyInvalidates(self):
+        """
+        Removing many elements through the cache invalidates their lookups.
+        """
+        self._get("butter")
+        self.cache.removeMany(filter={"name": "butter"})
+        self._get("butter").trap(errors.MissingElementError)
+
+
+    def test_changesInvalidate(self):
+        """
+        Changes the wrapped collection reports invalidate the lookups of
+        the changed elements, even when they weren't made through the
+        cache.
+        """
+        self._get("butter")
+        self.jar.applyChange(changes.Change(changes.REMOVED, "butter"))
+        self._get("butter").trap(errors.MissingElementError)
+
+
+
+class CachingResourceTest(collections.SimpleCollectionMixin, TestCase):
+    """
+    Tests that caching collections can be published like any other.
+    """
+    def collectionClass(self):
+        return cache.CachingCollection(CountingJar(), clock=task.Clock())
+
+
+    def test_getElement(self):
+        """
+        Elements can be retrieved through a caching collection.
+        """
+        self.resource.maximumCachedRoutes = 0
+        self.addElements()
+        d = self.getElement("butter")
+        d.addCallback(lambda _: self.getElement("butter"))
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            self.assertEqual(self.collection.hits, 1)
+
+        return d
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test telling listeners about changes to collections, and applying them.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.web import http, http_headers
+
+from txyoga import changes
+from txyoga.serializers import json
+from txyoga.test import collections
+
+
+class ChangeListenerTest(collections.UpdatableCollectionMixin, TestCase):
+    """
+    Tests that collections tell their listeners about changes.
+    """
+    def setUp(self):
+        collections.UpdatableCollectionMixin.setUp(self)
+        self.addElements()
+        self.changes = []
+        self.collection.addChangeListener(self.changes.append)
+
+
+    def _summary(self):
+        return [(c.kind, c.identifier, c.state) for c in self.changes]
+
+
+    def test_add(self):
+        """
+        Added elements come with the state to create them again.
+        """
+        self.collection.add(collections.Bikeshed("central", "white"))
+        self.assertEqual(self._summary(),
+                         [("add", "central",
+                           {"name": "central", "color": "white"})])
+
+
+    def test_remove(self):
+        """
+        Removed elements are reported.
+        """
+        self.collection.remove("north")
+        self.collection.removeMany(["east", "bogus"])
+        self.assertEqual(self._summary(), [("remove", "north", None),
+                                           ("remove", "east", None)])
+
+
+    def test_updateMany(self):
+        """
+        Updated elements are reported with their updated attributes.
+        """
+        self.collection.updateMany({"color": "black"}, ["north"])
+        self.assertEqual(self._summary(),
+                         [("update", "north", {"color": "black"})])
+
+
+    def test_updateThroughResource(self):
+        """
+        Element resources tell their collection about updates.
+        """
+        headers = http_headers.Headers()
+        headers.setRawHeaders("Content-Type", ["application/json"])
+        body = json.dumps({"color": "black"})
+        d = self.updateElement("north", body, headers)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            self.assertEqual(self._summary(),
+                             [("update", "north", {"color": "black"})])
+
+        return d
+
+
+    def test_withoutState(self):
+        """
+        When no listener wants the states of changed elements, they aren't
+        exported.
+        """
+        self.collection.removeChangeListener(self.changes.append)
+        self.collection.addChangeListener(self.changes.append,
+                                          withState=False)
+        shed = collections.Bikeshed("central", "white")
+        self.patch(shed, "getCreationState", None)
+        self.collection.add(shed)
+        self.collection.updateMany({"color": "black"}, ["north"])
+        self.assertEqual(self._summary(), [("add", "central", None),
+                                           ("update", "north", None)])
+
+
+    def test_removeListener(self):
+        """
+        Removed listeners aren't told about changes anymore.
+        """
+        self.collection.removeChangeListener(self.changes.append)
+        self.collection.remove("north")
+        self.assertEqual(self.changes, [])
+
+
+
+class ApplyChangeTest(collections.UpdatableCollectionMixin, TestCase):
+    """
+    Tests applying changes to collections.
+    """
+    def setUp(self):
+        collections.UpdatableCollectionMixin.setUp(self)
+        self.addElements()
+        self.changes = []
+        self.collection.addChangeListener(self.changes.append)
+
+
+    def _apply(self, kind, identifier, state=None):
+        change = changes.Change(kind, identifier, state)
+        self.collection.applyChange(change)
+
+
+    def test_add(self):
+        """
+        Added elements are created from their state.
+        """
+        self._apply("add", "central", {"name": "central", "color": "white"})
+        element = self.collection._elementsByIdentifier["central"]
+        self.assertEqual(element.color, "white")
+        self.assertEqual(len(self.changes), 1)
+
+
+    def test_addExisting(self):
+        """
+        Adding an element that's already there updates it.
+        """
+        self._apply("add", "north", {"name": "north", "color": "black"})
+        self.assertEqual(self.collection._elementsByIdentifier["north"].color,
+                         "black")
+        self.assertEqual([(c.kind, c.state) for c in self.changes],
+                         [("update", {"color": "black"})])
+
+
+    def test_update(self):
+        """
+        Updates are applied, even to attributes that can't be updated
+        through the API.
+        """
+        self._apply("update", "north", {"maximumOccupancy": 1})
+        element = self.collection._elementsByIdentifier["north"]
+        self.assertEqual(element.maximumOccupancy, 1)
+
+
+    def test_noChange(self):
+        """
+        Changes that don't change anything aren't reported.
+        """
+        self._apply("update", "north", {"color": "red"})
+        self._apply("update", "bogus", {"color": "red"})
+        self._apply("remove", "bogus")
+        self.assertEqual(self.changes, [])
+
+
+    def test_remove(self):
+        """
+        Removed elements are removed.
+        """
+        self._apply("remove", "north")
+        self.assertNotIn("north", self.collection._elementsByIdentifier)
+        self.assertEqual(len(self.changes), 1)
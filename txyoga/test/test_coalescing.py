@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test coalescing concurrent identical reads.
+"""
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+from twisted.web import http
+
+from txyoga import coalescing, errors
+from txyoga.test import collections, util
+
+
+class CoalescerTest(TestCase):
+    """
+    Tests for the coalescer itself.
+    """
+    def setUp(self):
+        self.coalescer = coalescing.Coalescer()
+        self.pending = []
+
+
+    def _operation(self):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+    def test_coalesce(self):
+        """
+        Identical concurrent operations are performed once, and all of them
+        get the result.
+        """
+        first = self.coalescer.call("key", self._operation)
+        second = self.coalescer.call("key", self._operation)
+        self.assertEqual(len(self.pending), 1)
+        self.assertEqual(self.coalescer.calls, 1)
+        self.assertEqual(self.coalescer.coalesced, 1)
+
+        self.pending[0].callback("result")
+        d = defer.gatherResults([first, second])
+        d.addCallback(self.assertEqual, ["result", "result"])
+        return d
+
+
+    def test_differentKeys(self):
+        """
+        Operations with different keys aren't coalesced.
+        """
+        self.coalescer.call("a", self._operation)
+        self.coalescer.call("b", self._operation)
+        self.assertEqual(len(self.pending), 2)
+        self.assertEqual(self.coalescer.coalesced, 0)
+
+
+    def test_failure(self):
+        """
+        Failures are passed to everything waiting for the operation.
+        """
+        first = self.coalescer.call("key", self._operation)
+        second = self.coalescer.call("key", self._operation)
+        self.pending[0].errback(errors.MissingElementError("key"))
+
+        for d in [first, second]:
+            self.assertFailure(d, errors.MissingElementError)
+        return defer.gatherResults([first, second])
+
+
+    def test_finished(self):
+        """
+        Once an operation has finished, the next one is performed anew.
+        """
+        self.coalescer.call("key", self._operation)
+        self.pending[0].callback(None)
+        self.coalescer.call("key", self._operation)
+        self.assertEqual(len(self.pending), 2)
+
+
+    def test_synchronous(self):
+        """
+        Operations that produce their result immediately are never
+        coalesced.
+        """
+        self.coalescer.call("key", defer.succeed, 1)
+        self.coalescer.call("key", defer.succeed, 1)
+        self.assertEqual(self.coalescer.calls, 2)
+        self.assertEqual(self.coalescer.coalesced, 0)
+
+
+
+class SlowZoo(collections.Zoo):
+    """
+    A zoo that takes a while to look up its animals.
+    """
+    def __init__(self):
+        collections.Zoo.__init__(self)
+        self.pending = []
+        self.cancelled = 0
+
+
+    def get(self, identifier):
+        return self._defer(collections.Zoo.get(self, identifier))
+
+
+    def query(self, start, stop):
+        return self._defer(collections.Zoo.query(self, start, stop))
+
+
+    def _defer(self, result):
+        d = defer.Deferred(self._cancel)
+        self.pending.append((d, result))
+        return d
+
+
+    def _cancel(self, d):
+        self.cancelled += 1
+
+
+    def fire(self):
+        pending, self.pending = self.pending, []
+        for d, result in pending:
+            result.chainDeferred(d)
+
+
+
+class CoalescingResourceTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests that collection resources coalesce concurrent identical reads.
+    """
+    collectionClass = SlowZoo
+
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+
+
+    def _render(self, path=()):
+        request = util._FakeRequest(requestHeaders=util.correctAcceptHeaders)
+        resource = self.resource
+        for childName in path:
+            resource = resource.getChildWithDefault(childName, request)
+        return self._makeRequest(resource, request), request
+
+
+    def test_element(self):
+        """
+        Concurrent GETs for the same element look it up once.
+        """
+        first, firstRequest = self._render(["Simba"])
+        second, secondRequest = self._render(["Simba"])
+
+        self.assertEqual(len(self.collection.pending), 1)
+        self.collection.fire()
+
+        d = defer.gatherResults([first, second])
+
+        @d.addCallback
+        def verify(_):
+            for request in [firstRequest, secondRequest]:
+                self.assertEqual(request.code, http.OK)
+            coalescer = self.resource.coalescer
+            self.assertEqual((coalescer.calls, coalescer.coalesced), (1, 1))
+
+        return d
+
+
+    def test_page(self):
+        """
+        Concurrent GETs for the same page query the collection once.
+        """
+        first, _ = self._render()
+        second, request = self._render()
+
+        self.assertEqual(len(self.collection.pending), 1)
+        self.collection.fire()
+
+        @second.addCallback
+        def verify(_):
+            self._decodeResponse()
+            names = [r["name"] for r in self.responseContent["results"]]
+            self.assertEqual(names, ["Pumbaa", "Simba", "Timon"])
+
+        return defer.gatherResults([first, second])
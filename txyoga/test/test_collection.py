@@ -7,9 +7,9 @@ from twisted.internet import defer
 from twisted.trial.unittest import TestCase
 from twisted.web.resource import IResource
 
-from txyoga import base, errors
+from txyoga import base, errors, resource
 from txyoga.interface import ICollection
-from txyoga.test import collections
+from txyoga.test import collections, util
 
 
 class CollectionTest(TestCase):
@@ -63,6 +63,82 @@ class ElementChildTest(collections.ElementChildMixin, TestCase):
 
 
 
+class SlowJar(collections.Jar):
+    """
+    A cookie jar that takes a while to produce its cookies.
+    """
+    def __init__(self):
+        collections.Jar.__init__(self)
+        self.pending = []
+
+
+    def get(self, identifier):
+        d = defer.Deferred()
+        self.pending.append((d, identifier))
+        return d
+
+
+    def fire(self):
+        """
+        Fires all of the pending lookups.
+        """
+        pending, self.pending = self.pending, []
+        for d, identifier in pending:
+            d.callback(self._elementsByIdentifier[identifier])
+
+
+
+class ChildLookupTest(collections.SimpleCollectionMixin, TestCase):
+    """
+    Test how collection resources look up their children.
+    """
+    def test_synchronousLookup(self):
+        """
+        When the collection already has the element available, the element
+        resource is returned directly.
+        """
+        self.addElements()
+        name, = self.elementArgs[0]
+        child = self.resource.getChild(name, util._FakeRequest())
+        self.assertIsInstance(child, resource.ElementResource)
+
+
+
+class AsynchronousChildLookupTest(collections.SimpleCollectionMixin,
+                                  TestCase):
+    """
+    Test how collection resources look up children that their collection
+    doesn't have available yet.
+    """
+    collectionClass = SlowJar
+
+    def setUp(self):
+        collections.SimpleCollectionMixin.setUp(self)
+        self.addElements()
+
+
+    def test_asynchronousLookup(self):
+        """
+        When the collection doesn't have the element available yet, a
+        deferred resource is returned, which can still be rendered.
+        """
+        name, = self.elementArgs[0]
+        request = util._FakeRequest(requestHeaders=util.correctAcceptHeaders)
+        child = self.resource.getChild(name, request)
+        self.assertIsInstance(child, resource.DeferredResource)
+
+        d = self._makeRequest(child, request)
+        self.collection.fire()
+
+        @d.addCallback
+        def verify(_):
+            self._decodeResponse()
+            self.assertEqual(self.responseContent, {})
+
+        return d
+
+
+
 class UnpaginatedCollectionTest(collections.SimpleCollectionMixin, TestCase):
     """
     Test some generic invariants for collections small enough to fit
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test storing the state of elements compactly.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.web import http, http_headers
+
+from txyoga import compact, errors
+from txyoga.serializers import json, jsonEncode
+from txyoga.test import collections
+
+
+class CountedBikeshed(collections.Bikeshed):
+    """
+    A bikeshed that counts how often one is constructed.
+    """
+    constructed = 0
+
+    def __init__(self, name, color):
+        collections.Bikeshed.__init__(self, name, color)
+        CountedBikeshed.constructed += 1
+
+
+
+class LoudBikeshed(CountedBikeshed):
+    """
+    A bikeshed whose color is computed.
+    """
+    def getSerializableAttribute(self, name):
+        value = CountedBikeshed.getSerializableAttribute(self, name)
+        if name == "color":
+            return value.upper()
+        return value
+
+
+
+class PaintedBikeshed(CountedBikeshed):
+    """
+    A bikeshed that remembers who painted it.
+    """
+    def paint(self, color, painter):
+        self.color = color
+        self.painter = painter
+
+
+
+class CompactProject(compact.CompactCollection):
+    exposedElementAttributes = "name", "color"
+    defaultElementClass = CountedBikeshed
+
+
+
+class CompactElementTest(TestCase):
+    """
+    Tests compactly stored elements.
+    """
+    def setUp(self):
+        self.collection = CompactProject()
+        self.collection.add(CountedBikeshed("north", "red"))
+        self.collection.add(LoudBikeshed("south", "green"))
+        self.north = self.collection._elementsByIdentifier["north"]
+        self.south = self.collection._elementsByIdentifier["south"]
+        CountedBikeshed.constructed = 0
+
+
+    def test_stored(self):
+        """
+        Elements are stored compactly, and their attributes still work.
+        """
+        self.assertIsInstance(self.north, compact.CompactElement)
+        self.assertEqual(self.north.name, "north")
+        self.assertEqual(self.north.maximumOccupancy, 100)
+        self.assertEqual(self.north.updatableAttributes, ("color",))
+        self.assertEqual(CountedBikeshed.constructed, 0)
+
+
+    def test_toState(self):
+        """
+        The state comes straight from the stored attributes.
+        """
+        self.assertEqual(self.north.toState(),
+                         {"color": "red", "maximumOccupancy": 100})
+        self.assertEqual(CountedBikeshed.constructed, 0)
+
+
+    def test_customAttributes(self):
+        """
+        Elements that compute their own attributes are constructed to get
+        their state.
+        """
+        self.assertEqual(self.south.toState(["color"]), {"color": "GREEN"})
+        self.assertEqual(CountedBikeshed.constructed, 1)
+
+
+    def test_update(self):
+        """
+        Updated elements store their new state.
+        """
+        self.successResultOf(self.north.update({"color": "black"}))
+        self.assertEqual(self.north.color, "black")
+        self.assertEqual(self.north.toState(["color"]), {"color": "black"})
+
+
+    def test_refusedUpdate(self):
+        """
+        Refused updates don't change the stored state.
+        """
+        d = self.north.update({"maximumOccupancy": 1})
+        self.failureResultOf(d, errors.AttributeValueUpdateError)
+        self.assertEqual(self.north.maximumOccupancy, 100)
+
+
+    def test_toElement(self):
+        """
+        Constructed elements have the stored state, even the parts their
+        constructor didn't set.
+        """
+        self.north.maximumOccupancy = 10
+        element = self.north.toElement()
+        self.assertIsInstance(element, CountedBikeshed)
+        self.assertEqual((element.name, element.color,
+                          element.maximumOccupancy), ("north", "red", 10))
+
+
+    def test_extraState(self):
+        """
+        Instance attributes that the constructor doesn't give an element
+        are kept.
+        """
+        shed = CountedBikeshed("west", "blue")
+        shed.painter = "Tom"
+        self.collection.add(shed)
+        west = self.collection._elementsByIdentifier["west"]
+        self.assertEqual(west.painter, "Tom")
+        west.painter = "Huck"
+        self.assertEqual(west.toElement().painter, "Huck")
+
+
+    def test_methods(self):
+        """
+        Changes made by the element's own methods are stored.
+        """
+        self.collection.add(PaintedBikeshed("west", "blue"))
+        west = self.collection._elementsByIdentifier["west"]
+        west.paint("white", "Tom")
+        self.assertEqual((west.color, west.painter), ("white", "Tom"))
+
+
+    def test_encodedState(self):
+        """
+        The encoded state is kept until the stored state changes.
+        """
+        body = self.north.getEncodedState(jsonEncode)
+        self.assertEqual(json.loads(body),
+                         {"color": "red", "maximumOccupancy": 100})
+        self.assertIdentical(self.north.getEncodedState(jsonEncode), body)
+
+        self.successResultOf(self.north.update({"color": "black"}))
+        body = self.north.getEncodedState(jsonEncode)
+        self.assertEqual(json.loads(body)["color"], "black")
+        self.assertEqual(CountedBikeshed.constructed, 1)
+
+
+    def test_encodedComputedState(self):
+        """
+        Elements that compute their own attributes have no encoded state.
+        """
+        self.assertIdentical(self.south.getEncodedState(jsonEncode), None)
+
+
+    def test_notStored(self):
+        """
+        Attributes that aren't stored can't be set.
+        """
+        self.assertRaises(AttributeError, setattr, self.north, "size", 1)
+
+
+
+class CompactResourceTest(collections.UpdatableCollectionMixin, TestCase):
+    """
+    Tests serving compactly stored elements.
+    """
+    collectionClass = CompactProject
+    elementClass = CountedBikeshed
+
+    def setUp(self):
+        collections.UpdatableCollectionMixin.setUp(self)
+        self.addElements()
+        CountedBikeshed.constructed = 0
+
+
+    def test_page(self):
+        """
+        Pages are served without constructing elements.
+        """
+        d = self.getElements()
+
+        @d.addCallback
+        def verify(_):
+            results = self.responseContent["results"]
+            self.assertEqual(results[0], {"name": "north", "color": "red"})
+            self.assertEqual(len(results), 4)
+            self.assertEqual(CountedBikeshed.constructed, 0)
+
+        return d
+
+
+    def test_element(self):
+        """
+        Elements are served from their encoded state.
+        """
+        north = self.collection._elementsByIdentifier["north"]
+        d = self.getElement("north")
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.responseContent,
+                             {"color": "red", "maximumOccupancy": 100})
+            self.assertNotIdentical(north._encoded, None)
+            self.assertEqual(CountedBikeshed.constructed, 0)
+
+        return d
+
+
+    def test_updateElement(self):
+        """
+        Elements can be updated through their resource.
+        """
+        headers = http_headers.Headers()
+        headers.setRawHeaders("Content-Type", ["application/json"])
+        body = json.dumps({"color": "black"})
+        d = self.updateElement("north", body, headers)
+        d.addCallback(lambda _: self.getElement("north"))
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            self.assertEqual(self.responseContent["color"], "black")
+
+        return d
+
+
+
+class CompactChildrenTest(TestCase):
+    """
+    Tests compactly stored elements with children.
+    """
+    def setUp(self):
+        self.world = compact.CompactCollection()
+        self.world.add(collections.State("oceania",
+                                         collections.Ministries()))
+        self.oceania = self.world._elementsByIdentifier["oceania"]
+
+
+    def test_children(self):
+        """
+        Children are stored, so that changes to them are kept.
+        """
+        ministries = self.oceania.ministries
+        self.assertIdentical(self.oceania.ministries, ministries)
+
+        ministries.add(collections.Ministry("Minitrue"))
+        d = self.oceania.ministries.get("Minitrue")
+        self.assertEqual(self.successResultOf(d).name, "Minitrue")
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test counting elements, and getting the headers of resources.
+"""
+from twisted.trial.unittest import TestCase
+
+from txyoga.test import collections, util
+
+
+class CountTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests counting the elements in a collection.
+    """
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+
+
+    def test_count(self):
+        """
+        All elements are counted.
+        """
+        count = self.successResultOf(self.collection.count())
+        self.assertEqual(count, len(self.elementArgs))
+
+
+    def test_filter(self):
+        """
+        With a filter, only the matching elements are counted.
+        """
+        d = self.collection.count(filter={"species": "hyena"})
+        self.assertEqual(self.successResultOf(d), 3)
+
+
+
+class TotalTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests the totals in pages of collections.
+    """
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+
+
+    def _header(self, name):
+        return self.request.responseHeaders.getRawHeaders(name)
+
+
+    def test_total(self):
+        """
+        Pages have the number of elements in the collection.
+        """
+        d = self.getElements()
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.responseContent["total"], 8)
+            self.assertEqual(self._header("X-Total-Count"), ["8"])
+            self.assertEqual(self._header("ETag"), ['W/"8"'])
+
+        return d
+
+
+    def test_fullLastPage(self):
+        """
+        A full last page doesn't link to a next page.
+        """
+        d = self.getElements({"start": ["4"], "stop": ["8"]})
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(len(self.responseContent["results"]), 4)
+            self.assertIdentical(self.responseContent["next"], None)
+
+        return d
+
+
+
+class HeadTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests getting the headers of collections and elements.
+    """
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+
+
+    def _head(self, path=()):
+        request = util._FakeRequest(method="HEAD",
+                                    requestHeaders=util.correctAcceptHeaders)
+        resource = self.resource
+        for childName in path:
+            resource = resource.getChildWithDefault(childName, request)
+        return self._makeRequest(resource, request)
+
+
+    def _header(self, name):
+        return self.request.responseHeaders.getRawHeaders(name)
+
+
+    def test_collection(self):
+        """
+        Collections have a count, an ETag and a content type, but no body.
+        No elements are exported.
+        """
+        self.patch(collections.Animal, "toState", None)
+        d = self._head()
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self._header("X-Total-Count"), ["8"])
+            self.assertEqual(self._header("ETag"), ['W/"8"'])
+            self._checkContentType()
+            self.assertEqual(self.request._responseContent.read(), "")
+
+        return d
+
+
+    def test_element(self):
+        """
+        Elements have the ETag of their last change, without being
+        exported.
+        """
+        self.patch(collections.Animal, "toState", None)
+        d = self._head(["Simba"])
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self._header("ETag"), ['W/"2"'])
+            self._checkContentType()
+            self.assertEqual(self.request._responseContent.read(), "")
+
+        return d
+
+
+    def test_elementChanged(self):
+        """
+        Elements get a new ETag when they change.
+        """
+        self.collection.remove("Simba")
+        self.collection.add(collections.Animal("Simba", "lion", "bugs"))
+        d = self._head(["Simba"])
+        d.addCallback(lambda _: self.assertEqual(self._header("ETag"),
+                                                 ['W/"10"']))
+        return d
@@ -84,6 +84,16 @@ class ElementCreationTest(collections.ElementCreationMixin):
         return self._test_createElement(http.UNSUPPORTED_MEDIA_TYPE)
 
 
+    def test_tooLarge(self):
+        """
+        Tests that creating an element with a body larger than the
+        resource accepts fails.
+        """
+        self.headers.setRawHeaders("Content-Type", ["application/json"])
+        self.resource.maximumBodySize = len(self.requestBody) - 1
+        return self._test_createElement(http.REQUEST_ENTITY_TOO_LARGE)
+
+
 
 class POSTElementCreationTest(ElementCreationTest, TestCase):
     method = "POST"
@@ -99,3 +109,51 @@ class PUTElementCreationTest(ElementCreationTest, TestCase):
         self.newElementName = "BOGUS"
         self._test_createElement(http.FORBIDDEN)
         del self.newElementName
+
+
+
+class BulkCreationTest(collections.ElementCreationMixin, TestCase):
+    """
+    Test creating many elements with a single POST.
+    """
+    newElementNames = ["shortbread", "macaroon", "snickerdoodle"]
+
+    def setUp(self):
+        collections.ElementCreationMixin.setUp(self)
+        self.headers = http_headers.Headers()
+        self.headers.setRawHeaders("Content-Type", ["application/json"])
+
+
+    def test_createElements(self):
+        """
+        Posting an array of states creates an element for each of them.
+        """
+        states = [{"name": name} for name in self.newElementNames]
+        d = self.createElement(None, json.dumps(states), self.headers, "POST")
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.CREATED)
+            elements = self.collection._elements
+            names = [element.name for element in elements]
+            self.assertEqual(names, self.newElementNames)
+
+        return d
+
+
+    def test_duplicateElement(self):
+        """
+        Posting an array of states containing a duplicate element fails,
+        after the elements preceding the duplicate have been added.
+        """
+        states = [{"name": "shortbread"}, {"name": "shortbread"}]
+        d = self.createElement(None, json.dumps(states), self.headers, "POST")
+
+        @d.addCallback
+        def verify(_):
+            self._decodeResponse()
+            self._checkBadRequest(http.FORBIDDEN)
+            names = [element.name for element in self.collection._elements]
+            self.assertEqual(names, ["shortbread"])
+
+        return d
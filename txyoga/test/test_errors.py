@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Tests for error reporting.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.web import http, http_headers
+
+from txyoga import errors
+from txyoga.serializers import json, jsonEncode
+from txyoga.test import collections, util
+
+
+class QuickFailureTest(TestCase):
+    """
+    Tests for cheap failures of expected errors.
+    """
+    def test_trap(self):
+        """
+        Quick failures can be trapped like regular failures, including by
+        the parent classes of their exception.
+        """
+        d = errors.quickFail(errors.MissingElementError("x"))
+        self.assertFailure(d, errors.SerializableError)
+
+        @d.addCallback
+        def verify(exception):
+            self.assertEqual(exception.details, {"identifier": "x"})
+
+        return d
+
+
+    def test_noTraceback(self):
+        """
+        Quick failures don't capture any traceback state.
+        """
+        failure = errors._QuickFailure(errors.MissingElementError("x"))
+        self.assertIdentical(failure.tb, None)
+        self.assertEqual(failure.frames, [])
+        self.assertEqual(failure.stack, [])
+
+
+
+class RESTErrorPageTest(TestCase):
+    """
+    Tests for rendering serializable errors.
+    """
+    def setUp(self):
+        self.addCleanup(errors.RESTErrorPage._cachedBodies.clear)
+
+
+    def _render(self, exception):
+        request = util._FakeRequest()
+        page = errors.RESTErrorPage(exception, jsonEncode)
+        body = page.render(request)
+        return request, body
+
+
+    def test_defaultEncoder(self):
+        """
+        When the request has no encoder, the default encoder is used.
+        """
+        request, body = self._render(errors.PaginationError("bad page"))
+        self.assertEqual(request.code, http.BAD_REQUEST)
+        self.assertEqual(request.responseHeaders.getRawHeaders("Content-Type"),
+                         ["application/json"])
+        self.assertEqual(json.loads(body), {"errorMessage": "bad page",
+                                            "errorDetails": {}})
+
+
+    def test_cachedBody(self):
+        """
+        Errors without details produce the same body every time, so it is
+        only encoded once.
+        """
+        _, first = self._render(errors.PaginationError("bad page"))
+        _, second = self._render(errors.PaginationError("bad page"))
+        self.assertIdentical(first, second)
+
+
+    def test_cachedDetails(self):
+        """
+        Bodies of errors with details are cached by their details.
+        """
+        _, first = self._render(errors.MissingElementError("x"))
+        _, second = self._render(errors.MissingElementError("x"))
+        _, other = self._render(errors.MissingElementError("y"))
+        self.assertIdentical(first, second)
+        self.assertEqual(json.loads(other)["errorDetails"],
+                         {"identifier": "y"})
+
+
+    def test_cachedPerEncoder(self):
+        """
+        Bodies are cached per encoder, even for encoders with the same
+        content type.
+        """
+        def otherEncoder(obj):
+            return "other"
+        otherEncoder.contentType = jsonEncode.contentType
+
+        _, first = self._render(errors.PaginationError("bad page"))
+        request = util._FakeRequest()
+        request.encoder = otherEncoder
+        page = errors.RESTErrorPage(errors.PaginationError("bad page"))
+        self.assertEqual(page.render(request), "other")
+        self.assertNotEqual(first, "other")
+
+
+    def test_leastRecentlyUsedEvicted(self):
+        """
+        Only the most recently used bodies are cached.
+        """
+        self.patch(errors.RESTErrorPage, "maxCachedBodies", 2)
+        self._render(errors.PaginationError("first"))
+        self._render(errors.PaginationError("second"))
+        self._render(errors.PaginationError("first"))
+        self._render(errors.PaginationError("third"))
+
+        messages = [m for _, _, m, _ in errors.RESTErrorPage._cachedBodies]
+        self.assertEqual(messages, ["first", "third"])
+
+
+
+class MissingElementLookupTest(collections.SimpleCollectionMixin, TestCase):
+    """
+    Tests for looking up missing elements.
+    """
+    def test_errorPage(self):
+        """
+        Looking up a missing element in a collection that reports misses
+        immediately produces the error page directly.
+        """
+        child = self.resource.getChild("bogus", util._FakeRequest())
+        self.assertIsInstance(child, errors.RESTErrorPage)
+        self.assertIsInstance(child.exception, errors.MissingElementError)
+
+
+    def test_belowMissingElement(self):
+        """
+        Paths below a missing element get the encoded error for the
+        missing element, not a generic page.
+        """
+        d = self._getResource(path=["bogus", "crumbs"])
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.NOT_FOUND)
+            self.assertEqual(self.responseContent["errorMessage"],
+                             "missing element")
+
+        return d
+
+
+
+class UnexpectedErrorTest(collections.UpdatableCollectionMixin, TestCase):
+    """
+    Tests for reporting unexpected errors.
+    """
+    def setUp(self):
+        collections.UpdatableCollectionMixin.setUp(self)
+        self.addElements()
+
+
+    def test_internalServerError(self):
+        """
+        Unexpected errors are logged, and reported as internal server
+        errors without their details.
+        """
+        headers = http_headers.Headers()
+        headers.setRawHeaders("Content-Type", ["application/json"])
+        body = json.dumps({"bogus": 1}) # Updating it raises AttributeError
+        d = self.updateElement("north", body, headers)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(len(self.flushLoggedErrors(AttributeError)), 1)
+            self._decodeResponse()
+            self._checkBadRequest(http.INTERNAL_SERVER_ERROR)
+            self.assertEqual(self.responseContent["errorMessage"],
+                             "internal server error")
+            self.assertEqual(self.responseContent["errorDetails"], {})
+
+        return d
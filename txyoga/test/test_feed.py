@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test change logs, and following the changes to collections.
+"""
+from twisted.internet import defer, error, task
+from twisted.trial.unittest import TestCase
+from twisted.web import http, http_headers, server
+
+from txyoga import changes, errors
+from txyoga.serializers import json
+from txyoga.test import collections, util
+
+
+class ChangeLogTest(TestCase):
+    """
+    Tests recording changes and getting them again.
+    """
+    def setUp(self):
+        self.log = changes.ChangeLog(maximumSize=3)
+
+
+    def _record(self, *identifiers):
+        for identifier in identifiers:
+            self.log.record(changes.Change(changes.REMOVED, identifier))
+
+
+    def test_since(self):
+        """
+        Changes are numbered, and can be gotten after any sequence number.
+        """
+        self._record("a", "b")
+        self.assertEqual(self.log.last, 2)
+        self.assertEqual([c.sequence for c in self.log.since(0)], [1, 2])
+        self.assertEqual([c.identifier for c in self.log.since(1)], ["b"])
+        self.assertEqual(self.log.since(2), [])
+
+
+    def test_gap(self):
+        """
+        Asking for changes that were forgotten is an error.
+        """
+        self._record("a", "b", "c", "d")
+        self.assertEqual([c.identifier for c in self.log.since(1)],
+                         ["b", "c", "d"])
+        e = self.assertRaises(errors.ChangesUnavailableError,
+                              self.log.since, 0)
+        self.assertEqual(e.details, {"since": 0, "oldest": 2})
+        self.assertFailure(self.log.wait(0), errors.ChangesUnavailableError)
+
+
+    def test_unknown(self):
+        """
+        Asking for changes after sequence numbers the log never handed out
+        is an error.
+        """
+        self._record("a")
+        for sequence in [2, -1]:
+            self.assertRaises(errors.ChangesUnavailableError,
+                              self.log.since, sequence)
+            self.assertFailure(self.log.wait(sequence),
+                               errors.ChangesUnavailableError)
+
+
+    def test_wait(self):
+        """
+        Waiting for changes fires as soon as there are some.
+        """
+        self._record("a")
+        self.assertEqual(len(self.successResultOf(self.log.wait(0))), 1)
+
+        d = self.log.wait(1)
+        self.assertNoResult(d)
+        self._record("b")
+        self.assertEqual([c.identifier for c in self.successResultOf(d)],
+                         ["b"])
+
+
+    def test_cancel(self):
+        """
+        Cancelled waits aren't fired anymore.
+        """
+        d = self.log.wait(0)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self._record("a")
+        self.assertEqual(self.log._waiters, [])
+
+
+
+class LockedBikeshed(collections.Bikeshed):
+    """
+    A bikeshed with a password, which isn't exposed.
+    """
+    def __init__(self, name, color, password):
+        collections.Bikeshed.__init__(self, name, color)
+        self.password = password
+
+
+
+class ExposingProject(collections.SoftwareProject):
+    """
+    A software project that exposes the attributes of its bikesheds.
+    """
+    exposedElementAttributes = collections.Bikeshed.exposedAttributes
+
+
+
+class _FeedMixin(collections.UpdatableCollectionMixin):
+    collectionClass = ExposingProject
+
+    def setUp(self):
+        collections.UpdatableCollectionMixin.setUp(self)
+        self.addElements()
+        self.feed = self.resource.getChildWithDefault("_changes", None)
+        self.clock = self.feed.clock = task.Clock()
+        self.changeLog = self.feed.changeLog
+        self.first = self.collection.version + 1
+
+
+    def forgetChanges(self):
+        """
+        Makes the change log of the collection keep only one change.
+        """
+        self.changeLog = changes.ChangeLog(maximumSize=1,
+                                           last=self.collection.version)
+        changes._changeLogs[self.collection] = self.changeLog
+        self.collection.addChangeListener(self.changeLog.record)
+
+
+
+class LongPollTest(_FeedMixin, TestCase):
+    """
+    Tests long-polling for changes.
+    """
+    def _poll(self, args=None):
+        request = util._FakeRequest(args=args,
+                                    requestHeaders=util.correctAcceptHeaders)
+        d = self._makeRequest(self.feed, request)
+        d.addCallback(lambda _: self._decodeResponse())
+        return d
+
+
+    def test_available(self):
+        """
+        Changes that already happened are returned right away.
+        """
+        self.collection.remove("north")
+        self.collection.remove("east")
+        d = self._poll({"since": [str(self.first)]})
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.responseContent, {
+                "changes": [{"type": "remove", "identifier": "east",
+                             "state": None, "sequence": self.first + 1}],
+                "last": self.first + 1})
+
+        return d
+
+
+    def test_wait(self):
+        """
+        Without changes, the response waits for the next one.
+        """
+        d = self._poll()
+        self.assertFalse(self.request._finished)
+        self.collection.updateMany({"color": "black"}, ["north"])
+
+        @d.addCallback
+        def verify(_):
+            change, = self.responseContent["changes"]
+            self.assertEqual(change["state"], {"color": "black"})
+            self.assertEqual(self.responseContent["last"], self.first)
+            self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        return d
+
+
+    def test_exposedAttributes(self):
+        """
+        Changes only have the exposed attributes of elements.
+        """
+        self.collection.add(LockedBikeshed("shed", "red", "sesame"))
+        d = self._poll({"since": [str(self.first - 1)]})
+
+        @d.addCallback
+        def verify(_):
+            change, = self.responseContent["changes"]
+            self.assertEqual(change["state"], {"color": "red"})
+
+        return d
+
+
+    def test_timeout(self):
+        """
+        Without changes before the timeout, the response has none.
+        """
+        d = self._poll({"since": [str(self.first - 1)], "timeout": ["5"]})
+        self.clock.advance(5)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            self.assertEqual(self.responseContent,
+                             {"changes": [], "last": self.first - 1})
+
+        return d
+
+
+    def test_maximumTimeout(self):
+        """
+        Timeouts are capped.
+        """
+        self.feed.maximumPollTimeout = 10
+        d = self._poll({"timeout": ["1000"]})
+        self.clock.advance(10)
+        return d
+
+
+    def test_disconnect(self):
+        """
+        Clients that go away stop waiting.
+        """
+        d = self._poll()
+        self.request.disconnect()
+        self.assertEqual(self.changeLog._waiters, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        return self.assertFailure(d, error.ConnectionLost)
+
+
+    def test_unavailable(self):
+        """
+        Asking for changes that were forgotten fails with 410 Gone.
+        """
+        self.forgetChanges()
+        self.collection.remove("north")
+        self.collection.remove("east")
+        d = self._poll({"since": [str(self.first - 1)]})
+        d.addCallback(lambda _: self._checkBadRequest(http.GONE))
+        return d
+
+
+    def test_unknownSince(self):
+        """
+        Asking for changes after a sequence number that hasn't happened
+        fails with 410 Gone, instead of waiting.
+        """
+        d = self._poll({"since": [str(self.first)]})
+        d.addCallback(lambda _: self._checkBadRequest(http.GONE))
+        return d
+
+
+    def test_badSince(self):
+        """
+        Sequence numbers have to be integers.
+        """
+        d = self._poll({"since": ["yesterday"]})
+        d.addCallback(lambda _: self._checkBadRequest(http.BAD_REQUEST))
+        return d
+
+
+
+class EventStreamTest(_FeedMixin, TestCase):
+    """
+    Tests following changes as Server-Sent Events.
+    """
+    def _stream(self, args=None, lastEventID=None):
+        headers = http_headers.Headers()
+        headers.setRawHeaders("Accept", ["text/event-stream"])
+        if lastEventID is not None:
+            headers.setRawHeaders("Last-Event-ID", [lastEventID])
+        self.request = util._FakeRequest(args=args, requestHeaders=headers)
+        return self.feed.render(self.request)
+
+
+    def _written(self):
+        return self.request._responseContent.getvalue()
+
+
+    def _events(self):
+        events = []
+        for block in self._written().split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.split("\n")
+                          if line and not line.startswith(":"))
+            if fields:
+                events.append((int(fields["id"]), fields["event"],
+                               json.loads(fields["data"])))
+        return events
+
+
+    def test_stream(self):
+        """
+        Changes are sent as events, as they happen.
+        """
+        self.assertIdentical(self._stream(), server.NOT_DONE_YET)
+        headers = self.request.responseHeaders
+        self.assertEqual(headers.getRawHeaders("Content-Type"),
+                         ["text/event-stream"])
+
+        self.collection.remove("north")
+        self.collection.updateMany({"color": "black"}, ["east"])
+        first, second = self.first, self.first + 1
+        self.assertEqual(self._events(), [
+            (first, "remove", {"type": "remove", "identifier": "north",
+                               "state": None, "sequence": first}),
+            (second, "update", {"type": "update", "identifier": "east",
+                                "state": {"color": "black"},
+                                "sequence": second})])
+
+
+    def test_exposedAttributes(self):
+        """
+        Changes only have the exposed attributes of elements.
+        """
+        self._stream()
+        self.collection.add(LockedBikeshed("shed", "red", "sesame"))
+        (_, _, change), = self._events()
+        self.assertEqual(change["state"], {"color": "red"})
+
+
+    def test_lastEventID(self):
+        """
+        Reconnecting clients get the changes they missed.
+        """
+        self.collection.remove("north")
+        self.collection.remove("east")
+        self._stream(lastEventID=str(self.first))
+        self.assertEqual([e[0] for e in self._events()], [self.first + 1])
+
+
+    def test_heartbeat(self):
+        """
+        Comments are sent regularly to keep the connection open.
+        """
+        self._stream()
+        written = len(self._written())
+        self.clock.advance(self.feed.heartbeatInterval)
+        self.assertEqual(self._written()[written:], ":\n\n")
+
+
+    def test_disconnect(self):
+        """
+        Streams stop when the client goes away.
+        """
+        self._stream()
+        self.request.disconnect()
+        self.assertEqual(self.changeLog._waiters, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_unavailable(self):
+        """
+        Asking for changes that were forgotten fails with 410 Gone.
+        """
+        self.forgetChanges()
+        self.collection.remove("north")
+        self.collection.remove("east")
+        body = self._stream(lastEventID="0")
+        self.assertEqual(self.request.code, http.GONE)
+        self.assertIn("errorMessage", json.loads(body))
+
+
+
+class ReservedIdentifierTest(_FeedMixin, TestCase):
+    """
+    Tests that elements can't be hidden by the change feed.
+    """
+    def test_add(self):
+        """
+        Elements can't have the name of the change feed as their
+        identifier.
+        """
+        headers = http_headers.Headers()
+        headers.setRawHeaders("Accept", ["application/json"])
+        headers.setRawHeaders("Content-Type", ["application/json"])
+        body = json.dumps({"name": "_changes", "color": "red"})
+        d = self.createElement("_changes", body, headers, method="POST")
+
+        @d.addCallback
+        def verify(_):
+            self._decodeResponse()
+            self._checkBadRequest(http.FORBIDDEN)
+            self.assertEqual(self.responseContent["errorMessage"],
+                             "reserved identifier")
+            self.assertNotIn("_changes",
+                             self.collection._elementsByIdentifier)
+
+        return d
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test embedding the children of elements.
+"""
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from twisted.web import http
+
+from txyoga import admission, tracing
+from txyoga.test import collections
+
+
+class IncludeTest(collections.ElementChildMixin, TestCase):
+    """
+    Tests embedding child collections in elements and pages.
+    """
+    def setUp(self):
+        collections.ElementChildMixin.setUp(self)
+        self.addElements()
+        self.queries = []
+
+        for element in self.collection._elements:
+            self.patch(element.ministries, "query", self._query(element))
+
+
+    def _query(self, element):
+        query = element.ministries.query
+        def recordingQuery(start, stop):
+            self.queries.append((element.name, start, stop))
+            return query(start, stop)
+        return recordingQuery
+
+
+    def _names(self, page):
+        return [state["name"] for state in page["results"]]
+
+
+    def test_element(self):
+        """
+        An element has the first page of an included child collection.
+        """
+        d = self.getElement("oceania", {"include": ["ministries"]})
+
+        @d.addCallback
+        def verify(_):
+            ministries = self.responseContent["ministries"]
+            self.assertEqual(self._names(ministries),
+                             collections.ministryNames)
+            self.assertIdentical(ministries["next"], None)
+            self.assertEqual(self.responseContent["name"], "oceania")
+
+        return d
+
+
+    def test_page(self):
+        """
+        Every element on a page has its included children, queried once
+        per element.
+        """
+        d = self.getElements({"include": ["ministries"]})
+
+        @d.addCallback
+        def verify(_):
+            results = self.responseContent["results"]
+            pages = [self._names(state["ministries"]) for state in results]
+            self.assertEqual(pages, [collections.ministryNames, [], []])
+            self.assertEqual(len(self.queries), 3)
+
+        return d
+
+
+    def test_pageSize(self):
+        """
+        Embedded pages are no larger than the child's page size, and link
+        to the next page.
+        """
+        oceania = self.collection._elementsByIdentifier["oceania"]
+        self.patch(oceania.ministries, "pageSize", 3)
+        d = self.getElement("oceania", {"include": ["ministries"]})
+
+        @d.addCallback
+        def verify(_):
+            page = self.responseContent["ministries"]
+            self.assertEqual(self._names(page), collections.ministryNames[:3])
+            self.assertEqual(page["next"], "http://localhost/ministries"
+                                           "?start=3&stop=6")
+
+        return d
+
+
+    def test_admission(self):
+        """
+        Embedded pages have to be admitted by the admission control of
+        the child collection.
+        """
+        oceania = self.collection._elementsByIdentifier["oceania"]
+        control = admission.AdmissionControl(maximumReads=0)
+        oceania.ministries.admissionControl = control
+        self.addCleanup(delattr, oceania.ministries, "admissionControl")
+        d = self.getElement("oceania", {"include": ["ministries"]})
+
+        @d.addCallback
+        def verify(_):
+            self._checkBadRequest(http.SERVICE_UNAVAILABLE)
+            self.assertEqual(self.queries, [])
+            self.assertEqual(control.reads.shed, 1)
+
+        return d
+
+
+    def test_traced(self):
+        """
+        Queries for embedded pages are traced.
+        """
+        exporter = tracing.InMemoryExporter()
+        self.resource.tracer = tracing.Tracer(exporter, task.Clock())
+        d = self.getElement("oceania", {"include": ["ministries"]})
+
+        @d.addCallback
+        def verify(_):
+            names = [span.name for span in exporter.spans]
+            self.assertEqual(names.count("query"), 1)
+
+        return d
+
+
+    def test_notAChild(self):
+        """
+        Only children can be included.
+        """
+        d = self.getElement("oceania", {"include": ["name"]})
+
+        @d.addCallback
+        def verify(_):
+            self._checkBadRequest(http.BAD_REQUEST)
+            self.assertEqual(self.responseContent["errorDetails"],
+                             {"child": "name"})
+            self.assertEqual(self.queries, [])
+
+        return d
+
+
+    def test_noInclude(self):
+        """
+        Without ``include``, children aren't queried.
+        """
+        d = self.getElements()
+        d.addCallback(lambda _: self.assertEqual(self.queries, []))
+        return d
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test monitoring reactor lag.
+"""
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from txyoga import lag, resource
+from txyoga.test import collections
+
+
+class LagMonitorTest(TestCase):
+    """
+    Tests measuring reactor lag.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.monitor = lag.LagMonitor(interval=1, threshold=0.5,
+                                      clock=self.clock)
+        self.monitor.start()
+        self.addCleanup(self.monitor.stop)
+        zoo = collections.Zoo()
+        self.resource = resource.CollectionResource(zoo)
+        self.operation = lag.Operation("query", self.resource, "GET", zoo, 3)
+
+
+    def _stall(self, seconds):
+        self.clock.rightNow += seconds
+
+
+    def test_noLag(self):
+        """
+        Calls that run on time aren't stalls.
+        """
+        self.clock.pump([1, 1])
+        self.assertEqual(self.monitor.lastLag, 0)
+        self.assertEqual(self.monitor.stalls, 0)
+
+
+    def test_lag(self):
+        """
+        Calls that run late by at least the threshold are stalls.
+        """
+        self.clock.advance(1.25)
+        self.assertEqual(self.monitor.lastLag, 0.25)
+        self.assertEqual(self.monitor.stalls, 0)
+
+        self.clock.advance(2)
+        self.assertEqual(self.monitor.lastLag, 1)
+        self.assertEqual(self.monitor.maximumLag, 1)
+        self.assertEqual(self.monitor.stalls, 1)
+
+        stall, = self.monitor.recentStalls
+        self.assertIdentical(stall.operation, None)
+        self.assertIn("no monitored operation", str(stall))
+
+
+    def test_attribution(self):
+        """
+        Stalls are attributed to the operation that ran longest.
+        """
+        self.monitor.running(self.operation, self._stall, 2)
+        self.clock.advance(0)
+
+        stall, = self.monitor.recentStalls
+        self.assertEqual(stall.lag, 1)
+        self.assertIdentical(stall.operation, self.operation)
+        self.assertEqual(stall.duration, 2)
+        self.assertEqual(str(stall),
+                         "Reactor stalled for 1.000s: query of 3 elements "
+                         "of Zoo for GET on CollectionResource, which took "
+                         "2.000s")
+
+
+    def test_nested(self):
+        """
+        Operations aren't held accountable for the operations they run.
+        """
+        outer = lag.Operation("render", self.resource, "GET")
+
+        def render():
+            self._stall(0.5)
+            self.monitor.running(self.operation, self._stall, 1)
+
+        self.monitor.running(outer, render)
+        self.clock.advance(0)
+
+        stall, = self.monitor.recentStalls
+        self.assertIdentical(stall.operation, self.operation)
+
+
+    def test_forget(self):
+        """
+        Operations are only held accountable for the next stall.
+        """
+        self.monitor.running(self.operation, self._stall, 0.25)
+        self.clock.advance(1)
+        self._stall(2)
+        self.clock.advance(0)
+
+        stall, = self.monitor.recentStalls
+        self.assertIdentical(stall.operation, None)
+
+
+
+class StallingZoo(collections.Zoo):
+    """
+    A zoo that takes a while to query its animals, without ever letting
+    the reactor do anything else.
+    """
+    def __init__(self, clock):
+        collections.Zoo.__init__(self)
+        self.clock = clock
+
+
+    def query(self, start, stop):
+        self.clock.rightNow += 1
+        return collections.Zoo.query(self, start, stop)
+
+
+
+class ResourceLagTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests that resources tell their lag monitor about operations.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.collectionClass = lambda: StallingZoo(self.clock)
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+
+        self.monitor = lag.LagMonitor(interval=0.1, threshold=0.5,
+                                      clock=self.clock)
+        self.monitor.start()
+        self.addCleanup(self.monitor.stop)
+        self.resource.lagMonitor = self.monitor
+
+
+    def test_query(self):
+        """
+        Stalls during requests are attributed to the collection's
+        operations.
+        """
+        d = self.getElements()
+
+        @d.addCallback
+        def verify(_):
+            self.clock.advance(0)
+            stall, = self.monitor.recentStalls
+            operation = stall.operation
+            self.assertEqual(operation.name, "query")
+            self.assertEqual(operation.resource, "CollectionResource")
+            self.assertEqual(operation.collection, "StallingZoo")
+            self.assertEqual(operation.method, "GET")
+
+        return d
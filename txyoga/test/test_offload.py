@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test offloading encoding and decoding to worker processes.
+"""
+import cPickle as pickle
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from twisted.web import http, http_headers
+
+from txyoga import errors, offload, serializers
+from txyoga.serializers import json
+from txyoga.test import collections
+
+
+def unpicklable(_):
+    return lambda: None
+
+
+def exit(_):
+    raise SystemExit()
+
+
+
+class ProcessPoolTest(TestCase):
+    """
+    Tests for the process pool, with a real worker process.
+    """
+    def setUp(self):
+        self.pool = offload.ProcessPool(1)
+        self.pool.start()
+        self.addCleanup(self.pool.close)
+
+
+    def test_encode(self):
+        """
+        Objects can be encoded in a worker process.
+        """
+        d = self.pool.encode(serializers.jsonEncode, {"a": [1, 2]})
+        d.addCallback(self.assertEqual, '{"a": [1, 2]}')
+        return d
+
+
+    def test_decode(self):
+        """
+        Request bodies can be decoded in a worker process.
+        """
+        d = self.pool.decode(serializers.jsonDecode, '{"a": [1, 2]}')
+        d.addCallback(self.assertEqual, {"a": [1, 2]})
+        return d
+
+
+    def test_failure(self):
+        """
+        Exceptions raised in the worker process are passed back.
+        """
+        d = self.pool.decode(serializers.jsonDecode, "ZALGO")
+        return self.assertFailure(d, ValueError)
+
+
+    def test_unpicklableResult(self):
+        """
+        Results that can't be passed back are reported as errors.
+        """
+        d = self.pool.call(unpicklable, None)
+        return self.assertFailure(d, pickle.PicklingError)
+
+
+    def test_unpicklableFunction(self):
+        """
+        Functions that can't be passed to a worker process fail right
+        away.
+        """
+        d = self.pool.call(lambda: None)
+        return self.assertFailure(d, pickle.PicklingError)
+
+
+    def test_exit(self):
+        """
+        Exceptions that would stop the worker process are passed back.
+        """
+        d = self.pool.call(exit, None)
+        return self.assertFailure(d, SystemExit)
+
+
+
+class StartTest(TestCase):
+    """
+    Tests starting process pools.
+    """
+    def test_notStarted(self):
+        """
+        Calls to pools that aren't started fail.
+        """
+        pool = offload.ProcessPool()
+        d = pool.encode(serializers.jsonEncode, {})
+        self.failureResultOf(d, RuntimeError)
+
+
+    def test_reactorRunning(self):
+        """
+        Pools can't be started once the reactor runs, since their worker
+        processes would be forked from it.
+        """
+        clock = task.Clock()
+        clock.running = True
+        pool = offload.ProcessPool(reactor=clock)
+        self.assertRaises(RuntimeError, pool.start)
+        self.assertIdentical(pool._pool, None)
+
+
+
+
+class LostCallTest(TestCase):
+    """
+    Tests calls whose worker process died.
+    """
+    def test_timeout(self):
+        """
+        Calls that never return time out.
+        """
+        clock = task.Clock()
+        pool = offload.ProcessPool(reactor=clock, timeout=5)
+        pool._pool = LosingPool()
+
+        d = pool.call(serializers.jsonEncode, {})
+        clock.advance(5)
+        reason = self.failureResultOf(d, errors.GatewayTimeoutError)
+        self.assertEqual(reason.value.details,
+                         {"operation": "jsonEncode", "timeout": 5})
+
+
+
+class LosingPool(object):
+    """
+    A pool whose worker processes die before they return anything.
+    """
+    def apply_async(self, f, args, callback):
+        pass
+
+
+
+class InProcessPool(offload.ProcessPool):
+    """
+    A process pool that does its work in this process, right away.
+    """
+    def __init__(self):
+        offload.ProcessPool.__init__(self)
+        self.calls = []
+
+
+    def call(self, f, *args):
+        self.calls.append(f)
+        d = defer.Deferred()
+        pickled = pickle.dumps(f, pickle.HIGHEST_PROTOCOL)
+        offload._fire(d, offload._capture(pickled, offload._dumps(args)))
+        return d
+
+
+
+class PageEncodingTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests that collection resources encode large pages with their
+    process pool.
+    """
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+        self.pool = self.resource.processPool = InProcessPool()
+
+
+    def test_smallPage(self):
+        """
+        Small pages are encoded on the reactor thread.
+        """
+        d = self.getElements()
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            self.assertEqual(self.pool.calls, [])
+
+        return d
+
+
+    def test_largePage(self):
+        """
+        Large pages are encoded by the process pool.
+        """
+        self.resource.minimumOffloadedPageSize = 3
+        d = self.getElements()
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.pool.calls, [serializers.jsonEncode])
+            names = [r["name"] for r in self.responseContent["results"]]
+            self.assertEqual(names, ["Pumbaa", "Simba", "Timon"])
+
+        return d
+
+
+
+class BodyDecodingTest(collections.ElementCreationMixin, TestCase):
+    """
+    Tests that collection resources decode large request bodies with
+    their process pool.
+    """
+    def setUp(self):
+        collections.ElementCreationMixin.setUp(self)
+        self.pool = self.resource.processPool = InProcessPool()
+        self.headers = http_headers.Headers()
+        self.headers.setRawHeaders("Content-Type", ["application/json"])
+
+
+    def test_smallBody(self):
+        """
+        Small request bodies are decoded on the reactor thread.
+        """
+        body = json.dumps(self.newElementState)
+        d = self.createElement(self.newElementName, body, self.headers)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.CREATED)
+            self.assertEqual(self.pool.calls, [])
+
+        return d
+
+
+    def test_largeBody(self):
+        """
+        Large request bodies are decoded by the process pool.
+        """
+        self.resource.minimumOffloadedBodySize = 0
+        states = [{"name": "shortbread"}, {"name": "macaroon"}]
+        body = json.dumps(states)
+        d = self.createElement(None, body, self.headers, "POST")
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.CREATED)
+            self.assertEqual(self.pool.calls, [offload._decode])
+            names = [e.name for e in self.collection._elements]
+            self.assertEqual(names, ["shortbread", "macaroon"])
+
+        return d
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test profiling a sample of requests.
+"""
+import os
+import pstats
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from twisted.web import http_headers
+
+from txyoga import profiling, resource
+from txyoga.test import collections, util
+from txyoga.test.test_coalescing import SlowZoo
+
+
+class ShouldProfileTest(TestCase):
+    """
+    Tests choosing which requests to profile.
+    """
+    def setUp(self):
+        self.draws = [0.5]
+        self.profiler = profiling.Profiler(self.mktemp(), sampleRate=0.6,
+                                           random=self.draws.pop)
+        self.resource = resource.CollectionResource(collections.Zoo())
+
+
+    def _request(self, path="/", headers=None):
+        return util._FakeRequest(path=path, requestHeaders=headers)
+
+
+    def test_sampleRate(self):
+        """
+        Requests are profiled with the sample rate's probability.
+        """
+        self.assertTrue(self.profiler.shouldProfile(self.resource,
+                                                    self._request()))
+        self.draws.append(0.7)
+        self.assertFalse(self.profiler.shouldProfile(self.resource,
+                                                     self._request()))
+
+
+    def test_resourceClasses(self):
+        """
+        Only requests for the given resource classes are profiled.
+        """
+        self.profiler.resourceClasses = (resource.ElementResource,)
+        self.assertFalse(self.profiler.shouldProfile(self.resource,
+                                                     self._request()))
+
+
+    def test_pathPrefixes(self):
+        """
+        Only requests for the given paths are profiled.
+        """
+        self.profiler.pathPrefixes = ("/zoo",)
+        request = self._request("/world")
+        self.assertFalse(self.profiler.shouldProfile(self.resource, request))
+        request = self._request("/zoo/Simba")
+        self.assertTrue(self.profiler.shouldProfile(self.resource, request))
+
+
+    def test_secret(self):
+        """
+        Requests with the secret in the header are always profiled.
+        """
+        self.profiler.secret = "sesame"
+        self.profiler.sampleRate = 0
+
+        headers = http_headers.Headers()
+        headers.setRawHeaders("X-Profile", ["sesame"])
+        request = self._request(headers=headers)
+        self.assertTrue(self.profiler.shouldProfile(self.resource, request))
+
+        headers.setRawHeaders("X-Profile", ["open"])
+        request = self._request(headers=headers)
+        self.assertFalse(self.profiler.shouldProfile(self.resource, request))
+
+
+    def test_compareInConstantTime(self):
+        """
+        Without ``hmac.compare_digest``, secrets are still compared.
+        """
+        compare = profiling._compareInConstantTime
+        self.assertTrue(compare("sesame", "sesame"))
+        self.assertFalse(compare("sesame", "sesamE"))
+        self.assertFalse(compare("sesame", "sesame!"))
+        self.assertFalse(compare("", "sesame"))
+
+
+    def test_oneAtATime(self):
+        """
+        Requests aren't profiled while another one is.
+        """
+        self.profiler._profiling = True
+        self.assertFalse(self.profiler.shouldProfile(self.resource,
+                                                     self._request()))
+
+
+
+class ProfileTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests profiling requests.
+    """
+    collectionClass = SlowZoo
+
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.clock = task.Clock()
+        self.profiler = profiling.Profiler(self.directory, sampleRate=1,
+                                           clock=self.clock)
+        self.resource.profiler = self.profiler
+
+
+    def _stats(self):
+        path = os.path.join(self.directory, "CollectionResource.GET.pstats")
+        stats = pstats.Stats(path)
+        return dict((function, stat[:4])
+                    for (_, _, function), stat in stats.stats.iteritems())
+
+
+    def test_profile(self):
+        """
+        Requests are profiled until they are finished, including the
+        callbacks that run later.
+        """
+        d = self.getElements()
+        self.assertTrue(self.profiler._profiling)
+        self.collection.fire()
+
+        d.addCallback(lambda _: self.profiler._written)
+
+        @d.addCallback
+        def verify(_):
+            self.assertFalse(self.profiler._profiling)
+            stats = self._stats()
+            self.assertIn("render_GET", stats)
+            self.assertIn("_encodeResponse", stats)
+            folded = os.path.join(self.directory,
+                                  "CollectionResource.GET.folded")
+            self.assertTrue(os.path.exists(folded))
+
+        return d
+
+
+    def test_maximumDuration(self):
+        """
+        Requests that take too long, like long polls, are only profiled
+        for the maximum duration.
+        """
+        d = self.getElements()
+        self.clock.advance(self.profiler.maximumDuration)
+        self.assertFalse(self.profiler._profiling)
+        self.collection.fire()
+
+        d.addCallback(lambda _: self.profiler._written)
+
+        @d.addCallback
+        def verify(_):
+            calls, _, _, _ = self._stats()["render_GET"]
+            self.assertEqual(calls, 1)
+            self.assertNotIn("_encodeResponse", self._stats())
+            self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        return d
+
+
+    def test_aggregated(self):
+        """
+        Profiles of requests for the same resource class and method are
+        aggregated.
+        """
+        d = self.getElements()
+        self.collection.fire()
+
+        @d.addCallback
+        def getAgain(_):
+            d = self.getElements()
+            self.collection.fire()
+            return d
+
+        d.addCallback(lambda _: self.profiler._written)
+
+        @d.addCallback
+        def verify(_):
+            calls, _, _, _ = self._stats()["render_GET"]
+            self.assertEqual(calls, 2)
+
+        return d
+
+
+    def test_unwritable(self):
+        """
+        Profiles that can't be written are logged, and don't keep later
+        ones from being written.
+        """
+        self.profiler.directory = os.path.join(self.directory, "missing")
+        d = self.getElements()
+        self.collection.fire()
+        d.addCallback(lambda _: self.profiler._written)
+
+        @d.addCallback
+        def getAgain(_):
+            self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+            self.profiler.directory = self.directory
+            d = self.getElements()
+            self.collection.fire()
+            return d
+
+        d.addCallback(lambda _: self.profiler._written)
+
+        @d.addCallback
+        def verify(_):
+            calls, _, _, _ = self._stats()["render_GET"]
+            self.assertEqual(calls, 2)
+
+        return d
+
+
+    def test_child(self):
+        """
+        Resources that wait for elements profile with the same profiler.
+        """
+        request = util._FakeRequest(requestHeaders=util.correctAcceptHeaders)
+        child = self.resource.getChildWithDefault("Simba", request)
+        self.assertIsInstance(child, resource.DeferredResource)
+        self.assertIdentical(child.profiler, self.profiler)
+        self.collection.fire()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test resolving paths through collections, elements and their children.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.web import http
+
+from txyoga import changes, errors
+from txyoga.test import collections, util
+
+
+class RoutingTest(collections.ElementChildMixin, TestCase):
+    """
+    Tests that resources along paths are reused.
+    """
+    def setUp(self):
+        collections.ElementChildMixin.setUp(self)
+        self.addElements()
+
+
+    def _route(self, *path):
+        """
+        Resolves a whole path, like ``twisted.web`` would.
+        """
+        request = util._FakeRequest(requestHeaders=util.correctAcceptHeaders)
+        request.postpath = list(path)
+        resource = self.resource
+        while request.postpath and not resource.isLeaf:
+            childName = request.postpath.pop(0)
+            request.prepath.append(childName)
+            resource = resource.getChildWithDefault(childName, request)
+        self.assertEqual(request.prepath, list(path))
+        return resource
+
+
+    def _resolve(self, *path):
+        request = util._FakeRequest(requestHeaders=util.correctAcceptHeaders)
+        resource = self.resource
+        for childName in path:
+            resource = resource.getChildWithDefault(childName, request)
+        return resource
+
+
+    def test_elementResource(self):
+        """
+        Elements get the same resource every time.
+        """
+        first = self._resolve("oceania")
+        self.assertIdentical(self._resolve("oceania"), first)
+        self.assertIdentical(first.collection, self.collection)
+
+
+    def test_childResource(self):
+        """
+        Children of elements get the same resource every time.
+        """
+        first = self._resolve("oceania", "ministries")
+        second = self._resolve("oceania", "ministries")
+        self.assertIdentical(first, second)
+        self.assertIdentical(self._resolve("oceania", "ministries",
+                                           "Minitrue").collection,
+                             first._collection)
+
+
+    def test_replacedElement(self):
+        """
+        An element that was replaced by another one with the same
+        identifier gets a new resource.
+        """
+        first = self._resolve("oceania")
+        self.collection.remove("oceania")
+        self.collection.add(collections.State("oceania",
+                                              collections.Ministries()))
+        self.assertNotIdentical(self._resolve("oceania"), first)
+
+
+    def test_deleted(self):
+        """
+        Deleting an element forgets its resource.
+        """
+        self._resolve("oceania")
+        d = self.deleteElement("oceania")
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.NO_CONTENT)
+            self.assertNotIn("oceania", self.resource._elementResources)
+
+        return d
+
+
+    def test_removedElsewhere(self):
+        """
+        Removing an element other than through the resource forgets its
+        resource too.
+        """
+        self._resolve("oceania")
+        self._resolve("eurasia")
+        self.collection.removeMany(["oceania"])
+        self.collection.applyChange(changes.Change(changes.REMOVED,
+                                                   "eurasia"))
+        self.assertEqual(list(self.resource._elementResources), [])
+
+
+    def test_maximumCachedResources(self):
+        """
+        Only the resources of the most recently requested elements are
+        kept.
+        """
+        self.resource.maximumCachedResources = 2
+        for name in ["oceania", "eurasia", "eastasia"]:
+            self._resolve(name)
+        self.assertEqual(list(self.resource._elementResources),
+                         ["eurasia", "eastasia"])
+
+
+    def test_notAChild(self):
+        """
+        Only declared children can be traversed to.
+        """
+        d = self.getElementChild("oceania", "name")
+        d.addCallback(lambda _: self._checkBadRequest(http.NOT_FOUND))
+        return d
+
+
+    def test_notAChildBelow(self):
+        """
+        Paths below something that isn't a child get the encoded error for
+        the missing child.
+        """
+        d = self._getResource(path=["oceania", "name", "x"])
+
+        @d.addCallback
+        def verify(_):
+            self._checkBadRequest(http.NOT_FOUND)
+            self.assertEqual(self.responseContent["errorMessage"],
+                             "missing child")
+
+        return d
+
+
+
+class RouteTest(collections.ElementChildMixin, TestCase):
+    """
+    Tests that reading requests for paths that were read before are
+    resolved in one step.
+    """
+    def setUp(self):
+        collections.ElementChildMixin.setUp(self)
+        self.addElements()
+        self.ministries = collections.Ministries()
+        for name in collections.ministryNames:
+            self.ministries.add(collections.Ministry(name))
+        self.oceania = self.collection._elementsByIdentifier["oceania"]
+        self.oceania.ministries = self.ministries
+        self.path = "oceania", "ministries", "Minitrue"
+
+
+    def _route(self, path, method="GET"):
+        request = util._FakeRequest(method=method,
+                                    requestHeaders=util.correctAcceptHeaders)
+        request.postpath = list(path[1:])
+        request.prepath = [path[0]]
+        resource = self.resource.getChildWithDefault(path[0], request)
+        return resource, request
+
+
+    def test_route(self):
+        """
+        Paths that were read before resolve to the same resource at once.
+        """
+        first, _ = self._route(self.path)
+        self.assertIn(self.path, self.resource._routes)
+
+        self.patch(self.collection, "get", None)
+        second, request = self._route(self.path)
+        self.assertIdentical(second, first)
+        self.assertEqual(request.prepath, list(self.path))
+        self.assertEqual(request.postpath, [])
+
+
+    def test_notRead(self):
+        """
+        Only paths of reading requests are kept.
+        """
+        self._route(self.path, method="PUT")
+        self.assertEqual(list(self.resource._routes), [])
+
+
+    def test_removed(self):
+        """
+        Routes through removed elements aren't used anymore.
+        """
+        self._route(self.path)
+        self.ministries.removeMany(["Minitrue"])
+        resource, _ = self._route(self.path)
+        self.assertIsInstance(resource.exception, errors.MissingElementError)
+
+
+    def test_replaced(self):
+        """
+        Routes through elements that were removed and added again are
+        resolved again.
+        """
+        first, _ = self._route(self.path)
+        self.collection.applyChange(changes.Change(changes.REMOVED,
+                                                   "oceania"))
+        self.collection.add(self.oceania)
+        second, _ = self._route(self.path)
+        self.assertNotIdentical(second, first)
+        self.assertIdentical(second.collection, self.ministries)
+
+
+    def test_replacedChild(self):
+        """
+        Routes through children that were replaced aren't used anymore.
+        """
+        self._route(self.path)
+        self.oceania.ministries = collections.Ministries()
+        resource, _ = self._route(self.path)
+        self.assertIsInstance(resource.exception, errors.MissingElementError)
+
+
+    def test_maximumCachedRoutes(self):
+        """
+        Only the routes of the most recently read paths are kept.
+        """
+        self.resource.maximumCachedRoutes = 2
+        for name in ["oceania", "eurasia", "eastasia"]:
+            self._route([name])
+        self.assertEqual(list(self.resource._routes),
+                         [("eurasia",), ("eastasia",)])
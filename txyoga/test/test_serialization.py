@@ -3,10 +3,19 @@
 """
 Tests for basic class serialization and deserialization.
 """
+from StringIO import StringIO
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from twisted.trial.unittest import TestCase
+from twisted.web import http, http_headers
 
+from txyoga import errors, serializers
 from txyoga.base import Collection, Element
-from txyoga.serializers import jsonEncode
+from txyoga.serializers import jsonDecode, jsonEncode, jsonIterDecode
+from txyoga.test import collections, util
 
 
 class Screwdriver(Element):
@@ -97,3 +106,268 @@ class JSONEncoderTests(TestCase):
         TypeError instead of failing silently.
         """
         self.assertRaises(TypeError, jsonEncode, object())
+
+
+
+class JSONIncrementalDecoderTests(TestCase):
+    """
+    Test incremental JSON decoding.
+    """
+    def _decode(self, body):
+        return list(jsonIterDecode(StringIO(body), chunkSize=3))
+
+
+    def test_array(self):
+        """
+        The items of an array are decoded one by one, even when they span
+        multiple chunks.
+        """
+        body = '[{"head": "philips", "size": "m3"}, 12345, "flat" ]'
+        expected = [{"head": "philips", "size": "m3"}, 12345, "flat"]
+        self.assertEqual(self._decode(body), expected)
+
+
+    def test_strings(self):
+        """
+        Brackets, quotes and escapes in strings don't end items early,
+        even when they are split across chunks.
+        """
+        expected = [{"a": "]}\"\\"}, ["[\\", "{"], "x\\\"y,"]
+        body = serializers.json.dumps(expected)
+        self.assertEqual(self._decode(body), expected)
+
+
+    def test_largeItem(self):
+        """
+        Items that span many chunks are decoded once, not once per chunk.
+        """
+        decodes = []
+        decoder = serializers.json.JSONDecoder
+
+        class CountingDecoder(decoder):
+            def raw_decode(self, s, *args, **kwargs):
+                decodes.append(len(s))
+                return decoder.raw_decode(self, s, *args, **kwargs)
+
+        self.patch(serializers.json, "JSONDecoder", CountingDecoder)
+        item = {"values": range(1000)}
+        body = serializers.json.dumps([item, 1])
+        self.assertEqual(self._decode(body), [item, 1])
+        self.assertEqual(len(decodes), 2)
+
+
+    def test_emptyArray(self):
+        """
+        An empty array decodes to no items.
+        """
+        self.assertEqual(self._decode(" [ ] "), [])
+
+
+    def test_object(self):
+        """
+        Something that isn't an array is decoded as a single item.
+        """
+        self.assertEqual(self._decode('{"size": "m3"}'), [{"size": "m3"}])
+
+
+    def test_malformed(self):
+        """
+        Malformed arrays raise ValueError.
+        """
+        for body in ["[1 2]", "[1,", "[{", "[1,]", '["a', "[1x]"]:
+            self.assertRaises(ValueError, self._decode, body)
+
+
+    def test_leadingWhitespace(self):
+        """
+        Arrays after whitespace that spans several chunks are still decoded
+        incrementally.
+        """
+        body = StringIO("  \n\t [1, 2]")
+        decoded = jsonIterDecode(body, chunkSize=1)
+        self.assertEqual(next(decoded), 1)
+        self.assertEqual(list(decoded), [2])
+
+
+    def test_trailingData(self):
+        """
+        Anything but whitespace after the array raises ValueError.
+        """
+        for body in ["[1] x", "[] 2", "[1]  \n ]"]:
+            decoded = jsonIterDecode(StringIO(body), chunkSize=1)
+            self.assertRaises(ValueError, list, decoded)
+        decoded = jsonIterDecode(StringIO("[1] \n "), chunkSize=1)
+        self.assertEqual(list(decoded), [1])
+
+
+
+class MessagePackTests(TestCase):
+    """
+    Test MessagePack encoding and decoding.
+    """
+    if msgpack is None:
+        skip = "MessagePack is not available"
+
+
+    def test_roundtrip(self):
+        """
+        Encoding and then decoding some state produces the same state.
+        """
+        state = {"head": "philips", "size": "m3", "length": 12}
+        encoded = serializers.msgpackEncode(state)
+        self.assertEqual(serializers.msgpackDecode(StringIO(encoded)), state)
+
+
+    def test_error(self):
+        """
+        Serializable errors are encoded like they are in JSON.
+        """
+        error = errors.MissingElementError("m3")
+        encoded = serializers.msgpackEncode(error)
+        decoded = serializers.msgpackDecode(StringIO(encoded))
+        self.assertEqual(decoded, {"errorMessage": "missing element",
+                                   "errorDetails": {"identifier": "m3"}})
+
+
+    def test_raiseForUnserializableType(self):
+        """
+        When given an unserializable type, the encoder raises TypeError.
+        """
+        self.assertRaises(TypeError, serializers.msgpackEncode, object())
+
+
+    def test_incrementalDecoding(self):
+        """
+        The items of an array are decoded one by one, even when they span
+        multiple chunks.
+        """
+        states = [{"size": "m%d" % (i,)} for i in xrange(10)]
+        encoded = StringIO(serializers.msgpackEncode(states))
+        decoded = serializers.msgpackIterDecode(encoded, chunkSize=3)
+        self.assertEqual(list(decoded), states)
+
+
+
+class MessagePackNegotiationTest(collections.PartialExposureMixin, TestCase):
+    """
+    Test that clients can ask for MessagePack.
+    """
+    if msgpack is None:
+        skip = "MessagePack is not available"
+
+
+    def test_getElement(self):
+        """
+        Elements are encoded with MessagePack when the client asks for it.
+        """
+        self.addElements()
+        headers = http_headers.Headers()
+        headers.setRawHeaders("Accept", ["application/msgpack"])
+        self.request = util._FakeRequest(requestHeaders=headers)
+
+        name, species, diet = self.elementArgs[0]
+        child = self.resource.getChildWithDefault(name, self.request)
+        d = self._makeRequest(child, self.request)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            self._checkContentType("application/msgpack")
+            content = self.request._responseContent
+            expected = {"name": name, "species": species, "diet": diet}
+            self.assertEqual(serializers.msgpackDecode(content), expected)
+
+        return d
+
+
+
+class FakeEntryPoint(object):
+    """
+    A fake setuptools entry point.
+    """
+    def __init__(self, name, codec):
+        self.name = name
+        self.codec = codec
+        self.loaded = False
+
+
+    def load(self):
+        self.loaded = True
+        return self.codec
+
+
+
+class CodecRegistryTests(TestCase):
+    """
+    Test registering and looking up codecs.
+    """
+    def setUp(self):
+        self.registry = serializers.CodecRegistry()
+
+
+    def test_direct(self):
+        """
+        Codecs registered directly are returned as is.
+        """
+        self.registry.register("application/json", jsonEncode)
+        self.assertIdentical(self.registry.get("application/json"),
+                             jsonEncode)
+        self.assertIdentical(self.registry.get("application/JSON"),
+                             jsonEncode)
+        self.assertIdentical(self.registry.get("text/plain"), None)
+
+
+    def test_byName(self):
+        """
+        Codecs registered by name are loaded by name.
+        """
+        self.registry.register("application/json",
+                               "txyoga.serializers.jsonDecode")
+        self.assertEqual(self.registry.contentTypes(), ["application/json"])
+        self.assertIdentical(self.registry.get("application/json"),
+                             jsonDecode)
+
+
+    def test_unavailable(self):
+        """
+        Codecs that can't be imported are dropped.
+        """
+        codec = serializers._NamedCodec("txyoga.serializers.jsonDecode",
+                                        requires="txyoga.test.ZALGO")
+        self.registry.register("application/zalgo", codec)
+        self.assertIdentical(self.registry.get("application/zalgo"), None)
+        self.assertEqual(self.registry.contentTypes(), [])
+
+
+    def test_entryPoints(self):
+        """
+        Codecs advertised as entry points are registered, and only loaded
+        when they're first looked up.
+        """
+        import pkg_resources
+
+        entryPoint = FakeEntryPoint("application/zalgo", jsonEncode)
+        def iter_entry_points(group):
+            self.assertEqual(group, "txyoga.zalgo")
+            return [entryPoint]
+        self.patch(pkg_resources, "iter_entry_points", iter_entry_points)
+
+        registry = serializers.CodecRegistry("txyoga.zalgo")
+        self.assertEqual(registry.contentTypes(), ["application/zalgo"])
+        self.assertFalse(entryPoint.loaded)
+
+        self.assertIdentical(registry.get("application/zalgo"), jsonEncode)
+        self.assertTrue(entryPoint.loaded)
+
+
+    def test_listsOfCodecs(self):
+        """
+        Resources can still use lists of codecs instead of registries.
+        """
+        resource = serializers.EncodingResource()
+        resource.encoders = [jsonEncode]
+
+        headers = http_headers.Headers()
+        headers.setRawHeaders("Accept", ["application/json"])
+        request = util._FakeRequest(requestHeaders=headers)
+        self.assertIdentical(resource._getEncoder(request), jsonEncode)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test logging slow requests.
+"""
+from StringIO import StringIO
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from txyoga import slowlog
+from txyoga.serializers import json
+from txyoga.test import collections
+from txyoga.test.test_coalescing import SlowZoo
+
+
+class SlowRequestLogTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests logging slow requests.
+    """
+    collectionClass = SlowZoo
+
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+        self.clock = task.Clock()
+        self.output = StringIO()
+        self.log = slowlog.SlowRequestLog(self.output, threshold=1,
+                                          clock=self.clock)
+        self.resource.slowRequestLog = self.log
+
+
+    def _records(self):
+        lines = self.output.getvalue().splitlines()
+        return [json.loads(line) for line in lines]
+
+
+    def _takeTime(self, seconds):
+        self.clock.advance(seconds)
+        self.collection.fire()
+
+
+    def test_page(self):
+        """
+        Slow pages are logged with their bounds, their size and the time
+        spent waiting for the collection.
+        """
+        d = self.getElements({"start": ["1"], "stop": ["3"]})
+        self._takeTime(2)
+
+        @d.addCallback
+        def verify(_):
+            record, = self._records()
+            body = self.request._responseContent.getvalue()
+            self.assertEqual(record["method"], "GET")
+            self.assertEqual(record["resource"], "CollectionResource")
+            self.assertEqual(record["collection"], "SlowZoo")
+            self.assertEqual((record["start"], record["stop"]), (1, 3))
+            self.assertEqual(record["elements"], 2)
+            self.assertEqual(record["contentType"], "application/json")
+            self.assertEqual(record["bytes"], len(body))
+            self.assertTrue(record["finished"])
+            self.assertEqual(record["duration"], 2)
+            self.assertEqual(record["phases"]["waiting"], 2)
+            self.assertEqual(record["phases"]["other"], 0)
+
+        return d
+
+
+    def test_element(self):
+        """
+        Slow requests for elements are logged with their identifier, and
+        the resource that rendered them.
+        """
+        d = self.getElement("Simba")
+        self._takeTime(1)
+
+        @d.addCallback
+        def verify(_):
+            record, = self._records()
+            self.assertEqual(record["resource"], "ElementResource")
+            self.assertEqual(record["collection"], "SlowZoo")
+            self.assertEqual(record["identifier"], "Simba")
+            self.assertEqual(record["elements"], 1)
+            self.assertEqual(record["phases"]["waiting"], 1)
+
+        return d
+
+
+    def test_fast(self):
+        """
+        Requests that are faster than the threshold aren't logged.
+        """
+        d = self.getElements()
+        self._takeTime(0.5)
+        d.addCallback(lambda _: self.assertEqual(self._records(), []))
+        return d
+
+
+    def test_untimed(self):
+        """
+        Requests for resources without a log aren't timed.
+        """
+        self.resource.slowRequestLog = None
+        d = self.getElements()
+        self.assertIdentical(slowlog.timingsFor(self.request),
+                             slowlog._noTimings)
+        self._takeTime(2)
+        d.addCallback(lambda _: self.assertEqual(self._records(), []))
+        return d
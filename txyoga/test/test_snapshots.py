@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test snapshots of collections, and paging through them.
+"""
+import urlparse
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from twisted.web import http
+
+from txyoga import errors, snapshots
+from txyoga.test import collections
+
+
+class SnapshotTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests taking snapshots of collections.
+    """
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+        self.snapshot = self.collection.snapshot()
+
+
+    def _names(self, d):
+        return [e.name for e in self.successResultOf(d)]
+
+
+    def test_add(self):
+        """
+        Added elements aren't in the snapshot, and don't copy the elements.
+        """
+        elements = self.collection._elements
+        self.collection.add(collections.Animal("Nala", "lion", "bugs"))
+        self.assertIdentical(self.collection._elements, elements)
+        self.assertEqual(self.successResultOf(self.snapshot.count()), 8)
+        self.assertEqual(self._names(self.snapshot.query(6, 10)),
+                         ["Banzai", "Ed"])
+
+
+    def test_remove(self):
+        """
+        Removed elements stay in the snapshot.
+        """
+        self.collection.remove("Pumbaa")
+        self.collection.removeMany(["Simba"])
+        self.assertEqual(self._names(self.snapshot.query(0, 3)),
+                         ["Pumbaa", "Simba", "Timon"])
+        self.assertEqual(self._names(self.collection.query(0, 3)),
+                         ["Timon", "Rafiki", "Zazu"])
+
+
+    def test_copiedOnce(self):
+        """
+        The elements are only copied for the first removal after a
+        snapshot.
+        """
+        self.collection.remove("Pumbaa")
+        elements = self.collection._elements
+        self.collection.remove("Simba")
+        self.assertIdentical(self.collection._elements, elements)
+
+
+    def test_version(self):
+        """
+        Snapshots have the version of the collection when they were taken.
+        """
+        self.collection.remove("Pumbaa")
+        self.assertEqual(self.snapshot.version, 8)
+
+
+
+class SnapshotPinsTest(TestCase):
+    """
+    Tests pinning snapshots.
+    """
+    def setUp(self):
+        self.pins = snapshots.SnapshotPins(timeToLive=10, maximumSize=2)
+
+
+    def test_get(self):
+        """
+        Pinned snapshots can be gotten with their token.
+        """
+        snapshot = object()
+        token = self.pins.pin(snapshot, 0)
+        self.assertIdentical(self.pins.get(token, 5), snapshot)
+
+
+    def test_expired(self):
+        """
+        Snapshots expire.
+        """
+        token = self.pins.pin(object(), 0)
+        e = self.assertRaises(errors.SnapshotExpiredError,
+                              self.pins.get, token, 10)
+        self.assertEqual(e.details, {"snapshot": token})
+
+
+    def test_maximumSize(self):
+        """
+        When too many snapshots are pinned, the oldest ones are unpinned.
+        """
+        first = self.pins.pin(object(), 0)
+        self.pins.pin(object(), 1)
+        self.pins.pin(object(), 2)
+        self.assertRaises(errors.SnapshotExpiredError,
+                          self.pins.get, first, 3)
+
+
+
+class SnapshotPaginationTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests paging through snapshots.
+    """
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+        self.resource.clock = self.clock = task.Clock()
+
+
+    def _nextArgs(self):
+        query = urlparse.urlsplit(self.responseContent["next"]).query
+        return dict((k, [v]) for k, v in urlparse.parse_qsl(query))
+
+
+    def _names(self):
+        return [r["name"] for r in self.responseContent["results"]]
+
+
+    def test_consistent(self):
+        """
+        Pages of a snapshot don't change while the collection does.
+        """
+        self.getElements({"snapshot": ["new"]})
+        token = self.responseContent["snapshot"]
+        self.assertEqual(self._names(), ["Pumbaa", "Simba", "Timon"])
+
+        self.collection.remove("Pumbaa")
+        args = self._nextArgs()
+        self.assertEqual(args["snapshot"], [token])
+
+        self.getElements(args)
+        self.assertEqual(self._names(), ["Rafiki", "Zazu", "Shenzi"])
+        self.assertEqual(self.responseContent["total"], 8)
+
+
+    def test_expired(self):
+        """
+        Pages of expired snapshots are gone.
+        """
+        self.getElements({"snapshot": ["new"]})
+        args = self._nextArgs()
+        self.clock.advance(snapshots.pinsFor(self.collection).timeToLive)
+        d = self.getElements(args)
+        d.addCallback(lambda _: self._checkBadRequest(http.GONE))
+        return d
+
+
+    def test_unknown(self):
+        """
+        Unknown snapshots are gone too.
+        """
+        d = self.getElements({"snapshot": ["bogus"]})
+        d.addCallback(lambda _: self._checkBadRequest(http.GONE))
+        return d
+
+
+    def test_unversioned(self):
+        """
+        Pages of snapshots without a version have no ETag.
+        """
+        snapshot = self.collection.snapshot()
+        snapshot.version = None
+        self.collection.snapshot = lambda: snapshot
+        d = self.getElements({"snapshot": ["new"]})
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            headers = self.request.responseHeaders
+            self.assertFalse(headers.hasHeader("ETag"))
+            self.assertNotIn("version", self.responseContent)
+            self.assertEqual(self._names(), ["Pumbaa", "Simba", "Timon"])
+
+        return d
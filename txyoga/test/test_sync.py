@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test getting only what changed in a collection since a version of it.
+"""
+from twisted.trial.unittest import TestCase
+from twisted.web import http, http_headers
+
+from txyoga import errors
+from txyoga.serializers import json
+from txyoga.test import collections
+
+
+class VersionTest(collections.UpdatableCollectionMixin, TestCase):
+    """
+    Tests that collections keep track of the versions of their elements.
+    """
+    def setUp(self):
+        collections.UpdatableCollectionMixin.setUp(self)
+        self.addElements()
+
+
+    def _changedSince(self, version):
+        delta = self.successResultOf(self.collection.changedSince(version))
+        changed = [e.name for e in delta["changed"]]
+        return changed, delta["removed"], delta["version"]
+
+
+    def test_added(self):
+        """
+        Every added element is a new version.
+        """
+        self.assertEqual(self.collection.version, 4)
+        self.assertEqual(self._changedSince(2), (["south", "west"], [], 4))
+        self.assertEqual(self._changedSince(4), ([], [], 4))
+
+
+    def test_updated(self):
+        """
+        Updated elements get a new version, and come after the others.
+        """
+        self.collection.updateMany({"color": "black"}, ["north"])
+        self.assertEqual(self._changedSince(2),
+                         (["south", "west", "north"], [], 5))
+
+
+    def test_removed(self):
+        """
+        Removed elements leave a tombstone.
+        """
+        self.collection.remove("south")
+        self.collection.removeMany(["north"])
+        self.assertEqual(self._changedSince(0),
+                         (["east", "west"], ["south", "north"], 6))
+        self.assertEqual(self._changedSince(5), ([], ["north"], 6))
+
+
+    def test_addedAgain(self):
+        """
+        Elements that are added again after being removed aren't removed.
+        """
+        self.collection.remove("south")
+        self.collection.add(collections.Bikeshed("south", "white"))
+        self.assertEqual(self._changedSince(4), (["south"], [], 6))
+
+
+    def test_compaction(self):
+        """
+        Only the most recent tombstones are kept. Versions from before
+        the forgotten ones are too old.
+        """
+        self.collection.maximumTombstones = 2
+        for name in ["north", "east", "south"]:
+            self.collection.remove(name)
+
+        self.assertEqual(self._changedSince(5), ([], ["east", "south"], 7))
+        d = self.collection.changedSince(4)
+        failure = self.failureResultOf(d, errors.ChangesUnavailableError)
+        self.assertEqual(failure.value.details, {"since": 4, "oldest": 5})
+
+
+    def test_future(self):
+        """
+        Versions newer than the current one are unknown.
+        """
+        d = self.collection.changedSince(5)
+        self.failureResultOf(d, errors.ChangesUnavailableError)
+
+
+
+class DeltaResourceTest(collections.UpdatableCollectionMixin, TestCase):
+    """
+    Tests getting the changes to a collection through its resource.
+    """
+    def setUp(self):
+        collections.UpdatableCollectionMixin.setUp(self)
+        self.collection.exposedElementAttributes = "name", "color"
+        self.addElements()
+
+
+    def test_version(self):
+        """
+        Pages have the version of the collection.
+        """
+        d = self.getElements()
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.responseContent["version"], 4)
+
+        return d
+
+
+    def test_delta(self):
+        """
+        Only the changed elements and the identifiers of the removed ones
+        are returned.
+        """
+        self.collection.remove("north")
+        headers = http_headers.Headers()
+        headers.setRawHeaders("Content-Type", ["application/json"])
+        body = json.dumps({"color": "black"})
+        d = self.updateElement("east", body, headers)
+        d.addCallback(lambda _: self.getElements({"since": ["4"]}))
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.responseContent, {
+                "results": [{"name": "east", "color": "black"}],
+                "removed": ["north"],
+                "version": 6})
+
+        return d
+
+
+    def test_tooOld(self):
+        """
+        Clients with a version that is too old have to get the whole
+        collection again.
+        """
+        self.collection.maximumTombstones = 0
+        self.collection.remove("north")
+        d = self.getElements({"since": ["0"]})
+        d.addCallback(lambda _: self._checkBadRequest(http.GONE))
+        return d
+
+
+    def test_badVersion(self):
+        """
+        Versions have to be integers.
+        """
+        d = self.getElements({"since": ["latest"]})
+        d.addCallback(lambda _: self._checkBadRequest(http.BAD_REQUEST))
+        return d
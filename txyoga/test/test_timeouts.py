@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test timing out and cancelling operations on collections.
+"""
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+from twisted.web import http
+
+from txyoga.test import collections, util
+from txyoga.test.test_coalescing import SlowZoo
+
+
+class TimeoutTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests that slow operations time out and are cancelled.
+    """
+    collectionClass = SlowZoo
+
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+        self.clock = self.resource.clock = task.Clock()
+        self.resource.operationTimeouts = {"get": 5, "query": 5}
+
+
+    def _render(self, path=()):
+        request = util._FakeRequest(requestHeaders=util.correctAcceptHeaders)
+        resource = self.resource
+        for childName in path:
+            resource = resource.getChildWithDefault(childName, request)
+        return self._makeRequest(resource, request), request
+
+
+    def test_timeout(self):
+        """
+        Operations that take too long fail with 504 Gateway Timeout, and
+        are cancelled.
+        """
+        d = self.getElement("Simba")
+        self.clock.advance(5)
+
+        @d.addCallback
+        def verify(_):
+            self._checkBadRequest(http.GATEWAY_TIMEOUT)
+            details = self.responseContent["errorDetails"]
+            self.assertEqual(details, {"operation": "get", "timeout": 5})
+            self.assertEqual(self.collection.cancelled, 1)
+
+        return d
+
+
+    def test_inTime(self):
+        """
+        Operations that finish in time don't time out later.
+        """
+        d = self.getElements()
+        self.collection.fire()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        return d
+
+
+    def test_collectionTimeouts(self):
+        """
+        Without timeouts on the resource, those of the collection are used.
+        """
+        self.resource.operationTimeouts = None
+        self.collection.operationTimeouts = {"query": 1}
+        d = self.getElements()
+        self.clock.advance(1)
+        d.addCallback(lambda _: self._checkBadRequest(http.GATEWAY_TIMEOUT))
+        return d
+
+
+    def test_noTimeout(self):
+        """
+        Operations without a timeout don't time out.
+        """
+        self.resource.operationTimeouts = {}
+        self.getElements()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_disconnect(self):
+        """
+        Operations are cancelled when the client goes away.
+        """
+        d, request = self._render(["Simba"])
+        request.disconnect()
+
+        self.assertEqual(self.collection.cancelled, 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(request._responseContent.getvalue(), "")
+        return self.assertFailure(d, Exception)
+
+
+    def test_coalescedDisconnect(self):
+        """
+        Coalesced operations are only cancelled when all of the clients
+        waiting for them have gone away.
+        """
+        first, firstRequest = self._render(["Simba"])
+        second, secondRequest = self._render(["Simba"])
+
+        firstRequest.disconnect()
+        self.assertEqual(self.collection.cancelled, 0)
+
+        secondRequest.disconnect()
+        self.assertEqual(self.collection.cancelled, 1)
+
+        return defer.gatherResults([self.assertFailure(first, Exception),
+                                    self.assertFailure(second, Exception)])
+
+
+    def test_coalescedSurvivor(self):
+        """
+        Clients waiting for a coalesced operation still get the result
+        when another one has gone away.
+        """
+        first, firstRequest = self._render(["Simba"])
+        second, secondRequest = self._render(["Simba"])
+        firstRequest.disconnect()
+        self.collection.fire()
+
+        @second.addCallback
+        def verify(_):
+            self.assertEqual(secondRequest.code, http.OK)
+
+        return defer.gatherResults([self.assertFailure(first, Exception),
+                                    second])
+
+
+    def test_cancelledByCollection(self):
+        """
+        Operations that the collection cancelled itself still finish the
+        request.
+        """
+        d, request = self._render(["Simba"])
+        (pending, _), = self.collection.pending
+        pending.errback(defer.CancelledError())
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(len(self.flushLoggedErrors(defer.CancelledError)),
+                             1)
+
+        return d
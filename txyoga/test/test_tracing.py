@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test tracing requests.
+"""
+from StringIO import StringIO
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from twisted.web import http_headers
+
+from txyoga import tracing
+from txyoga.serializers import json
+from txyoga.test import collections, util
+from txyoga.test.test_coalescing import SlowZoo
+
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+class ParseTraceparentTest(TestCase):
+    """
+    Tests parsing W3C ``traceparent`` headers.
+    """
+    def test_valid(self):
+        """
+        Valid headers have a trace and a parent span.
+        """
+        header = "00-%s-%s-01" % (TRACE_ID, PARENT_ID)
+        self.assertEqual(tracing.parseTraceparent(header),
+                         (TRACE_ID, PARENT_ID))
+
+
+    def test_invalid(self):
+        """
+        Missing, malformed and all-zero headers have neither.
+        """
+        for header in [None, "", "bogus",
+                       "01-%s-%s-01" % (TRACE_ID, PARENT_ID),
+                       "00-%s-%s-01" % ("0" * 32, PARENT_ID),
+                       "00-%s-%s-01" % (TRACE_ID, "0" * 16)]:
+            self.assertEqual(tracing.parseTraceparent(header), (None, None))
+
+
+
+class TracingTest(collections.PaginatedCollectionMixin, TestCase):
+    """
+    Tests tracing requests.
+    """
+    collectionClass = SlowZoo
+
+    def setUp(self):
+        collections.PaginatedCollectionMixin.setUp(self)
+        self.addElements()
+        self.clock = task.Clock()
+        self.exporter = tracing.InMemoryExporter()
+        self.resource.tracer = tracing.Tracer(self.exporter, self.clock)
+
+
+    def _spans(self):
+        """
+        Gets the exported spans by name, checking that they are all in one
+        trace, and that all but the request's own span are its children.
+        """
+        spans = dict((span.name, span) for span in self.exporter.spans)
+        root, = [s for s in spans.itervalues() if s.name.startswith("GET")]
+        for span in spans.itervalues():
+            self.assertEqual(span.traceId, root.traceId)
+            if span is not root:
+                self.assertEqual(span.parentId, root.spanId)
+        return spans
+
+
+    def test_page(self):
+        """
+        Requests for pages have spans for the collection's operations,
+        exporting states, encoding and writing.
+        """
+        d = self.getElements()
+        self.clock.advance(2)
+        self.collection.fire()
+
+        @d.addCallback
+        def verify(_):
+            spans = self._spans()
+            self.assertEqual(set(spans), set(["GET CollectionResource",
+                                              "count", "query", "toState",
+                                              "encoding", "write"]))
+
+            root = spans["GET CollectionResource"]
+            self.assertEqual(root.attributes["http.status_code"], 200)
+            self.assertFalse(root.failed)
+            self.assertEqual(root.ended - root.started, 2)
+
+            query = spans["query"]
+            self.assertEqual(query.ended - query.started, 2)
+            toState = spans["toState"]
+            self.assertEqual(toState.attributes["txyoga.elements"], 3)
+
+        return d
+
+
+    def test_element(self):
+        """
+        Requests for elements have a span for finding the element, and
+        are attributed to the element's resource.
+        """
+        d = self.getElement("Simba")
+        self.clock.advance(1)
+        self.collection.fire()
+
+        @d.addCallback
+        def verify(_):
+            spans = self._spans()
+            self.assertEqual(set(spans), set(["GET CollectionResource",
+                                              "getChild", "get", "toState",
+                                              "encoding", "write"]))
+
+            root = spans["GET CollectionResource"]
+            self.assertEqual(root.attributes["txyoga.resource"],
+                             "ElementResource")
+            getChild = spans["getChild"]
+            self.assertEqual(getChild.ended - getChild.started, 1)
+
+        return d
+
+
+    def test_traceparent(self):
+        """
+        Requests with a ``traceparent`` continue its trace.
+        """
+        headers = http_headers.Headers()
+        headers.setRawHeaders("Accept", ["application/json"])
+        headers.setRawHeaders("traceparent",
+                              ["00-%s-%s-01" % (TRACE_ID, PARENT_ID)])
+        d = self.getElements(headers=headers)
+        self.collection.fire()
+
+        @d.addCallback
+        def verify(_):
+            root = self._spans()["GET CollectionResource"]
+            self.assertEqual(root.traceId, TRACE_ID)
+            self.assertEqual(root.parentId, PARENT_ID)
+            self.assertEqual(root.traceparent[:36], "00-" + TRACE_ID + "-")
+
+        return d
+
+
+    def test_untraced(self):
+        """
+        Requests for resources without a tracer aren't traced.
+        """
+        self.resource.tracer = None
+        d = self.getElements()
+        self.assertIdentical(tracing.spanFor(self.request), tracing._noSpan)
+        self.collection.fire()
+        d.addCallback(lambda _: self.assertEqual(self.exporter.spans, []))
+        return d
+
+
+
+class FileExporterTest(TestCase):
+    """
+    Tests writing spans to a file.
+    """
+    def test_export(self):
+        """
+        Spans are written as one JSON object per line.
+        """
+        output = StringIO()
+        tracer = tracing.Tracer(tracing.FileExporter(output), task.Clock())
+        request = util._FakeRequest()
+        span = tracer.start(collections.Zoo(), request)
+        span.run("query", {"txyoga.elements": 2}, lambda: None)
+        request.finish()
+
+        child, root = [json.loads(l) for l in output.getvalue().splitlines()]
+        self.assertEqual(child["name"], "query")
+        self.assertEqual(child["parentId"], root["spanId"])
+        self.assertEqual(child["attributes"], {"txyoga.elements": 2})
+        self.assertEqual(root["name"], "GET Zoo")
@@ -7,6 +7,7 @@ from twisted.internet import defer
 from twisted.trial.unittest import TestCase
 from twisted.web import http, http_headers
 
+from txyoga import base, errors
 from txyoga.errors import AttributeValueUpdateError
 from txyoga.serializers import json
 from txyoga.test import collections
@@ -192,3 +193,203 @@ class ManualUpdatingTest(collections.UpdatableCollectionMixin, TestCase):
     def test_completeState(self):
         state = dict(allowedUpdateState, **nilpotentUpdateState)
         return self._testUpdate(state)
+
+
+
+class ElementPatchingTest(collections.UpdatableCollectionMixin, TestCase):
+    """
+    Test patching elements with JSON merge patches.
+    """
+    def setUp(self):
+        collections.UpdatableCollectionMixin.setUp(self)
+        self.headers = http_headers.Headers()
+        self.headers.setRawHeaders("Content-Type",
+                                   ["application/merge-patch+json"])
+        self.addElements()
+        self.name = self.elementArgs[0][0]
+
+
+    def _patch(self, patch):
+        return self.patchElement(self.name, json.dumps(patch), self.headers)
+
+
+    def test_simple(self):
+        """
+        Patching an updatable attribute changes it.
+        """
+        d = self._patch(allowedUpdateState)
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            element = self.collection._elementsByIdentifier[self.name]
+            self.assertEqual(element.color, allowedUpdateState["color"])
+
+        return d
+
+
+    def test_nonUpdatableAttribute(self):
+        """
+        Patching an attribute which is not allowed to be updated fails.
+        """
+        d = self._patch(disallowedUpdateState)
+
+        @d.addCallback
+        def verify(_):
+            self._decodeResponse()
+            self._checkBadRequest(http.FORBIDDEN)
+
+        return d
+
+
+    def test_unknownAttribute(self):
+        """
+        Patching an attribute the element doesn't have is forbidden.
+        """
+        d = self._patch({"bogus": 1})
+
+        @d.addCallback
+        def verify(_):
+            self._decodeResponse()
+            self._checkBadRequest(http.FORBIDDEN)
+            self.assertEqual(self.responseContent["errorDetails"],
+                             {"attribute": "bogus", "newValue": 1})
+
+        return d
+
+
+    def test_changesOnly(self):
+        """
+        The collection is only told about the attributes that changed.
+        """
+        changes = []
+        self.collection.addChangeListener(changes.append)
+        d = self._patch({"color": "green", "maximumOccupancy": 100})
+
+        @d.addCallback
+        def verify(_):
+            self.assertEqual(self.request.code, http.OK)
+            change, = changes
+            self.assertEqual(change.state, {"color": "green"})
+
+        return d
+
+
+    def test_notAnObject(self):
+        """
+        Patches that aren't JSON objects are bad requests.
+        """
+        d = self._patch([1])
+
+        @d.addCallback
+        def verify(_):
+            self._decodeResponse()
+            self._checkBadRequest(http.BAD_REQUEST)
+            self.assertEqual(self.responseContent["errorMessage"],
+                             "patch is not an object")
+
+        return d
+
+
+    def test_plainJSON(self):
+        """
+        Patches have to be sent as merge patches, not as plain JSON.
+        """
+        self.headers.setRawHeaders("Content-Type", ["application/json"])
+        d = self._patch(allowedUpdateState)
+
+        @d.addCallback
+        def verify(_):
+            self._decodeResponse()
+            self._checkBadRequest(http.UNSUPPORTED_MEDIA_TYPE)
+
+        return d
+
+
+
+class Widget(base.Element):
+    """
+    A widget that remembers how it was updated.
+    """
+    updatableAttributes = "color", "dimensions", "label"
+
+    def __init__(self, name):
+        self.name = name
+        self.color = "red"
+        self.dimensions = {"width": 10, "height": 20}
+        self.label = "widget"
+        self.updates = []
+
+
+    def update(self, state):
+        self.updates.append(state)
+        return base.Element.update(self, state)
+
+
+
+class ManualPatchingTest(TestCase):
+    """
+    Tests patching an element directly.
+    """
+    def setUp(self):
+        self.widget = Widget("w")
+
+
+    def test_onlyChanges(self):
+        """
+        Only the attributes that actually change are passed to ``update``.
+        """
+        d = self.widget.patch({"name": "w", "color": "blue",
+                               "label": "widget"})
+        self.assertEqual(self.successResultOf(d), {"color": "blue"})
+        self.assertEqual(self.widget.updates, [{"color": "blue"}])
+        self.assertEqual(self.widget.color, "blue")
+
+
+    def test_nested(self):
+        """
+        Nested objects are merged, and ``null`` removes nested members.
+        """
+        self.widget.patch({"dimensions": {"width": None, "depth": 5}})
+        expected = {"height": 20, "depth": 5}
+        self.assertEqual(self.widget.updates, [{"dimensions": expected}])
+        self.assertEqual(self.widget.dimensions, expected)
+
+
+    def test_null(self):
+        """
+        ``null`` sets top-level attributes to ``None``.
+        """
+        self.widget.patch({"label": None})
+        self.assertEqual(self.widget.updates, [{"label": None}])
+        self.assertIdentical(self.widget.label, None)
+
+
+    def test_noChanges(self):
+        """
+        A patch that doesn't change anything is passed as an empty delta.
+        """
+        d = self.widget.patch({"color": "red"})
+        self.assertEqual(self.widget.updates, [{}])
+        return d
+
+
+    def test_notUpdatable(self):
+        """
+        Patches that change attributes that aren't updatable, or that the
+        element doesn't have, aren't applied.
+        """
+        for patch in [{"name": "v"}, {"bogus": 1, "color": "blue"}]:
+            d = self.widget.patch(patch)
+            self.failureResultOf(d, errors.AttributeValueUpdateError)
+        self.assertEqual(self.widget.updates, [])
+
+
+    def test_notAnObject(self):
+        """
+        Patches that aren't objects aren't applied.
+        """
+        for patch in [[1], "x", None]:
+            d = self.widget.patch(patch)
+            self.failureResultOf(d, errors.PatchError)
+        self.assertEqual(self.widget.updates, [])
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Test keeping collections in worker processes the same.
+"""
+from twisted.test import proto_helpers
+from twisted.trial.unittest import TestCase
+
+from txyoga import changes, workers
+from txyoga.serializers import json
+from txyoga.test import collections
+
+
+class ReplicatorTest(collections.UpdatableCollectionMixin, TestCase):
+    """
+    Tests for replicators, which exchange changes with the launcher.
+    """
+    def setUp(self):
+        collections.UpdatableCollectionMixin.setUp(self)
+        self.addElements()
+        self.replicator = workers.Replicator({"sheds": self.collection})
+        self.transport = proto_helpers.StringTransport()
+        self.replicator.stream.makeConnection(self.transport)
+
+
+    def _received(self, *lines):
+        for line in lines:
+            self.replicator.stream.dataReceived(line + "\n")
+
+
+    def test_sendChanges(self):
+        """
+        Local changes are sent to the launcher.
+        """
+        self.collection.remove("north")
+        line = self.transport.value()
+        self.assertTrue(line.endswith("\n"))
+        self.assertEqual(json.loads(line),
+                         {"collection": "sheds",
+                          "change": {"type": "remove", "identifier": "north",
+                                     "state": None}})
+
+
+    def test_applyChanges(self):
+        """
+        Changes from the launcher are applied, but not sent back. Their
+        sequence number, counted from the version the collection had when
+        the replicator was made, becomes the collection's version.
+        """
+        self._received('{"collection": "sheds", "change": '
+                       '{"type": "update", "identifier": "north", '
+                       '"state": {"color": "black"}, "sequence": 1}}')
+        element = self.collection._elementsByIdentifier["north"]
+        self.assertEqual(element.color, "black")
+        self.assertEqual(self.transport.value(), "")
+        self.assertEqual(self.collection.version, len(self.elementArgs) + 1)
+
+
+    def test_versionOnceApplied(self):
+        """
+        Local changes only get a version, and are only told to the change
+        listeners, once the launcher sends them back.
+        """
+        received = []
+        self.collection.addChangeListener(received.append)
+        version = self.collection.version
+
+        self.collection.remove("north")
+        self.assertEqual(self.collection.version, version)
+        self.assertEqual(received, [])
+
+        message = json.loads(self.transport.value())
+        message["change"]["sequence"] = 1
+        self._received(json.dumps(message))
+        self.assertEqual(self.collection.version, version + 1)
+        [change] = received
+        self.assertEqual((change.kind, change.identifier, change.sequence),
+                         (changes.REMOVED, "north", version + 1))
+
+
+
+class FakeWorkerProcess(object):
+    def __init__(self):
+        self.lines = []
+
+
+    def sendLine(self, line):
+        self.lines.append(line)
+
+
+
+class LauncherTest(TestCase):
+    """
+    Tests for the launcher's end of the change streams.
+    """
+    def test_broadcast(self):
+        """
+        Changes from any worker are passed on to all workers, in order,
+        numbered in sequence for each collection.
+        """
+        launcher = workers.Launcher("example.makeRoot", 0, workers=2)
+        processes = [FakeWorkerProcess(), FakeWorkerProcess()]
+        launcher._processes.extend(processes)
+
+        worker = workers._WorkerProcess(launcher)
+        worker.outReceived('{"collection": "a", "change": {}}\n'
+                           '{"collection": "b", "cha')
+        worker.outReceived('nge": {}}\n{"collection": "a", "change": {}}\n')
+
+        expected = [{"collection": "a", "change": {"sequence": 1}},
+                    {"collection": "b", "change": {"sequence": 1}},
+                    {"collection": "a", "change": {"sequence": 2}}]
+        for process in processes:
+            self.assertEqual(map(json.loads, process.lines), expected)
+
+
+
+class ReplicatedWorkerProcess(object):
+    """
+    The launcher's end of a worker whose replicator is in this process.
+    """
+    def __init__(self, replicator):
+        self.replicator = replicator
+
+
+    def sendLine(self, line):
+        self.replicator.stream.dataReceived(line + "\n")
+
+
+
+class WorkersTest(TestCase):
+    """
+    Tests for copies of a collection in several workers, exchanging
+    changes through a launcher.
+    """
+    def setUp(self):
+        self.launcher = workers.Launcher("example.makeRoot", 0, workers=2)
+        self.workers = []
+        for _ in xrange(2):
+            collection = collections.SoftwareProject()
+            for args in collections.UpdatableCollectionMixin.elementArgs:
+                collection.add(collections.Bikeshed(*args))
+
+            replicator = workers.Replicator({"sheds": collection})
+            transport = proto_helpers.StringTransport()
+            replicator.stream.makeConnection(transport)
+
+            process = ReplicatedWorkerProcess(replicator)
+            self.launcher._processes.append(process)
+            self.workers.append((collection, transport))
+
+
+    def _sendChanges(self, *indices):
+        """
+        Sends the changes made in the workers with the given indices to the
+        launcher, in that order.
+        """
+        worker = workers._WorkerProcess(self.launcher)
+        for index in indices:
+            _, transport = self.workers[index]
+            worker.outReceived(transport.value())
+            transport.clear()
+
+
+    def test_converge(self):
+        """
+        Concurrent changes to the same element in different workers end up
+        the same in both, once each has applied the changes in the
+        launcher's order.
+        """
+        (first, _), (second, _) = self.workers
+        first.updateMany({"color": "black"}, ["north"])
+        second.updateMany({"color": "white"}, ["north"])
+        self._sendChanges(0, 1)
+
+        colors = [c._elementsByIdentifier["north"].color
+                  for c, _ in self.workers]
+        self.assertEqual(colors, ["white", "white"])
+
+
+    def test_sameVersions(self):
+        """
+        Once they applied the same changes, the copies have the same
+        version and element order, and a version one of them handed out
+        can be used to get what changed since then from the other.
+        """
+        (first, _), (second, _) = self.workers
+        first.add(collections.Bikeshed("northwest", "purple"))
+        second.add(collections.Bikeshed("southeast", "orange"))
+        self._sendChanges(1, 0)
+        version = first.version
+
+        second.remove("east")
+        first.updateMany({"color": "black"}, ["north"])
+        self._sendChanges(1, 0)
+
+        self.assertEqual(first.version, second.version)
+        self.assertEqual([e.name for e in first._elements],
+                         [e.name for e in second._elements])
+
+        changed = self.successResultOf(second.changedSince(version))
+        self.assertEqual(changed["removed"], ["east"])
+        self.assertEqual([e.name for e in changed["changed"]], ["north"])
+        self.assertEqual(changed["version"], first.version)
+
+
+    def test_sameChangeLogs(self):
+        """
+        The change logs of the copies number the changes the same way, so
+        a sequence number from one of them can be used with the other.
+        """
+        first, second = [changes.changeLogFor(c) for c, _ in self.workers]
+        start = first.last
+        self.workers[0][0].remove("north")
+        self.workers[1][0].remove("south")
+        self._sendChanges(0, 1)
+
+        north, south = first.since(start)
+        self.assertEqual([north.identifier, south.identifier],
+                         ["north", "south"])
+        [change] = second.since(north.sequence)
+        self.assertEqual((change.identifier, change.sequence),
+                         ("south", south.sequence))
+        self.assertEqual(second.last, first.last)
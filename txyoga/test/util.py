@@ -4,7 +4,7 @@ Generic utilities for testing txyoga.
 from functools import partial
 from StringIO import StringIO
 
-from twisted.internet import defer
+from twisted.internet import defer, error
 from twisted.web import http, http_headers, resource, server
 
 from txyoga.serializers import json
@@ -21,8 +21,9 @@ class _FakeRequest(object):
     Mimics a twisted.web.server.Request, poorly.
     """
     def __init__(self, args=None, body="", method="GET",
-                 prePathURL=BASE_URL, requestHeaders=None):
+                 prePathURL=BASE_URL, requestHeaders=None, path="/"):
         self.args = args or {}
+        self.path = path
 
         self.content = StringIO(body)
         self._responseContent = StringIO()
@@ -31,6 +32,7 @@ class _FakeRequest(object):
         # we're always directly aimed at a resource and nobody is doing any
         # postpath-related stuff, so let's just pretend it's always emtpy...
         self.postpath = []
+        self.prepath = []
 
         self.code = http.OK
 
@@ -39,6 +41,7 @@ class _FakeRequest(object):
         self.method = method
 
         self._finished = False
+        self._disconnected = False
         self._notifiers = []
 
 
@@ -53,6 +56,21 @@ class _FakeRequest(object):
             d.callback(None)
 
 
+    def disconnect(self):
+        """
+        Pretends the client went away before the request was finished.
+        """
+        self._finished = self._disconnected = True
+        notifiers, self._notifiers = self._notifiers, []
+        for d in notifiers:
+            d.errback(error.ConnectionLost())
+
+
+    @property
+    def finished(self):
+        return self._finished
+
+
     def notifyFinish(self):
         if self._finished:
             return defer.succeed(None)
@@ -79,6 +97,7 @@ class _FakeRequest(object):
 
 
 _FakeDELETERequest = partial(_FakeRequest, method="DELETE")
+_FakePATCHRequest = partial(_FakeRequest, method="PATCH")
 _FakePOSTRequest = partial(_FakeRequest, method="POST")
 _FakePUTRequest = partial(_FakeRequest, method="PUT")
 
@@ -203,6 +222,17 @@ class _BaseCollectionTest(object):
         return self._makeRequest(elementResource, request)
 
 
+    def patchElement(self, name, body, headers=None):
+        """
+        Patch an element.
+
+        For a successful patch, the headers should contain a Content-Type.
+        """
+        request = _FakePATCHRequest(body=body, requestHeaders=headers)
+        elementResource = self.resource.getChild(name, request)
+        return self._makeRequest(elementResource, request)
+
+
     def deleteElement(self, name):
         """
         Delete an element.
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Tracing requests.
+
+Give a resource a ``Tracer`` as its ``tracer`` (or give it to all
+resources, by setting it on ``serializers.EncodingResource``), and every
+request it renders gets a span, with child spans for:
+
+    - ``getChild``, resolving the element a request is for,
+    - the operations of the collection (``get``, ``query``, ``add``,
+      ``remove``...), until their ``Deferred``s fire,
+    - ``fromState``, ``toState`` and ``encoding``,
+    - ``write``, writing the response body.
+
+Requests with a W3C ``traceparent`` header continue that trace; others
+start a new one. Finished spans are handed to the tracer's exporter,
+which is anything with an ``export`` method that takes a ``Span``, like
+an ``InMemoryExporter`` or a ``FileExporter``. An exporter can pass them
+on to a tracing system.
+"""
+import binascii
+import functools
+import os
+import re
+
+from twisted.internet import defer
+from twisted.python import failure, log
+
+from txyoga.serializers import json
+from txyoga.slowlog import getAttached
+
+
+class Span(object):
+    """
+    A timed part of the work done for a request.
+
+    Times are in seconds since the epoch, and identifiers in lowercase
+    hexadecimal, like they are in a ``traceparent`` header.
+    """
+    def __init__(self, tracer, name, traceId, parentId=None,
+                 attributes=None):
+        self._tracer = tracer
+        self.name = name
+        self.traceId = traceId
+        self.spanId = _newIdentifier(8)
+        self.parentId = parentId
+        self.attributes = attributes or {}
+        self.failed = False
+        self.started = tracer.clock.seconds()
+        self.ended = None
+
+
+    @property
+    def traceparent(self):
+        """
+        The ``traceparent`` header that continues the trace from this span.
+        """
+        return "00-%s-%s-01" % (self.traceId, self.spanId)
+
+
+    def setAttribute(self, key, value):
+        self.attributes[key] = value
+
+
+    def child(self, name, attributes=None):
+        """
+        Starts a child span.
+        """
+        return Span(self._tracer, name, self.traceId, self.spanId,
+                    attributes)
+
+
+    def end(self, failed=False):
+        """
+        Ends the span, and exports it.
+        """
+        self.ended = self._tracer.clock.seconds()
+        self.failed = failed
+        self._tracer.export(self)
+
+
+    def run(self, name, attributes, f, *args, **kwargs):
+        """
+        Calls a function in a child span.
+
+        If it returns a ``Deferred``, the span lasts until that fires.
+        """
+        span = self.child(name, attributes)
+        try:
+            result = f(*args, **kwargs)
+        except:
+            span.end(failed=True)
+            raise
+
+        if not isinstance(result, defer.Deferred):
+            span.end()
+            return result
+
+        def end(result):
+            span.end(failed=isinstance(result, failure.Failure))
+            return result
+
+        return result.addBoth(end)
+
+
+    def toState(self):
+        return {"name": self.name,
+                "traceId": self.traceId,
+                "spanId": self.spanId,
+                "parentId": self.parentId,
+                "started": self.started,
+                "ended": self.ended,
+                "failed": self.failed,
+                "attributes": self.attributes}
+
+
+
+class _NoSpan(object):
+    """
+    The span of requests that aren't traced: it traces nothing.
+    """
+    def setAttribute(self, key, value):
+        pass
+
+
+
+_noSpan = _NoSpan()
+
+
+def spanFor(request):
+    """
+    Gets the span of a request, which traces nothing if the request isn't
+    traced.
+    """
+    return getAttached(request, "span", _noSpan)
+
+
+def wrap(request, name, f, attributes=None):
+    """
+    Wraps a function, so that it is called in a child span of the span of
+    a request (see ``Span.run``), if the request is traced.
+    """
+    span = getAttached(request, "span")
+    if span is None:
+        return f
+    return functools.partial(span.run, name, attributes, f)
+
+
+
+class Tracer(object):
+    """
+    Traces requests, and hands the finished spans to an ``exporter``.
+    """
+    def __init__(self, exporter, clock=None):
+        self.exporter = exporter
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+
+
+    def start(self, resource, request):
+        """
+        Starts the span of a request for a resource, unless it already has
+        one.
+
+        The span ends when the request is finished.
+        """
+        span = getAttached(request, "span")
+        if span is not None:
+            return span
+
+        traceId, parentId = parseTraceparent(request.getHeader("traceparent"))
+        if traceId is None:
+            traceId = _newIdentifier(16)
+
+        attributes = {"http.method": request.method,
+                      "http.target": request.path,
+                      "txyoga.resource": resource.__class__.__name__}
+        name = "%s %s" % (request.method, resource.__class__.__name__)
+        span = request.span = Span(self, name, traceId, parentId, attributes)
+
+        d = request.notifyFinish()
+
+        @d.addBoth
+        def end(result):
+            span.setAttribute("http.status_code", request.code)
+            span.end(failed=result is not None or request.code >= 500)
+
+        return span
+
+
+    def export(self, span):
+        try:
+            self.exporter.export(span)
+        except Exception:
+            log.err(None, "Couldn't export span %s" % (span.name,))
+
+
+
+_traceparent = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+def parseTraceparent(header):
+    """
+    Parses a W3C ``traceparent`` header.
+
+    Returns the trace identifier and the identifier of the parent span, or
+    ``None`` for both if the header is missing or invalid.
+    """
+    match = _traceparent.match((header or "").strip().lower())
+    if match is None:
+        return None, None
+
+    traceId, parentId = match.groups()
+    if traceId == "0" * 32 or parentId == "0" * 16:
+        return None, None
+
+    return traceId, parentId
+
+
+def _newIdentifier(size):
+    return binascii.hexlify(os.urandom(size))
+
+
+
+class InMemoryExporter(object):
+    """
+    Keeps the exported spans in a list.
+    """
+    def __init__(self):
+        self.spans = []
+
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+
+class FileExporter(object):
+    """
+    Writes the exported spans to a file, one JSON object per line.
+    """
+    def __init__(self, output):
+        self.output = output
+
+
+    def export(self, span):
+        self.output.write(json.dumps(span.toState()) + "\n")
+        self.output.flush()
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+# Copyright (c), 2011, the txyoga authors. See the LICENSE file for details.
+"""
+Serving resources from several worker processes.
+
+A reactor only ever uses one core. The ``Launcher`` opens a listening
+socket, and starts worker processes that all accept connections on it,
+each serving its own copy of the same resource tree.
+
+Every change to an in-memory collection of a worker is sent to the
+launcher, which numbers it in sequence and passes it on to every worker
+(including the one it came from) in the order it received them. Since
+changes are applied idempotently, all copies of a collection end up the
+same, even when different workers change the same element at the same
+time. The sequence numbers become the versions of the collections (see
+``base.Collection.setSequencer``), so the versions, the sequence numbers
+of change feeds and the order of the elements are the same in all
+workers too, once they applied the same changes. A version or sequence
+number one worker gave a client can be used with any other.
+
+Snapshot tokens are the exception: a snapshot is only kept by the worker
+that took it, and the others answer requests for its pages with a
+``SnapshotExpiredError``.
+
+Run the launcher with the fully qualified name of a callable that builds
+the resource tree::
+
+    python -m txyoga.workers --port 8080 --workers 4 example.makeRoot
+
+That callable is called in every worker. It returns the root resource,
+and a dictionary of names to the collections that have to be kept the
+same in all workers. Those collections have to start out the same in all
+workers, and need elements that can be created again from their
+``getCreationState`` (see ``base.Element``).
+"""
+import functools
+import os
+import socket
+import sys
+try: # pragma: no cover
+    import simplejson as json
+except ImportError:# pragma: no cover
+    import json
+
+from twisted.internet import protocol
+from twisted.protocols import basic
+from twisted.python import log, reflect, usage
+
+from txyoga import changes
+
+
+class ChangeStream(basic.LineOnlyReceiver):
+    """
+    A stream of changes, one JSON-encoded change per line.
+    """
+    delimiter = "\n"
+    MAX_LENGTH = 1 << 24
+
+    def __init__(self, received, lost=None):
+        self._received = received
+        self._lost = lost
+
+
+    def lineReceived(self, line):
+        self._received(line)
+
+
+    def connectionLost(self, reason):
+        if self._lost is not None:
+            self._lost(reason)
+
+
+
+class Replicator(object):
+    """
+    Keeps collections the same as their copies in the other workers.
+
+    The replicator is the sequencer of the collections: local changes are
+    sent to the launcher. Changes from the launcher are applied to the
+    collections with the launcher's sequence number, counted from the
+    version the collection had when replication started.
+    """
+    def __init__(self, collections, lost=None):
+        self.collections = collections
+        self.stream = ChangeStream(self.changeReceived, lost)
+        self._initialVersions = {}
+
+        for name, collection in collections.iteritems():
+            self._initialVersions[name] = collection.version
+            sequencer = functools.partial(self._changed, name)
+            collection.setSequencer(sequencer)
+
+
+    def _changed(self, name, change):
+        message = {"collection": name, "change": change.toState()}
+        self.stream.sendLine(json.dumps(message))
+
+
+    def changeReceived(self, line):
+        message = json.loads(line)
+        name = message["collection"]
+        change = changes.Change.fromState(message["change"])
+        change.sequence += self._initialVersions[name]
+        self.collections[name].applyChange(change)
+
+
+
+class _WorkerProcess(protocol.ProcessProtocol):
+    """
+    The launcher's end of a worker process.
+    """
+    def __init__(self, launcher):
+        self.launcher = launcher
+        self._buffer = ""
+
+
+    def outReceived(self, data):
+        lines = (self._buffer + data).split(ChangeStream.delimiter)
+        self._buffer = lines.pop()
+        for line in lines:
+            self.launcher.broadcast(line)
+
+
+    def sendLine(self, line):
+        self.transport.write(line + ChangeStream.delimiter)
+
+
+    def processEnded(self, reason):
+        self.launcher.workerEnded(self, reason)
+
+
+
+class Launcher(object):
+    """
+    Starts worker processes that share a listening socket, and passes the
+    changes each of them makes on to all of them.
+    """
+    backlog = 128
+
+    def __init__(self, factory, port, workers=None, interface="",
+                 reactor=None):
+        self.factory = factory
+        self.port = port
+        self.workers = workers or _cpuCount()
+        self.interface = interface
+
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+        self._processes = []
+        self._sequences = {}
+        self._socket = None
+
+
+    def start(self):
+        """
+        Opens the listening socket, and starts the workers.
+        """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.interface, self.port))
+        self._socket.listen(self.backlog)
+        self._socket.setblocking(False)
+
+        for _ in xrange(self.workers):
+            self._spawn()
+
+
+    def _spawn(self):
+        fd = self._socket.fileno()
+        process = _WorkerProcess(self)
+        args = [sys.executable, "-m", "txyoga.workers",
+                "--worker-fd", str(fd), self.factory]
+        self._reactor.spawnProcess(process, sys.executable, args,
+                                   env=os.environ,
+                                   childFDs={0: "w", 1: "r", 2: 2, fd: fd})
+        self._processes.append(process)
+
+
+    def broadcast(self, line):
+        """
+        Numbers a change in sequence with the others to the same
+        collection, and passes it on to all workers.
+        """
+        message = json.loads(line)
+        name = message["collection"]
+        sequence = self._sequences.get(name, 0) + 1
+        self._sequences[name] = message["change"]["sequence"] = sequence
+
+        line = json.dumps(message)
+        for process in self._processes:
+            process.sendLine(line)
+
+
+    def workerEnded(self, process, reason):
+        """
+        Forgets about a worker that has ended.
+
+        Workers aren't replaced, since a new worker wouldn't have the
+        changes the others made. Once all of them have ended, the reactor
+        is stopped.
+        """
+        log.msg("Worker ended: %s" % (reason.getErrorMessage(),))
+        self._processes.remove(process)
+        if not self._processes:
+            self._reactor.stop()
+
+
+
+def _cpuCount():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError): # pragma: no cover
+        return 1
+
+
+def runWorker(factory, fd, reactor=None):
+    """
+    Serves the resource tree built by the factory on a listening socket
+    inherited from the launcher, and exchanges changes with the launcher
+    over standard in and out.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    from twisted.internet import stdio
+    from twisted.web import server
+
+    root, collections = reflect.namedAny(factory)()
+
+    replicator = Replicator(collections, lost=lambda _: reactor.stop())
+    stdio.StandardIO(replicator.stream)
+    reactor.adoptStreamPort(fd, socket.AF_INET, server.Site(root))
+    reactor.run()
+
+
+
+class Options(usage.Options):
+    synopsis = "[options] factory"
+
+    optParameters = [
+        ["port", "p", 8080, "The port to listen on.", int],
+        ["interface", "i", "", "The interface to listen on."],
+        ["workers", "w", None, "The number of worker processes. "
+                               "Defaults to the number of cores.", int],
+        ["worker-fd", None, None, "Run as a worker, serving this listening "
+                                  "socket.", int]]
+
+    def parseArgs(self, factory):
+        self["factory"] = factory
+
+
+
+def main(argv=None):
+    from twisted.internet import reactor
+
+    options = Options()
+    options.parseOptions(argv if argv is not None else sys.argv[1:])
+    log.startLogging(sys.stderr)
+
+    if options["worker-fd"] is not None:
+        runWorker(options["factory"], options["worker-fd"], reactor)
+        return
+
+    launcher = Launcher(options["factory"], options["port"],
+                        options["workers"], options["interface"], reactor)
+    reactor.callWhenRunning(launcher.start)
+    reactor.run()
+
+
+
+if __name__ == "__main__":
+    main()